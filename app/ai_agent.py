@@ -1,61 +1,68 @@
-from openai import OpenAI
 from typing import Dict, Any
 import json
 import os
-from dotenv import load_dotenv
 
-from moodle_integration import MoodleIntegration
-from memory import ConversationMemory
+from app_container import AppContainer, get_container
+from memory import create_session_memory
 from mcp_integration import MCPClient
+from metrics import metric_labels, stage_timer
+from usage import CourseOverBudget
 from tools import (
     QuizTools, GradingTools, AnnouncementTools,
     PerformanceTools, StudyTools, ResourceTools
 )
 from models import QuizRequest, GradingRequest, AnnouncementRequest
-from graph_memory.neo4j_connector import Neo4jConnector
-from graph_memory.memory_schema import GraphMemory 
-from graph_memory.config import Config
 from models import GraphQARequest
 from tools.graph_qa import GraphQATool
 
-load_dotenv()
 
-OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+class AcademicAIAgent:
+    def __init__(self, container: AppContainer = None):
+        # OpenAI, Moodle, Neo4j and the tools come from the shared container, built on first use
+        self.container = container or get_container()
+        self.mcp_client = MCPClient()
+        self.memory = create_session_memory(max_turns=5, summarize=self._summarize_history)
+        self.tool_schemas = self._build_tool_schemas()
 
-config = Config(
-    neo4j_uri="bolt://127.0.0.1:7687",
-    neo4j_user="neo4j",
-    neo4j_password="MyPassword",
-    openai_api_key=OPENAI_API_KEY,
-    embedding_model_name="text-embedding-3-small",
-    chunk_size=500,
-    chunk_overlap=50
-)
+    @property
+    def client(self):
+        return self.container.openai_client
 
+    @property
+    def moodle(self):
+        return self.container.moodle
 
-neo4j_connector = Neo4jConnector(cfg = config)
+    @property
+    def graph_memory(self):
+        return self.container.graph_memory
 
-neo4j_graph = GraphMemory(
-    connector=neo4j_connector,
-    cfg=config
-)
+    @property
+    def quiz_tools(self) -> QuizTools:
+        return self.container.get("quiz_tools", lambda: QuizTools(self.client, self.graph_memory))
 
-class AcademicAIAgent:
-    def __init__(self):
-        print(neo4j_connector)
-        self.client = OpenAI(api_key=OPENAI_API_KEY)
-        self.moodle = MoodleIntegration(neo4j_graph_memory=neo4j_graph)
-        self.mcp_client = MCPClient()
-        self.memory = ConversationMemory(max_turns=5)
-        self.graph_memory = neo4j_graph
-        self.tool_schemas = self._build_tool_schemas()
-        self.quiz_tools = QuizTools(self.client, self.graph_memory)
-        self.grading_tools = GradingTools(self.client)
-        self.announcement_tools = AnnouncementTools(self.client)
-        self.performance_tools = PerformanceTools(self.client)
-        self.study_tools = StudyTools(self.client)
-        self.resource_tools = ResourceTools(self.client)
-        self.graph_qa_tools = GraphQATool(self.graph_memory)
+    @property
+    def grading_tools(self) -> GradingTools:
+        return self.container.get("grading_tools", lambda: GradingTools(self.client))
+
+    @property
+    def announcement_tools(self) -> AnnouncementTools:
+        return self.container.get("announcement_tools", lambda: AnnouncementTools(self.client))
+
+    @property
+    def performance_tools(self) -> PerformanceTools:
+        return self.container.get("performance_tools", lambda: PerformanceTools(self.client))
+
+    @property
+    def study_tools(self) -> StudyTools:
+        return self.container.get("study_tools", lambda: StudyTools(self.client))
+
+    @property
+    def resource_tools(self) -> ResourceTools:
+        return self.container.get("resource_tools", lambda: ResourceTools(self.client))
+
+    @property
+    def graph_qa_tools(self) -> GraphQATool:
+        return self.container.get("graph_qa_tools", lambda: GraphQATool(self.graph_memory))
 
 
     def _build_tool_schemas(self) -> Dict[str, Dict]:
@@ -82,11 +89,16 @@ class AcademicAIAgent:
         
         return formatted
 
-    def analyze_intent(self, user_prompt: str) -> Dict:
+    def analyze_intent(self, user_prompt: str, session_id: str = None, context: Dict = None) -> Dict:
         """Analyze user intent and determine which tool to use"""
         
         tools_description = self._format_tools_for_prompt()
-        memory_context = self.memory.get_context()
+        history = self.memory.get_context_stats(session_id)
+        memory_context = history["context"]
+        request_context = ", ".join(
+            f"{key}={value}" for key, value in (context or {}).items()
+            if key in ("course_id", "forum_id") and value is not None
+        ) or "none"
         
         prompt = f"""
         Analyze this user request and determine the appropriate action.
@@ -94,6 +106,7 @@ class AcademicAIAgent:
         {memory_context}
         
         Current User Request: {user_prompt}
+        Selected in the UI: {request_context}
         
         Available Actions and their required parameters:
         {tools_description}
@@ -117,13 +130,19 @@ class AcademicAIAgent:
         """
         
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[{"role": "user", "content": prompt}]
-            )
+            with stage_timer("analyze_intent"):
+                response = self.client.chat.completions.create(
+                    model="gpt-3.5-turbo",
+                    messages=[{"role": "user", "content": prompt}]
+                )
             
-            return json.loads(response.choices[0].message.content)
+            analysis = json.loads(response.choices[0].message.content)
+            analysis["history_tokens"] = {key: history[key] for key in ("context_tokens", "raw_tokens", "tokens_saved")}
+            print(f"🧮 History: {history['context_tokens']} prompt tokens ({history['tokens_saved']} saved by compaction)")
+            return analysis
 
+        except CourseOverBudget:
+            raise
         except Exception as e:
             print(f"❌ Error in analyze_intent: {str(e)}")
             return {"intent": "error", "parameters": {}, "confidence": 0.0}
@@ -131,11 +150,20 @@ class AcademicAIAgent:
     def handle_user_request(self, user_prompt: str, context: Dict = None) -> Dict:
         """Main entry point - analyzes intent and routes to appropriate tool"""
         
-        self.memory.add("General Context", context or "No additional context provided.")
-
-        intent_analysis = self.analyze_intent(user_prompt)
+        session_id = (context or {}).get("session_id")
+        try:
+            intent_analysis = self.analyze_intent(user_prompt, session_id, context)
+        except CourseOverBudget as e:
+            self.memory.add(session_id, user_prompt, f"💸 {str(e)}")
+            return {"status": "error", "error": str(e), "intent": "over_budget"}
         
         print(f"Intent Analysis: {intent_analysis}")
+
+        if intent_analysis.get("intent") == "error":
+            # there is no tool to call; say so instead of dispatching "error"
+            message = "I could not work out what to do with that request. Please try rephrasing it."
+            self.memory.add(session_id, user_prompt, f"❌ {message}")
+            return {"status": "error", "error": message, "intent": "error"}
         
         if intent_analysis.get("missing_parameters"):
             response = {
@@ -143,10 +171,11 @@ class AcademicAIAgent:
                 "intent": intent_analysis["intent"],
                 "missing_parameters": intent_analysis["missing_parameters"],
                 "clarification_question": intent_analysis.get("clarification_question"),
-                "message": f"I need more information to proceed. {intent_analysis.get('clarification_question', 'Please provide the missing parameters.')}"
+                "message": f"I need more information to proceed. {intent_analysis.get('clarification_question', 'Please provide the missing parameters.')}",
+                "history_tokens": intent_analysis.get("history_tokens")
             }
             
-            self.memory.add(user_prompt, response["message"])
+            self.memory.add(session_id, user_prompt, response["message"])
             return response
         
         try:
@@ -165,31 +194,43 @@ class AcademicAIAgent:
             
             # Call the tool
             result = self.call_tool(intent_analysis["intent"], tool_params)
+            if isinstance(result, dict) and "error" in result and "message" not in result:
+                # tool failures (including a course past its hard budget) come back as {"error": ...}
+                raise RuntimeError(result["error"])
             
             # Extract generated content from the result
             generated_content = result.get("generated_content", "")
             print("Generated content:", generated_content)
             
             success_message = f"✅ Successfully executed {intent_analysis['intent']}"
-            self.memory.add(user_prompt, success_message)
+            # Tool output goes into history too; large outputs (whole quizzes) are kept as short references
+            output = generated_content or result.get("message")
+            if output:
+                output = output if isinstance(output, str) else json.dumps(output, default=str)
+                success_message = f"{success_message}\n{output}"
+            self.memory.add(session_id, user_prompt, success_message)
             
             response = {
                 "status": "success",
                 "intent": intent_analysis["intent"],
                 "message": result["message"] if "message" in result else result,
-                "confidence": intent_analysis["confidence"]
+                "confidence": intent_analysis["confidence"],
+                "history_tokens": intent_analysis.get("history_tokens")
             }
+            if result.get("outbox_id"):
+                response["outbox_id"] = result["outbox_id"]
             
             # Add generated content for confirmation flow (only for Moodle actions on first call)
             moodle_actions = ["generate_quiz", "post_announcement"]
             if not is_confirmed and intent_analysis["intent"] in moodle_actions:
                 response["generated_content"] = generated_content
+                response["artifact_id"] = result.get("artifact_id")
             
             return response
             
         except Exception as e:
             error_message = f"❌ Error: {str(e)}"
-            self.memory.add(user_prompt, error_message)
+            self.memory.add(session_id, user_prompt, error_message)
             
             return {
                 "status": "error",
@@ -197,20 +238,70 @@ class AcademicAIAgent:
                 "intent": intent_analysis["intent"]
             }
     
+    def publish_artifact(self, artifact_id: str, intent: str = None, session_id: str = None) -> Dict:
+        """Queue a previewed artifact for publishing as approved, without re-running intent analysis or generation"""
+        try:
+            result = self.call_tool("publish_artifact", {"artifact_id": artifact_id})
+        except Exception as e:
+            result = {"error": str(e)}
+
+        intent = result.get("intent", intent)
+        if "error" in result:
+            self.memory.add(session_id, f"Confirm {intent}", f"❌ Error: {result['error']}")
+            return {"status": "error", "error": result["error"], "intent": intent}
+
+        self.memory.add(session_id, f"Confirm {intent}", f"📬 Queued {intent} for posting to Moodle")
+        return {
+            "status": "queued",
+            "intent": intent,
+            "outbox_id": result.get("outbox_id"),
+            "message": result.get("message", result)
+        }
+
+    def get_publish_status(self, outbox_id: str) -> Dict:
+        """Delivery state of a queued publish action (status, attempts, result with the final URL)"""
+        return self.mcp_client.get_outbox_entry(outbox_id)
+
+    def _summarize_history(self, previous_summary: str, messages: list) -> str:
+        """Fold turns evicted from the prompt history into the running summary (one small model call)"""
+        transcript = "\n".join(f"{'User' if m['role'] == 'user' else 'Assistant'}: {m['content']}" for m in messages)
+        summary_tokens = int(os.getenv("MEMORY_SUMMARY_TOKENS", "150"))
+        with stage_timer("summarize_history"):
+            response = self.client.chat.completions.create(
+                model=os.getenv("MEMORY_SUMMARY_MODEL", "gpt-4o-mini"),
+                messages=[{"role": "user", "content": f"""
+                Update the running summary of a conversation between a teacher and a Moodle assistant.
+                Keep course ids, forum ids, topics, requested parameters and decisions; drop pleasantries.
+                Answer in at most {summary_tokens * 3 // 4} words, with only the updated summary.
+
+                Current summary: {previous_summary or "(none)"}
+
+                New messages:
+                {transcript}
+                """}],
+                max_tokens=summary_tokens
+            )
+        return response.choices[0].message.content.strip()
+
+    def get_memory_reference(self, ref_id: str):
+        """Full text of a message that history replaced with ref:<id>"""
+        return self.memory.compactor.reference(ref_id)
+
     def call_tool(self, tool_name: str, params: dict):
         """Call a tool through MCP"""
-        return self.mcp_client.call_tool(tool_name, params)
+        with metric_labels(tool=tool_name, course=params.get("course_id")), stage_timer("mcp_call"):
+            return self.mcp_client.call_tool(tool_name, params)
 
     def list_tools(self):
         """List available tools"""
         return self.mcp_client.list_tools()
 
     # Expose memory methods
-    def clear_memory(self):
-        self.memory.clear()
+    def clear_memory(self, session_id: str = None):
+        self.memory.clear(session_id)
 
-    def get_memory(self):
-        return self.memory.get_history()
+    def get_memory(self, session_id: str = None):
+        return self.memory.get_history(session_id)
 
-    def get_conversation_history(self):
-        return self.memory.conversation_history
\ No newline at end of file
+    def get_conversation_history(self, session_id: str = None):
+        return self.memory.get_history(session_id)
\ No newline at end of file
@@ -0,0 +1,107 @@
+# app/app_container.py
+import os
+import threading
+import time
+from typing import Any, Callable, Dict
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+class AppContainer:
+    """
+    Shared services for the chat API and the MCP router, built on first use rather than at import.
+    Each service is constructed once per process (thread-safe), so both routers share one agent,
+    one Moodle client, one OpenAI client and one Neo4j driver. Heavy libraries (openai, neo4j,
+    numpy) are only imported when the service that needs them is built.
+    """
+
+    def __init__(self):
+        self._instances: Dict[str, Any] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self.build_seconds: Dict[str, float] = {}
+
+    def get(self, name: str, factory: Callable[[], Any]) -> Any:
+        """The service called name, built with factory() the first time it is asked for"""
+        if name in self._instances:
+            return self._instances[name]
+        # one lock per service, so building the agent can build the graph it depends on
+        with self._lock:
+            lock = self._locks.setdefault(name, threading.Lock())
+        with lock:
+            if name not in self._instances:
+                start = time.perf_counter()
+                self._instances[name] = factory()
+                self.build_seconds[name] = round(time.perf_counter() - start, 3)
+                print(f"🧱 Built {name} in {self.build_seconds[name]:.2f}s")
+        return self._instances[name]
+
+    def is_built(self, name: str) -> bool:
+        return name in self._instances
+
+    @property
+    def config(self):
+        def build():
+            from graph_memory.config import Config
+            return Config(
+                neo4j_uri="bolt://127.0.0.1:7687",
+                neo4j_user="neo4j",
+                neo4j_password="MyPassword",
+                openai_api_key=os.getenv('OPENAI_API_KEY'),
+                embedding_model_name="text-embedding-3-small",
+                chunk_size=500,
+                chunk_overlap=50
+            )
+        return self.get("config", build)
+
+    @property
+    def openai_client(self):
+        def build():
+            from openai import OpenAI
+            from usage import track_openai_client
+            return track_openai_client(OpenAI(api_key=os.getenv('OPENAI_API_KEY')))
+        return self.get("openai_client", build)
+
+    @property
+    def neo4j_connector(self):
+        def build():
+            from graph_memory.neo4j_connector import Neo4jConnector
+            return Neo4jConnector(cfg=self.config)
+        return self.get("neo4j_connector", build)
+
+    @property
+    def graph_memory(self):
+        def build():
+            # GraphMemory creates its schema in Neo4j when constructed
+            from graph_memory.memory_schema import GraphMemory
+            return GraphMemory(connector=self.neo4j_connector, cfg=self.config, client=self.openai_client)
+        return self.get("graph_memory", build)
+
+    @property
+    def moodle(self):
+        def build():
+            from moodle_integration import MoodleIntegration
+            return MoodleIntegration(graph_memory_factory=lambda: self.graph_memory)
+        return self.get("moodle", build)
+
+    @property
+    def agent(self):
+        def build():
+            from ai_agent import AcademicAIAgent
+            return AcademicAIAgent(container=self)
+        return self.get("agent", build)
+
+
+_container = None
+_container_lock = threading.Lock()
+
+
+def get_container() -> AppContainer:
+    """Process-wide application container"""
+    global _container
+    with _container_lock:
+        if _container is None:
+            _container = AppContainer()
+        return _container
@@ -0,0 +1,52 @@
+import os
+import time
+import uuid
+from typing import Dict, Any, Optional
+
+from state_backend import StateBackend, get_state_backend
+
+
+class ArtifactStore:
+    """Keeps generated previews (quizzes, announcements) until the user confirms them"""
+
+    namespace = "artifacts"
+
+    def __init__(self, ttl_seconds: int = None, backend: StateBackend = None):
+        self.ttl_seconds = ttl_seconds or int(os.getenv("ARTIFACT_TTL_SECONDS", "1800"))
+        # with a shared backend, a preview made by one worker can be confirmed on another
+        self.backend = backend or get_state_backend()
+
+    def put(self, kind: str, content: Any, params: Dict[str, Any] = None) -> str:
+        """Store a generated artifact and return its ID"""
+        artifact_id = uuid.uuid4().hex
+        now = time.time()
+        self.backend.set(self.namespace, artifact_id, {
+            "artifact_id": artifact_id,
+            "kind": kind,
+            "content": content,
+            "params": params or {},
+            "created_at": now,
+            "expires_at": now + self.ttl_seconds,
+        }, ttl=self.ttl_seconds)
+        return artifact_id
+
+    def get(self, artifact_id: str) -> Optional[Dict[str, Any]]:
+        """Return the artifact, or None if it is unknown or expired"""
+        return self.backend.get(self.namespace, artifact_id)
+
+    def take(self, artifact_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Remove and return the artifact in one atomic step, or None if it is unknown, expired or
+        already taken. Of several concurrent confirmations, exactly one gets the artifact.
+        """
+        return self.backend.pop(self.namespace, artifact_id)
+
+    def restore(self, artifact: Dict[str, Any]):
+        """Put back an artifact taken with take() whose publishing could not be queued"""
+        ttl = artifact["expires_at"] - time.time()
+        if ttl > 0:
+            self.backend.set(self.namespace, artifact["artifact_id"], artifact, ttl=ttl)
+
+    def discard(self, artifact_id: str):
+        """Remove an artifact once it has been published"""
+        self.backend.delete(self.namespace, artifact_id)
@@ -0,0 +1,189 @@
+# app/async_moodle.py
+import asyncio
+import os
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import httpx
+from dotenv import load_dotenv
+
+from moodle_integration import RETRYABLE_STATUSES, is_read_only_wsfunction
+from tracing import span
+
+load_dotenv()
+
+
+def _moodle_error(result: Any) -> Optional[str]:
+    """Message of a Moodle error response (Moodle reports errors as a dict in a 200 response), else None"""
+    if isinstance(result, dict) and (result.get('exception') or result.get('errorcode')):
+        return result.get('message') or result.get('errorcode') or str(result.get('exception'))
+    return None
+
+
+def _expect_list(result: Any, what: str) -> List[Dict]:
+    """result if it is a list; a Moodle error (or anything else) raises instead of being fanned out over"""
+    error = _moodle_error(result)
+    if error:
+        raise ValueError(f"Moodle could not list {what}: {error}")
+    if not isinstance(result, list):
+        raise ValueError(f"Unexpected response listing {what}: {str(result)[:200]}")
+    return result
+
+
+class AsyncMoodleIntegration:
+    """
+    Async Moodle client for course-wide operations that need one call per student or module.
+    Calls share one pooled HTTP client and at most max_concurrency run at a time.
+    """
+
+    def __init__(self, base_url: str = None, token: str = None, max_concurrency: int = None):
+        self.base_url = base_url or os.getenv('MOODLE_BASE_URL', 'https://teaching-assistant-agent.moodlecloud.com/webservice/rest/server.php')
+        self.token = token or os.getenv('EXTERNAL_MOODLE_TOKEN', '4140e426c7adb15979c0c18ce57bd45d')
+        self.max_concurrency = max_concurrency or int(os.getenv('MOODLE_MAX_CONCURRENCY', '10'))
+        self.max_retries = int(os.getenv('MOODLE_MAX_RETRIES', '3'))
+        self.retry_backoff = float(os.getenv('MOODLE_RETRY_BACKOFF', '0.5'))
+        self.timeout = httpx.Timeout(
+            float(os.getenv('MOODLE_READ_TIMEOUT', '30')),
+            connect=float(os.getenv('MOODLE_CONNECT_TIMEOUT', '5'))
+        )
+        self._client = None
+        self._semaphore = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # Created lazily so the client and semaphore bind to the running event loop
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.max_concurrency,
+                    max_keepalive_connections=self.max_concurrency
+                )
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def make_api_call(self, function: str, data: Dict = None) -> Any:
+        """Make an async API call to Moodle (same retry rules as MoodleIntegration.make_api_call)"""
+        client = self._get_client()
+        params = {
+            'wstoken': self.token,
+            'moodlewsrestformat': 'json',
+            'wsfunction': function
+        }
+        if data:
+            params.update(data)
+
+        idempotent = is_read_only_wsfunction(function)
+        attempt = 0
+        while True:
+            try:
+                async with self._semaphore:
+                    with span("moodle.async", wsfunction=function, attempt=attempt) as active:
+                        response = await client.post(self.base_url, data=params)
+                        active.set_attribute("status_code", response.status_code)
+                if idempotent and response.status_code in RETRYABLE_STATUSES and attempt < self.max_retries:
+                    raise httpx.HTTPStatusError(f"HTTP {response.status_code}", request=response.request, response=response)
+                response.raise_for_status()
+                return response.json()
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                safe_to_retry = idempotent or isinstance(e, httpx.ConnectError)
+                retryable_http = not isinstance(e, httpx.HTTPStatusError) or e.response.status_code in RETRYABLE_STATUSES
+                if not (safe_to_retry and retryable_http) or attempt >= self.max_retries:
+                    raise
+                delay = self.retry_backoff * (2 ** attempt)
+                attempt += 1
+                print(f"⚠ Moodle {function} failed ({str(e)}), retry {attempt}/{self.max_retries} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def get_enrolled_students(self, course_id: int) -> List[Dict]:
+        """Get all students enrolled in a specific course"""
+        return await self.make_api_call('core_enrol_get_enrolled_users', {'courseid': course_id})
+
+    async def get_user_grades(self, course_id: int, user_id: int = None) -> Any:
+        """Get user grades"""
+        params = {'courseid': course_id}
+        if user_id:
+            params['userid'] = user_id
+        return await self.make_api_call('gradereport_user_get_grade_items', params)
+
+    async def get_course_contents(self, course_id: int) -> List[Dict]:
+        """Get course content"""
+        return await self.make_api_call('core_course_get_contents', {'courseid': course_id})
+
+    async def _fan_out(self, items: List[Any], call) -> AsyncIterator[Tuple[Any, Any, str]]:
+        """Run call(item) for every item concurrently and yield (item, result, error) as each completes"""
+        async def run(item):
+            try:
+                return item, await call(item), None
+            except Exception as e:
+                return item, None, str(e)
+
+        tasks = [asyncio.ensure_future(run(item)) for item in items]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                yield await finished
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def iter_grades_for_enrolled_users(self, course_id: int) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Yield each enrolled user's grade items as soon as their call completes.
+        Raises ValueError if Moodle cannot list the enrolled users.
+        """
+        users = _expect_list(await self.get_enrolled_students(course_id), f"the users enrolled in course {course_id}")
+        async for user, grades, error in self._fan_out(
+            users, lambda user: self.get_user_grades(course_id, user['id'])
+        ):
+            error = error or _moodle_error(grades)
+            yield {
+                "user_id": user.get('id'),
+                "fullname": user.get('fullname'),
+                "grades": None if error else grades,
+                "error": error
+            }
+
+    async def grades_for_enrolled_users(self, course_id: int) -> Dict[str, Any]:
+        """Grade items for every enrolled user, keyed by user ID"""
+        start = time.perf_counter()
+        results = {}
+        async for item in self.iter_grades_for_enrolled_users(course_id):
+            results[item["user_id"]] = item
+        return {
+            "course_id": course_id,
+            "users": results,
+            "elapsed_seconds": round(time.perf_counter() - start, 3)
+        }
+
+    async def iter_resource_file_metadata(self, course_id: int) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Yield the file metadata of every resource module in the course as each lookup completes.
+        Raises ValueError if Moodle cannot list the course contents.
+        """
+        sections = _expect_list(await self.get_course_contents(course_id), f"the contents of course {course_id}")
+        modules = [
+            module
+            for section in sections
+            for module in section.get('modules', [])
+            if module.get('modname') == 'resource' and module.get('contextid')
+        ]
+        async for module, result, error in self._fan_out(
+            modules,
+            lambda module: self.make_api_call('core_files_get_files', {
+                'contextid': module['contextid'],
+                'component': 'mod_resource',
+                'filearea': 'content',
+                'itemid': 0
+            })
+        ):
+            yield {
+                "module_id": module.get('id'),
+                "module_name": module.get('name'),
+                "files": (result or {}).get('files', []) if isinstance(result, dict) else [],
+                "error": error or _moodle_error(result)
+            }
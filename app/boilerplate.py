@@ -0,0 +1,108 @@
+# app/boilerplate.py
+import math
+import os
+import re
+from collections import Counter
+from itertools import chain, islice
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+
+from tokens import CHARS_PER_TOKEN
+
+
+def boilerplate_enabled() -> bool:
+    return os.getenv("BOILERPLATE_STRIP", "true").lower() != "false"
+
+
+def _line_key(line: str) -> str:
+    return re.sub(r"\s+", " ", line.strip().lower())
+
+
+def _masked_key(line: str) -> str:
+    """Line key with digits masked so "Page 3 of 40" matches "Page 4 of 40" """
+    return re.sub(r"\d+", "#", _line_key(line))
+
+
+class BoilerplateStripper:
+    """
+    Removes lines that repeat across most pages of a document (slide headers, footers,
+    course codes, page numbers) before chunking. A line counts as boilerplate if it recurs
+    verbatim, or - within the first/last edge_lines lines of a page - recurs once digits
+    are masked, so numbered body text is never mistaken for a page counter.
+
+    Repeated lines are learned from the first sample_pages pages, so pages can still be
+    streamed: the sample is buffered, then every page is filtered as it arrives.
+    """
+
+    def __init__(self, sample_pages: int = None, min_share: float = None, min_pages: int = 3,
+                 max_line_length: int = 120, edge_lines: int = 3):
+        self.sample_pages = sample_pages or int(os.getenv("BOILERPLATE_SAMPLE_PAGES", "12"))
+        self.min_share = min_share or float(os.getenv("BOILERPLATE_MIN_SHARE", "0.6"))
+        self.min_pages = min_pages
+        self.max_line_length = max_line_length
+        self.edge_lines = edge_lines
+        self.patterns = set()
+        self.masked_patterns = set()
+        self.pages = 0
+        self.characters_in = 0
+        self.lines_removed = 0
+        self.characters_removed = 0
+
+    def _candidates(self, text: str) -> List[Tuple[str, bool]]:
+        """(line, is_edge) for every non-empty line short enough to be a header or footer"""
+        lines = [line for line in text.split("\n") if line.strip()]
+        return [
+            (line, index < self.edge_lines or index >= len(lines) - self.edge_lines)
+            for index, line in enumerate(lines)
+            if len(line.strip()) <= self.max_line_length
+        ]
+
+    def _detect(self, pages: List[Tuple[int, str]]):
+        if len(pages) < self.min_pages:
+            return
+        counts, masked_counts = Counter(), Counter()
+        for _, text in pages:
+            candidates = self._candidates(text)
+            counts.update({_line_key(line) for line, _ in candidates})
+            masked_counts.update({_masked_key(line) for line, edge in candidates if edge})
+        needed = max(self.min_pages, math.ceil(self.min_share * len(pages)))
+        self.patterns = {key for key, count in counts.items() if count >= needed}
+        self.masked_patterns = {key for key, count in masked_counts.items() if count >= needed}
+
+    def _strip(self, text: str) -> str:
+        removable = {
+            line for line, edge in self._candidates(text)
+            if _line_key(line) in self.patterns or (edge and _masked_key(line) in self.masked_patterns)
+        }
+        kept = []
+        for line in text.split("\n"):
+            if line in removable:
+                self.lines_removed += 1
+                self.characters_removed += len(line) + 1
+            else:
+                kept.append(line)
+        return "\n".join(kept)
+
+    def filter(self, pages: Iterable[Tuple[int, str]]) -> Iterator[Tuple[int, str]]:
+        """Yield (page_no, text) with boilerplate lines removed"""
+        pages = iter(pages)
+        sample = list(islice(pages, self.sample_pages))
+        self._detect(sample)
+        for page_no, text in chain(sample, pages):
+            self.pages += 1
+            self.characters_in += len(text)
+            yield page_no, self._strip(text) if self.patterns or self.masked_patterns else text
+
+    def report(self, chunks_before: int = None, chunks_after: int = None) -> Dict[str, Any]:
+        """What stripping saved for this document"""
+        report = {
+            "pages": self.pages,
+            "patterns": len(self.patterns | self.masked_patterns),
+            "lines_removed": self.lines_removed,
+            "characters_removed": self.characters_removed,
+            "share_removed": round(self.characters_removed / self.characters_in, 3) if self.characters_in else 0.0,
+            "tokens_saved": self.characters_removed // CHARS_PER_TOKEN,
+        }
+        if chunks_before is not None and chunks_after is not None:
+            report["chunks_before"] = chunks_before
+            report["chunks_saved"] = chunks_before - chunks_after
+        return report
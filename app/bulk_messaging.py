@@ -0,0 +1,94 @@
+# app/bulk_messaging.py
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from string import Template
+from typing import Any, Dict, List
+
+
+def render_message(template: str, recipient: Dict[str, Any]) -> str:
+    """
+    Personalize a message locally from Moodle user fields, e.g. "Hi $firstname, ...".
+    Unknown placeholders are left as they are.
+    """
+    return Template(template).safe_substitute(
+        {key: value for key, value in recipient.items() if isinstance(value, (str, int, float))}
+    )
+
+
+class BulkNotifier:
+    """
+    Sends messages to many users by packing them into batched core_message_send_instant_messages
+    calls, several batches at a time, and reports the delivery result for every recipient.
+    """
+
+    def __init__(self, moodle, batch_size: int = None, max_parallel: int = None):
+        self.moodle = moodle
+        self.batch_size = batch_size or int(os.getenv("MESSAGE_BATCH_SIZE", "50"))
+        self.max_parallel = max_parallel or int(os.getenv("MESSAGE_MAX_PARALLEL", "4"))
+
+    def send(self, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Deliver messages ({"user_id", "text"}) and return per-recipient results.
+        Messages are write calls, so a failed batch is reported rather than retried.
+        """
+        start = time.perf_counter()
+        batches = [messages[i:i + self.batch_size] for i in range(0, len(messages), self.batch_size)]
+        results: List[Dict[str, Any]] = []
+        if batches:
+            with ThreadPoolExecutor(max_workers=min(self.max_parallel, len(batches)),
+                                    thread_name_prefix="notify") as pool:
+                for batch_results in pool.map(self._send_batch, range(len(batches)), batches):
+                    results.extend(batch_results)
+
+        sent = sum(1 for r in results if r["status"] == "sent")
+        print(f"✉ Sent {sent}/{len(messages)} messages in {len(batches)} batches")
+        return {
+            "sent": sent,
+            "failed": len(results) - sent,
+            "batches": len(batches),
+            "results": results,
+            "elapsed_seconds": round(time.perf_counter() - start, 3)
+        }
+
+    def _send_batch(self, batch_index: int, batch: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        payload = [
+            {"touserid": m["user_id"], "text": m["text"], "clientmsgid": f"b{batch_index}m{i}"}
+            for i, m in enumerate(batch)
+        ]
+        try:
+            response = self.moodle.send_instant_messages(payload)
+            if isinstance(response, dict) and "exception" in response:
+                raise ValueError(response.get("message") or response.get("errorcode"))
+        except Exception as e:
+            print(f"❌ Message batch {batch_index} failed: {str(e)}")
+            return [{"user_id": m["user_id"], "status": "failed", "msgid": None, "error": str(e)} for m in batch]
+
+        by_client_id = {
+            item.get("clientmsgid"): item for item in response if isinstance(item, dict)
+        } if isinstance(response, list) else {}
+        results = []
+        for message in payload:
+            item = by_client_id.get(message["clientmsgid"])
+            if item is None:
+                results.append({"user_id": message["touserid"], "status": "unknown", "msgid": None,
+                                "error": "no result returned for this message"})
+            elif item.get("msgid", -1) == -1 or item.get("errormessage"):
+                results.append({"user_id": message["touserid"], "status": "failed", "msgid": None,
+                                "error": item.get("errormessage") or "not delivered"})
+            else:
+                results.append({"user_id": message["touserid"], "status": "sent", "msgid": item["msgid"],
+                                "error": None})
+        return results
+
+    def notify_course(self, course_id: int, template: str, user_ids: List[int] = None) -> Dict[str, Any]:
+        """
+        Message the enrolled users of a course (optionally only user_ids), personalizing
+        the template per student with their Moodle fields ($firstname, $fullname, ...).
+        """
+        users = self.moodle.get_enrolled_students(course_id)
+        if user_ids:
+            wanted = set(user_ids)
+            users = [user for user in users if user.get("id") in wanted]
+        messages = [{"user_id": user["id"], "text": render_message(template, user)} for user in users]
+        return {"course_id": course_id, **self.send(messages)}
@@ -0,0 +1,123 @@
+# app/extraction_cache.py
+import gzip
+import json
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+class ExtractionCache:
+    """
+    Content-addressed on-disk cache of extracted PDF pages, keyed by the SHA-256 of the PDF bytes.
+    Entries are gzipped JSON files; the least recently used ones are evicted once the cache
+    grows past max_bytes.
+    """
+
+    def __init__(self, cache_dir: str = None, max_bytes: int = None):
+        self.cache_dir = cache_dir or os.getenv("EXTRACTION_CACHE_DIR", "extraction_cache")
+        self.max_bytes = max_bytes or int(os.getenv("EXTRACTION_CACHE_MAX_MB", "512")) * 1024 * 1024
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+        # content hash -> entry size, least recently used first (file mtime tracks use across restarts)
+        self._index: "OrderedDict[str, int]" = OrderedDict()
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".json.gz"):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, name[:-len(".json.gz")], stat.st_size))
+        for _, content_hash, size in sorted(entries):
+            self._index[content_hash] = size
+        self._total = sum(self._index.values())
+
+    def _path(self, content_hash: str) -> str:
+        return os.path.join(self.cache_dir, f"{content_hash}.json.gz")
+
+    def get(self, content_hash: str) -> Optional[List[Tuple[int, str]]]:
+        """Cached (page_no, text) pages for the PDF, or None"""
+        path = self._path(content_hash)
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                pages = [(page_no, text) for page_no, text in json.load(f)["pages"]]
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                self._stats["misses"] += 1
+                self._total -= self._index.pop(content_hash, 0)
+            return None
+
+        with self._lock:
+            self._stats["hits"] += 1
+            if content_hash in self._index:
+                self._index.move_to_end(content_hash)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return pages
+
+    def put(self, content_hash: str, pages: List[Tuple[int, str]]):
+        data = gzip.compress(json.dumps({"pages": pages}).encode("utf-8"))
+        if len(data) > self.max_bytes:
+            return
+        # write-then-rename so readers never see a partial entry
+        tmp_path = f"{self._path(content_hash)}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        self._commit(content_hash, tmp_path, len(data))
+
+    def caching(self, content_hash: str, pages: Iterable[Tuple[int, str]]) -> Iterator[Tuple[int, str]]:
+        """
+        Yield pages unchanged while writing them to the cache, so a document can be cached without
+        holding all of its pages; the entry is only stored once every page has passed through.
+        """
+        tmp_path = f"{self._path(content_hash)}.{uuid.uuid4().hex}.tmp"
+        try:
+            with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+                f.write('{"pages": [')
+                for index, page in enumerate(pages):
+                    f.write((", " if index else "") + json.dumps(list(page)))
+                    yield page
+                f.write("]}")
+            size = os.path.getsize(tmp_path)
+        except BaseException:
+            # failed or abandoned part-way: nothing is cached
+            os.remove(tmp_path)
+            raise
+        if size > self.max_bytes:
+            os.remove(tmp_path)
+            return
+        self._commit(content_hash, tmp_path, size)
+
+    def _commit(self, content_hash: str, tmp_path: str, size: int):
+        os.replace(tmp_path, self._path(content_hash))
+        with self._lock:
+            self._total += size - self._index.pop(content_hash, 0)
+            self._index[content_hash] = size
+            while self._total > self.max_bytes and self._index:
+                evicted, size = self._index.popitem(last=False)
+                self._total -= size
+                self._stats["evictions"] += 1
+                try:
+                    os.remove(self._path(evicted))
+                except OSError:
+                    pass
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self._stats, "entries": len(self._index), "bytes": self._total}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_extraction_cache() -> ExtractionCache:
+    """Process-wide extraction cache (created on first use)"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ExtractionCache()
+        return _cache
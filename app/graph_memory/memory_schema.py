@@ -7,20 +7,80 @@ from typing import List, Optional, Tuple, Dict, Any
 import openai
 from openai import OpenAI
 import uuid
+import threading
+import time
+from contextlib import contextmanager
 
+from metrics import stage_timer
+from usage import free_text_output, track_openai_client
 
 
 
+
+class TextChunker:
+    """
+    Incremental form of GraphMemory._chunk_text: feed text piece by piece (a piece may end
+    mid-word) and take each chunk as soon as it is complete, so a large document is never
+    held as one string. Feeding the pieces of a text gives the same chunks as chunking it whole.
+    """
+
+    def __init__(self, chunk_size: int, chunk_overlap: int):
+        self.chunk_size = chunk_size
+        self.step = chunk_size - chunk_overlap
+        self.words = 0
+        self._window: List[str] = []
+        self._tail = ""
+
+    def feed(self, text: str) -> List[str]:
+        text = self._tail + text
+        words = text.split()
+        # a trailing partial word waits for the rest of it
+        self._tail = words.pop() if words and not text[-1].isspace() else ""
+        self.words += len(words)
+        self._window.extend(words)
+        chunks = []
+        while len(self._window) >= self.chunk_size:
+            chunks.append(" ".join(self._window[:self.chunk_size]))
+            del self._window[:self.step]
+        return chunks
+
+    def finish(self) -> List[str]:
+        if self._tail:
+            self.words += 1
+            self._window.append(self._tail)
+            self._tail = ""
+        chunks = []
+        while self._window:
+            chunks.append(" ".join(self._window[:self.chunk_size]))
+            del self._window[:self.step]
+        return chunks
+
+
 class GraphMemory:
     """High-level API for storing documents and chunks in Neo4j."""
 
 
-    def __init__(self, connector: Neo4jConnector, cfg: Config):
+    def __init__(self, connector: Neo4jConnector, cfg: Config, client: Optional[OpenAI] = None):
         self.conn = connector
         self.cfg = cfg
-        self.client = OpenAI(api_key=cfg.openai_api_key)
+        # the process's shared OpenAI client when given (see AppContainer), else one of our own
+        self.client = client or track_openai_client(OpenAI(api_key=cfg.openai_api_key))
         self.embedding_model = cfg.embedding_model_name
 
+        # shared retrieval state used while a batch of tool calls is running
+        self._shared_lock = threading.Lock()
+        self._shared_scopes = 0
+        self._shared_query_embeddings: Dict[str, List[float]] = {}
+
+        # every chunk embedding as one normalized float32 matrix, so a query is a single dot product
+        # instead of a full Neo4j fetch; writes in this process drop it, and after matrix_ttl a chunk
+        # count tells whether another process changed the graph. Graphs whose matrix would exceed
+        # matrix_max_bytes are searched in Neo4j as before.
+        self._matrix_lock = threading.Lock()
+        self._matrix: Optional[Dict[str, Any]] = None
+        self.matrix_ttl = float(os.getenv("GRAPH_MATRIX_TTL", "300"))
+        self.matrix_max_bytes = int(float(os.getenv("GRAPH_MATRIX_MAX_MB", "128")) * 1024 * 1024)
+        self.matrix_page_size = int(os.getenv("GRAPH_MATRIX_PAGE_SIZE", "2000"))
 
     # create minimal constraints / indexes
         self._init_schema()
@@ -44,26 +104,56 @@ class GraphMemory:
 
     
     def _chunk_text(self, text: str) -> List[str]:
-        max_len = self.cfg.chunk_size
-        overlap = self.cfg.chunk_overlap
-        tokens = text.split()
-        chunks = []
-        i = 0
-        while i < len(tokens):
-            chunk_tokens = tokens[i : i + max_len]
-            chunks.append(" ".join(chunk_tokens))
-            i += max_len - overlap
-        return chunks
+        chunker = self.chunker()
+        return chunker.feed(text) + chunker.finish()
+
+    def chunker(self) -> TextChunker:
+        """Incremental chunker with this graph's chunk size and overlap"""
+        return TextChunker(self.cfg.chunk_size, self.cfg.chunk_overlap)
+
+    def chunk_count(self, words: int) -> int:
+        """How many chunks a text of this many words is split into"""
+        step = self.cfg.chunk_size - self.cfg.chunk_overlap
+        return -(-words // step)
     
     def _embed_texts(self, texts: List[str]) -> List[List[float]]:
-        response = self.client.embeddings.create(
-            model=self.embedding_model,   # "text-embedding-3-large" or "text-embedding-3-small"
-            input=texts
-        )
+        with stage_timer("embed"):
+            response = self.client.embeddings.create(
+                model=self.embedding_model,   # "text-embedding-3-large" or "text-embedding-3-small"
+                input=texts
+            )
 
         # Extract embeddings
         return [item.embedding for item in response.data]
     
+    def _embed_query(self, query: str) -> List[float]:
+        with self._shared_lock:
+            cached = self._shared_query_embeddings.get(query)
+        if cached is not None:
+            return cached
+        return self._embed_texts([query])[0]
+
+    @contextmanager
+    def shared_retrieval(self, queries: List[str]):
+        """
+        Embed all queries in one request and make sure the embedding matrix is loaded, so every
+        retrieve() issued inside the block skips its own embedding call and searches the matrix.
+        """
+        queries = [q for q in dict.fromkeys(queries) if q]
+        embeddings = self._embed_texts(queries) if queries else []
+        self.load_embedding_matrix()
+
+        with self._shared_lock:
+            self._shared_scopes += 1
+            self._shared_query_embeddings.update(zip(queries, embeddings))
+        try:
+            yield
+        finally:
+            with self._shared_lock:
+                self._shared_scopes -= 1
+                if self._shared_scopes == 0:
+                    self._shared_query_embeddings = {}
+
     def add_document(self, doc_id: str, title: str, text: str, metadata: dict = None) -> None:
         """Add a document + chunks + embeddings to the graph.
 
@@ -73,10 +163,36 @@ class GraphMemory:
         (c:Chunk {chunk_id, text, embedding, position})
         (d)-[:HAS_CHUNK]->(c)
         """
-        metadata = metadata or {}
         chunks = self._chunk_text(text)
-        embeddings = self._embed_texts(chunks)
-
+        embeddings = self.embed_in_batches(chunks)
+        self.add_document_chunks(doc_id, title, chunks, embeddings, metadata)
+
+    def embed_in_batches(self, texts: List[str], batch_size: int = 256) -> List[List[float]]:
+        """Embed texts with as few embedding requests as the batch size allows"""
+        embeddings = []
+        for i in range(0, len(texts), batch_size):
+            embeddings.extend(self._embed_texts(texts[i : i + batch_size]))
+        return embeddings
+
+    def add_document_chunks(self, doc_id: str, title: str, chunks: List[str], embeddings: List[List[float]],
+                            metadata: dict = None, write_batch_size: int = 500, replace: bool = False,
+                            pages: List[Tuple[int, int]] = None, start_position: int = 0,
+                            invalidate: bool = True) -> int:
+        """
+        Write one Document and all of its already chunked and embedded text in bulk
+        (one UNWIND query per write batch instead of one query per chunk).
+        With replace=True the document's previous chunks are removed first.
+        pages optionally gives each chunk's (page_start, page_end) in the source PDF.
+        A document can be written in several calls: start_position numbers the first chunk of this one.
+        With invalidate=False the embedding matrix is kept; the caller invalidates it once when done
+        (per document or sync) instead of once per write.
+        """
+        metadata = metadata or {}
+        if replace:
+            self.conn.run(
+                "MATCH (:Document {doc_id: $doc_id})-[:HAS_CHUNK]->(c:Chunk) DETACH DELETE c",
+                {"doc_id": doc_id},
+            )
 
         # create document node
         self.conn.run(
@@ -88,42 +204,157 @@ class GraphMemory:
                 },
         )
 
-
         # create chunk nodes and relationships
-        for idx, (chunk_text, emb) in enumerate(zip(chunks, embeddings)):
-            chunk_id = f"{doc_id}::chunk::{idx}"
+        pages = pages or [(None, None)] * len(chunks)
+        rows = [
+            {"chunk_id": f"{doc_id}::chunk::{idx}", "text": chunk_text, "embedding": emb, "position": idx,
+             "page_start": page_span[0], "page_end": page_span[1]}
+            for idx, (chunk_text, emb, page_span) in enumerate(zip(chunks, embeddings, pages), start_position)
+        ]
+        for i in range(0, len(rows), write_batch_size):
             self.conn.run(
-                "MERGE (c:Chunk {chunk_id: $chunk_id})\n"
-                "SET c.text = $text, c.embedding = $embedding, c.position = $position\n"
-                "WITH c\n"
                 "MATCH (d:Document {doc_id: $doc_id})\n"
-                "MERGE (d)-[:HAS_CHUNK {pos: $position}]->(c)",
-                {
-                    "chunk_id": chunk_id,
-                    "text": chunk_text,
-                    "embedding": emb,
-                    "position": idx,
-                    "doc_id": doc_id,
-                },
+                "UNWIND $rows AS row\n"
+                "MERGE (c:Chunk {chunk_id: row.chunk_id})\n"
+                "SET c.text = row.text, c.embedding = row.embedding, c.position = row.position,\n"
+                "    c.page_start = row.page_start, c.page_end = row.page_end\n"
+                "MERGE (d)-[:HAS_CHUNK {pos: row.position}]->(c)",
+                {"doc_id": doc_id, "rows": rows[i : i + write_batch_size]},
             )
+        if invalidate:
+            self.invalidate_embedding_matrix()
+        return len(rows)
 
 
-    def _fetch_all_chunk_embeddings(self, limit: Optional[int] = None) -> List[Tuple[str, List[float], str, dict, str]]:
+    def delete_document(self, doc_id: str, invalidate: bool = True) -> None:
+        """Remove a document and its chunks from the graph (invalidate as in add_document_chunks)."""
+        self.conn.run(
+            "MATCH (d:Document {doc_id: $doc_id})\n"
+            "OPTIONAL MATCH (d)-[:HAS_CHUNK]->(c:Chunk)\n"
+            "DETACH DELETE c, d",
+            {"doc_id": doc_id},
+        )
+        if invalidate:
+            self.invalidate_embedding_matrix()
+
+    def _chunk_count(self) -> int:
+        with stage_timer("neo4j_count"):
+            records = self.conn.run("MATCH (c:Chunk) RETURN count(c) AS n")
+        return records[0]["n"] if records else 0
+
+    @staticmethod
+    def _matrix_info(cached: Dict[str, Any], loaded: bool) -> Dict[str, Any]:
+        if cached["matrix"] is None:
+            return {"chunks": cached["chunk_count"], "dimensions": 0, "bytes": 0, "loaded": False, "over_limit": True}
+        return {"chunks": len(cached["rows"]), "dimensions": cached["matrix"].shape[1],
+                "bytes": cached["matrix"].nbytes, "loaded": loaded}
+
+    def load_embedding_matrix(self, force: bool = False) -> Dict[str, Any]:
+        """
+        Load (or reuse) the in-memory embedding matrix used by retrieve().
+        Returns {"chunks", "dimensions", "bytes", "loaded"} where loaded tells whether it was (re)built;
+        "over_limit" is set when the matrix would exceed GRAPH_MATRIX_MAX_MB and was not built.
+        """
+        cached = self._matrix
+        if not force and cached is not None and time.time() - cached["loaded_at"] < self.matrix_ttl:
+            return self._matrix_info(cached, loaded=False)
+
+        # past the TTL: one count, outside the lock so retrievals never queue behind Neo4j
+        count = self._chunk_count()
+        with self._matrix_lock:
+            cached = self._matrix
+            if not force and cached is not None:
+                if time.time() - cached["loaded_at"] < self.matrix_ttl:
+                    return self._matrix_info(cached, loaded=False)  # refreshed by another thread meanwhile
+                if cached["chunk_count"] == count:
+                    cached["loaded_at"] = time.time()
+                    return self._matrix_info(cached, loaded=False)
+
+            # fetched page by page, each page turned into float32 at once, so the Python lists of
+            # only one page are alive next to the matrix
+            rows, blocks = [], []
+            while True:
+                page = self._fetch_all_chunk_embeddings(limit=self.matrix_page_size,
+                                                        after=rows[-1][0] if rows else "")
+                if not page:
+                    break
+                block = np.array([emb for _, emb, _, _, _ in page], dtype=np.float32).reshape(len(page), -1)
+                if max(count, len(rows) + len(page)) * block.shape[1] * 4 > self.matrix_max_bytes:
+                    print(f"⚠ Embedding matrix for {count} chunks would exceed {self.matrix_max_bytes / (1024 * 1024):g} MB, "
+                          f"searching in Neo4j instead")
+                    rows, blocks = None, None
+                    break
+                rows.extend((chunk_id, text, meta, doc_title) for chunk_id, _, text, meta, doc_title in page)
+                blocks.append(block)
+                if len(page) < self.matrix_page_size:
+                    break
+            if rows is None:
+                self._matrix = {"rows": None, "matrix": None, "chunk_count": count, "loaded_at": time.time()}
+                return self._matrix_info(self._matrix, loaded=False)
+
+            matrix = np.vstack(blocks) if blocks else np.zeros((0, 1), dtype=np.float32)
+            del blocks
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            # zero vectors stay zero and score 0, as in cosine_similarity
+            np.divide(matrix, norms, out=matrix, where=norms > 0)
+            self._matrix = {"rows": rows, "matrix": matrix, "chunk_count": count, "loaded_at": time.time()}
+            return self._matrix_info(self._matrix, loaded=True)
+
+    def invalidate_embedding_matrix(self):
+        with self._matrix_lock:
+            self._matrix = None
+
+    def _retrieve_from_matrix(self, q_emb: np.ndarray, top_k: int) -> Optional[List[Dict[str, Any]]]:
+        self.load_embedding_matrix()
+        cached = self._matrix
+        if cached is None or cached["matrix"] is None:
+            return None
+        if not cached["rows"]:
+            return []
+        with stage_timer("vector_search"):
+            q_norm = np.linalg.norm(q_emb)
+            scores = cached["matrix"] @ (q_emb / q_norm if q_norm else q_emb).astype(np.float32)
+            top = np.argpartition(-scores, top_k)[:top_k] if top_k < len(scores) else np.arange(len(scores))
+            top = top[np.argsort(-scores[top])]
+        hits = []
+        for idx in top:
+            chunk_id, text, meta, doc_title = cached["rows"][idx]
+            hits.append({
+                "chunk_id": chunk_id,
+                "score": float(scores[idx]),
+                "text": text,
+                "chapter": meta.get("chapter") if meta else None,
+                "course": meta.get("course") if meta else None,
+                "doc_title": doc_title
+            })
+        return hits
+
+    def _fetch_all_chunk_embeddings(self, limit: Optional[int] = None, after: Optional[str] = None) -> List[Tuple[str, List[float], str, dict, str]]:
         """
         Return list of tuples (chunk_id, embedding, text, metadata, doc_title)
+        With after, only chunks whose chunk_id sorts after it are returned, in chunk_id order, so the
+        graph can be read page by page from the chunk_id index (pass the last chunk_id of a page).
         """
         q = """
             MATCH (d:Document)-[:HAS_CHUNK]->(c:Chunk)
+            WHERE c.embedding IS NOT NULL
+        """
+        if after is not None:
+            q += " AND c.chunk_id > $after"
+        q += """
             RETURN c.chunk_id AS chunk_id,
                 c.embedding AS embedding,
                 c.text AS text,
                 d.metadata_json AS metadata_json,
                 d.title AS doc_title
         """
+        if after is not None:
+            q += " ORDER BY chunk_id"
         if limit:
             q += f" LIMIT {int(limit)}"
 
-        records = self.conn.run(q)
+        with stage_timer("neo4j_fetch"):
+            records = self.conn.run(q, {"after": after} if after is not None else None)
         out = []
         for rec in records:
             embedding = rec.get("embedding") or rec.get("c.embedding")
@@ -138,23 +369,28 @@ class GraphMemory:
 
     
     def retrieve(self, query: str, top_k: int = 2, candidate_limit: Optional[int] = None) -> List[Dict[str, Any]]:
-        q_emb = np.array(self.embedder.encode([query])[0])
+        q_emb = np.array(self._embed_query(query))
+        if candidate_limit is None:
+            hits = self._retrieve_from_matrix(q_emb, top_k)
+            if hits is not None:
+                return hits
         rows = self._fetch_all_chunk_embeddings(limit=candidate_limit)
 
         sims = []
-        for chunk_id, emb_list, text, meta, doc_title in rows:
-            emb = np.array(emb_list)
-            score = float(self.cosine_similarity(q_emb, emb))
-            sims.append({
-                "chunk_id": chunk_id,
-                "score": score,
-                "text": text,
-                "chapter": meta.get("chapter") if meta else None,
-                "course": meta.get("course") if meta else None,
-                "doc_title": doc_title
-            })
-
-        sims.sort(key=lambda x: x["score"], reverse=True)
+        with stage_timer("vector_search"):
+            for chunk_id, emb_list, text, meta, doc_title in rows:
+                emb = np.array(emb_list)
+                score = float(self.cosine_similarity(q_emb, emb))
+                sims.append({
+                    "chunk_id": chunk_id,
+                    "score": score,
+                    "text": text,
+                    "chapter": meta.get("chapter") if meta else None,
+                    "course": meta.get("course") if meta else None,
+                    "doc_title": doc_title
+                })
+
+            sims.sort(key=lambda x: x["score"], reverse=True)
         return sims[:top_k]
 
     
@@ -203,13 +439,13 @@ class GraphMemory:
         # Step 3: Use OpenAI (new API format)
         if use_openai and (self.cfg.openai_api_key or os.environ.get("OPENAI_API_KEY")):
             try:
-                from openai import OpenAI
-                client = OpenAI(api_key=self.cfg.openai_api_key or os.environ.get("OPENAI_API_KEY"))
-
-                response = client.chat.completions.create(
-                    model=self.cfg.openai_model or "gpt-4o-mini",
-                    messages=[{"role": "user", "content": prompt}]
-                )
+                # a short JSON object with one answer; unparsable output is wrapped below, so a
+                # capped answer for an over-budget course still comes through
+                with stage_timer("llm"), free_text_output():
+                    response = self.client.chat.completions.create(
+                        model=self.cfg.openai_model or "gpt-4o-mini",
+                        messages=[{"role": "user", "content": prompt}]
+                    )
 
                 raw = response.choices[0].message.content.strip()
 
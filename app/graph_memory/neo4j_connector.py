@@ -2,6 +2,7 @@ import numpy as np
 from neo4j import GraphDatabase, basic_auth
 from config import Config
 from typing import List
+from tracing import span
 
 
 class Neo4jConnector:
@@ -19,6 +20,9 @@ class Neo4jConnector:
 
     def run(self, query: str, params: dict = None) -> List[dict]:
         params = params or {}
-        with self._driver.session() as session:
-            result = session.run(query, params)
-            return [record.data() for record in result]
\ No newline at end of file
+        with span("neo4j.query", query=" ".join(query.split())[:120]) as active:
+            with self._driver.session() as session:
+                result = session.run(query, params)
+                records = [record.data() for record in result]
+            active.set_attribute("records", len(records))
+            return records
\ No newline at end of file
@@ -0,0 +1,264 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Any, List, Optional
+
+
+class JobCancelled(BaseException):
+    """Raised inside a job when it has been cancelled.
+
+    Derives from BaseException so the per-file ``except Exception`` handlers
+    inside long-running jobs do not swallow it.
+    """
+
+
+class JobContext:
+    """Handed to a running job so it can report progress and observe cancellation"""
+
+    def __init__(self, queue: "JobQueue", job_id: str):
+        self.queue = queue
+        self.job_id = job_id
+
+    @property
+    def cancelled(self) -> bool:
+        return self.queue.is_cancelled(self.job_id)
+
+    def report(self, stage: str, **data):
+        """Publish a progress event; raises JobCancelled if the job was cancelled"""
+        if self.cancelled:
+            raise JobCancelled()
+        self.queue._add_event(self.job_id, {"type": "progress", "stage": stage, **data})
+
+
+# tells this process apart from an earlier one that had the same host and PID (e.g. a restarted container)
+_PROCESS_TOKEN = uuid.uuid4().hex[:8]
+
+
+def _owner_alive(owner: Optional[str]) -> Optional[bool]:
+    """Whether the process named by a job owner ("host:pid:token") still runs; None if it is on another host"""
+    host, _, pid = (owner or "").rsplit(":", 1)[0].rpartition(":")
+    if host != socket.gethostname() or not pid.isdigit():
+        return None
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobQueue:
+    """
+    Worker pool for long-running tools with a persistent SQLite job table.
+    Several worker processes can share the table: each job records its owner process, which renews
+    a lease on its active jobs every lease_seconds / 4. Active jobs are only marked interrupted once
+    their owner has exited or stopped renewing the lease, never while a live worker runs them.
+    """
+
+    ACTIVE_STATES = ("queued", "running")
+
+    def __init__(self, db_path: str = None, max_workers: int = None, lease_seconds: float = None):
+        self.db_path = db_path or os.getenv("JOB_DB_PATH", "jobs.db")
+        self.max_workers = max_workers or int(os.getenv("JOB_WORKERS", "2"))
+        self.lease_seconds = lease_seconds or float(os.getenv("JOB_LEASE_SECONDS", "120"))
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{_PROCESS_TOKEN}"
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="job")
+        self._lock = threading.Lock()
+        self._events: Dict[str, List[Dict[str, Any]]] = {}
+        self._cancelled = set()
+        self._futures = {}
+
+        self._init_db()
+        self.recover_stale()
+        self._heartbeat = threading.Thread(target=self._renew_leases, name="job-lease", daemon=True)
+        self._heartbeat.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _init_db(self):
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    dedupe_key TEXT,
+                    status TEXT NOT NULL,
+                    progress_json TEXT,
+                    result_json TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "owner" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+                conn.execute("ALTER TABLE jobs ADD COLUMN lease_expires_at REAL")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_dedupe ON jobs (dedupe_key, status)")
+
+    def recover_stale(self) -> int:
+        """
+        Mark active jobs interrupted whose owner process has exited or whose lease ran out (jobs from
+        before owners were recorded have neither); returns how many were marked
+        """
+        now = time.time()
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT job_id, owner, lease_expires_at FROM jobs WHERE status IN ('queued', 'running')"
+            ).fetchall()
+            stale = [
+                row["job_id"] for row in rows
+                if row["owner"] != self.owner and (
+                    _owner_alive(row["owner"]) is False or (row["lease_expires_at"] or 0) < now)
+            ]
+            for job_id in stale:
+                # the status check keeps a job that finished meanwhile from being overwritten
+                conn.execute(
+                    "UPDATE jobs SET status = 'interrupted', updated_at = ? "
+                    "WHERE job_id = ? AND status IN ('queued', 'running')",
+                    (now, job_id)
+                )
+        if stale:
+            print(f"⚠ Marked {len(stale)} jobs of stopped workers as interrupted")
+        return len(stale)
+
+    def _renew_leases(self):
+        while True:
+            time.sleep(self.lease_seconds / 4)
+            try:
+                with self._connect() as conn:
+                    conn.execute(
+                        "UPDATE jobs SET lease_expires_at = ? WHERE owner = ? AND status IN ('queued', 'running')",
+                        (time.time() + self.lease_seconds, self.owner)
+                    )
+            except Exception as e:
+                print(f"⚠ Renewing job leases failed: {e}")
+
+    def _update(self, job_id: str, **fields):
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{key} = ?" for key in fields)
+        with self._lock, self._connect() as conn:
+            conn.execute(f"UPDATE jobs SET {assignments} WHERE job_id = ?", (*fields.values(), job_id))
+
+    def _add_event(self, job_id: str, event: Dict[str, Any]):
+        event = {"timestamp": time.time(), **event}
+        with self._lock:
+            self._events.setdefault(job_id, []).append(event)
+        if event["type"] == "progress":
+            self._update(job_id, progress_json=json.dumps(event))
+
+    def submit(self, kind: str, fn: Callable[[JobContext], Any], dedupe_key: str = None) -> Dict[str, Any]:
+        """
+        Queue fn(ctx) on the worker pool. If an active job shares the dedupe_key,
+        its ID is returned instead of starting a second one.
+        """
+        if dedupe_key:
+            # an active job of a worker that died would otherwise absorb every later request
+            self.recover_stale()
+        with self._lock:
+            if dedupe_key:
+                with self._connect() as conn:
+                    row = conn.execute(
+                        "SELECT job_id FROM jobs WHERE dedupe_key = ? AND status IN ('queued', 'running') "
+                        "ORDER BY created_at DESC LIMIT 1",
+                        (dedupe_key,)
+                    ).fetchone()
+                if row:
+                    return {"job_id": row["job_id"], "deduplicated": True}
+
+            job_id = uuid.uuid4().hex
+            now = time.time()
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT INTO jobs (job_id, kind, dedupe_key, status, created_at, updated_at, owner, lease_expires_at) "
+                    "VALUES (?, ?, ?, 'queued', ?, ?, ?, ?)",
+                    (job_id, kind, dedupe_key, now, now, self.owner, now + self.lease_seconds)
+                )
+            self._events[job_id] = [{"timestamp": now, "type": "status", "status": "queued"}]
+            self._futures[job_id] = self._executor.submit(self._run, job_id, fn)
+
+        return {"job_id": job_id, "deduplicated": False}
+
+    def _run(self, job_id: str, fn: Callable[[JobContext], Any]):
+        # Terminal events are recorded before the status row so SSE readers never miss them
+        if self.is_cancelled(job_id):
+            self._update(job_id, status="cancelled")
+            self._add_event(job_id, {"type": "status", "status": "cancelled"})
+            return
+        self._update(job_id, status="running")
+        self._add_event(job_id, {"type": "status", "status": "running"})
+
+        try:
+            result = fn(JobContext(self, job_id))
+            self._add_event(job_id, {"type": "status", "status": "completed", "result": result})
+            self._update(job_id, status="completed", result_json=json.dumps(result, default=str))
+        except JobCancelled:
+            self._add_event(job_id, {"type": "status", "status": "cancelled"})
+            self._update(job_id, status="cancelled")
+        except Exception as e:
+            print(f"❌ Job {job_id} failed: {str(e)}")
+            self._add_event(job_id, {"type": "status", "status": "failed", "error": str(e)})
+            self._update(job_id, status="failed", error=str(e))
+        finally:
+            with self._lock:
+                self._futures.pop(job_id, None)
+                self._cancelled.discard(job_id)
+                self._prune_events()
+
+    def _prune_events(self, keep: int = 200):
+        # Drop event logs of the oldest finished jobs; the job table keeps their final state
+        finished = [job_id for job_id in self._events if job_id not in self._futures]
+        for job_id in finished[:max(0, len(self._events) - keep)]:
+            del self._events[job_id]
+
+    def cancel(self, job_id: str) -> bool:
+        """Request cancellation; queued jobs stop immediately, running jobs at their next progress report"""
+        job = self.get(job_id)
+        if job is None or job["status"] not in self.ACTIVE_STATES:
+            return False
+
+        with self._lock:
+            self._cancelled.add(job_id)
+            future = self._futures.get(job_id)
+
+        if future is not None and future.cancel():
+            with self._lock:
+                self._futures.pop(job_id, None)
+                self._cancelled.discard(job_id)
+            self._update(job_id, status="cancelled")
+            self._add_event(job_id, {"type": "status", "status": "cancelled"})
+        return True
+
+    def is_cancelled(self, job_id: str) -> bool:
+        with self._lock:
+            return job_id in self._cancelled
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return self._row_to_dict(row) if row else None
+
+    def list(self, limit: int = 50) -> List[Dict[str, Any]]:
+        with self._connect() as conn:
+            rows = conn.execute("SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,)).fetchall()
+        return [self._row_to_dict(row) for row in rows]
+
+    def events_since(self, job_id: str, offset: int = 0) -> List[Dict[str, Any]]:
+        """Return progress events after offset (used by SSE streaming)"""
+        with self._lock:
+            return list(self._events.get(job_id, [])[offset:])
+
+    def _row_to_dict(self, row: sqlite3.Row) -> Dict[str, Any]:
+        job = dict(row)
+        job["progress"] = json.loads(job.pop("progress_json") or "null")
+        job["result"] = json.loads(job.pop("result_json") or "null")
+        return job
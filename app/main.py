@@ -2,18 +2,30 @@
 from fastapi import FastAPI, HTTPException, UploadFile, Form, File, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 from fastapi.responses import FileResponse
 import asyncio
 from pydantic import BaseModel
-from typing import AsyncGenerator, Dict, Optional, Union
-from ai_agent import AcademicAIAgent 
+from typing import AsyncGenerator, Dict, List, Optional, Union
+from app_container import get_container
 from mcp_server import router as mcp_router
 import json
-from models import UserRequest,ConfirmationRequest
-import base64
-from utils import extract_pdf_text
+from models import UserRequest,ConfirmationRequest,NotifyRequest
+from utils import iter_pdf_pages, pdf_page_count, pdf_page_ranges
+from boilerplate import BoilerplateStripper, boilerplate_enabled
+from job_queue import JobQueue
+from async_moodle import AsyncMoodleIntegration
+from sync_manifest import SyncScheduler
+from bulk_messaging import BulkNotifier
+from extraction_cache import get_extraction_cache
+from uploads import SpooledUpload, UploadTooLarge, spool_base64, spool_upload_file
+from warmup import create_warmup, readiness_status
+from metrics import CONTENT_TYPE, REGISTRY, metric_labels, stage_timer
+from usage import get_usage_tracker
+from tracing import analyze_trace, get_exporter, load_trace, set_service_name, span
 import os
+import time
+import uuid
 
 app = FastAPI(title="Smart Academic Assistant")
 
@@ -27,7 +39,26 @@ app.add_middleware(
 
 app.mount("/frontend", StaticFiles(directory="../frontend"), name="frontend")
 
-ai_agent = AcademicAIAgent()
+# the container's agent, the same instance the imported mcp_server module already holds
+ai_agent = get_container().agent
+job_queue = JobQueue()
+async_moodle = AsyncMoodleIntegration()
+
+
+@app.on_event("shutdown")
+async def close_async_moodle():
+    await async_moodle.close()
+
+
+@app.on_event("startup")
+def name_trace_service():
+    set_service_name("main")
+
+
+@app.on_event("shutdown")
+def flush_usage():
+    get_usage_tracker().stop()
+    get_exporter().stop()
 
 @app.get("/")
 async def root():
@@ -49,7 +80,8 @@ async def chat(request: UserRequest):
             return StreamingResponse(
                 stream_agent_response(
                     user_prompt=request.message,
-                    context={"course_id": request.course_id, "forum_id": request.forum_id}
+                    context={"course_id": request.course_id, "forum_id": request.forum_id,
+                             "session_id": request.session_id}
                 ),
                 media_type="text/event-stream"
             )
@@ -62,19 +94,32 @@ async def chat(request: UserRequest):
         )
 
 @app.post("/clear-memory")
-async def clear_memory():
-    """Clear conversation history"""
-    ai_agent.clear_memory()
+async def clear_memory(session_id: Optional[str] = None):
+    """Clear conversation history of one chat session"""
+    ai_agent.clear_memory(session_id)
     return {"status": "success", "message": "Conversation history cleared"}
 
 @app.get("/memory")
-async def get_memory():
-    """Get current conversation history"""
+async def get_memory(session_id: Optional[str] = None):
+    """Get current conversation history of one chat session"""
+    history = ai_agent.get_memory(session_id)
+    tokens = ai_agent.memory.get_context_stats(session_id)
+    tokens.pop("context")
     return {
-        "history": ai_agent.get_memory(),
-        "size": len(ai_agent.get_memory())
+        "history": history,
+        "size": len(history),
+        "tokens": tokens,
+        "store": ai_agent.memory.stats()
     }
 
+@app.get("/memory/refs/{ref_id}")
+async def get_memory_reference(ref_id: str):
+    """Full text of a long message that conversation history keeps only as ref:<id>"""
+    content = ai_agent.get_memory_reference(ref_id)
+    if content is None:
+        raise HTTPException(status_code=404, detail="Reference not found or expired")
+    return {"ref_id": ref_id, "content": content}
+
 @app.get("/tools")
 async def list_tools():
     """Get list of available tools"""
@@ -101,6 +146,48 @@ async def list_courses(course_id: int):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/courses/{course_id}/grades/stream")
+async def stream_course_grades(course_id: int):
+    """Stream every enrolled user's grades as server-sent events, in completion order"""
+    async def events() -> AsyncGenerator[str, None]:
+        try:
+            async for item in async_moodle.iter_grades_for_enrolled_users(course_id):
+                yield "data: " + json.dumps({"type": "grades", "content": item}, default=str) + "\n\n"
+            yield "data: " + json.dumps({"type": "complete", "content": ""}) + "\n\n"
+        except Exception as e:
+            yield "data: " + json.dumps({"type": "error", "content": f"❌ Error: {str(e)}"}) + "\n\n"
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+@app.get("/courses/{course_id}/resource-files/stream")
+async def stream_resource_files(course_id: int):
+    """Stream file metadata for every resource module as server-sent events, in completion order"""
+    async def events() -> AsyncGenerator[str, None]:
+        try:
+            async for item in async_moodle.iter_resource_file_metadata(course_id):
+                yield "data: " + json.dumps({"type": "files", "content": item}, default=str) + "\n\n"
+            yield "data: " + json.dumps({"type": "complete", "content": ""}) + "\n\n"
+        except Exception as e:
+            yield "data: " + json.dumps({"type": "error", "content": f"❌ Error: {str(e)}"}) + "\n\n"
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+@app.post("/courses/{course_id}/notify")
+async def notify_course(course_id: int, request: NotifyRequest):
+    """Send a templated message to enrolled students in batched calls; returns per-recipient delivery results"""
+    try:
+        notifier = BulkNotifier(ai_agent.moodle, batch_size=request.batch_size)
+        return await asyncio.to_thread(notifier.notify_course, course_id, request.template, request.user_ids)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/moodle/metrics")
+async def moodle_metrics():
+    """Per-wsfunction Moodle call latency, error and retry counts, plus read-cache and extraction-cache statistics"""
+    return {
+        "metrics": ai_agent.moodle.get_api_metrics(),
+        "cache": ai_agent.moodle.cache.stats(),
+        "extraction_cache": get_extraction_cache().stats()
+    }
+
 # Keep direct endpoints for specific use cases
 @app.post("/direct-action")
 async def direct_action(action: str, params: Dict):
@@ -121,16 +208,144 @@ async def get_materials(course_id: int):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
+def submit_course_sync(course_id: int, full: bool = False) -> Dict:
+    """Queue a course sync job; requests for a course that is already syncing coalesce"""
+    def sync(ctx):
+        # the pipeline's threads copy this context, so their embedding calls carry the course label
+        with metric_labels(tool="save_as_graph", course=course_id):
+            return ai_agent.moodle.save_as_graph(
+                course_id, chunk_overlap=200, chunk_size=1000, progress=ctx.report, full=full
+            )
+
+    return job_queue.submit(kind="save_as_graph", fn=sync, dedupe_key=f"save_as_graph:{course_id}")
+
+
+sync_scheduler = SyncScheduler(
+    moodle=ai_agent.moodle,
+    manifest=ai_agent.moodle.sync_manifest,
+    submit_sync=submit_course_sync
+)
+
+
+@app.on_event("startup")
+async def start_sync_scheduler():
+    sync_scheduler.start()
+
+
+warmup = create_warmup(get_container())
+
+
+@app.on_event("startup")
+async def start_warmup():
+    warmup.start()
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus scrape target for the chat API: stage latencies and errors recorded in this process"""
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+
+@app.get("/usage")
+async def usage(group_by: str = "course", since_hours: float = None, course_id: int = None,
+                session_id: str = None, tool: str = None, request_id: str = None, model: str = None):
+    """Model token usage and cost, grouped by a comma-separated list of request_id, session_id, tool, course, model, kind"""
+    since = time.time() - since_hours * 3600 if since_hours else None
+    return await asyncio.to_thread(
+        get_usage_tracker().query,
+        [field.strip() for field in group_by.split(",") if field.strip()], since,
+        course=course_id, session_id=session_id, tool=tool, request_id=request_id, model=model
+    )
+
+
+@app.get("/usage/budget/{course_id}")
+async def usage_budget(course_id: int):
+    """A course's model spend against its budget; over budget, chat calls use the cheaper fallback model"""
+    return await asyncio.to_thread(get_usage_tracker().budget_status, course_id)
+
+
+@app.get("/traces/{trace_id}")
+async def trace(trace_id: str, spans: bool = False):
+    """Critical path and fan-out of one request's trace (file exporter only); trace_id is the chat request_id"""
+    records = await asyncio.to_thread(load_trace, trace_id)
+    if not records:
+        raise HTTPException(status_code=404, detail="Trace not found (is TRACE_EXPORTER=file?)")
+    result = analyze_trace(records)
+    if spans:
+        result["span_list"] = records
+    return result
+
+
+@app.get("/ready")
+async def readiness():
+    """Readiness probe for the chat API (WARMUP_STEPS)"""
+    status_code, status = readiness_status(warmup, get_container())
+    return JSONResponse(status_code=status_code, content=status)
+
+
 @app.post("/save-as-graph/{course_id}")
-async def upload_document(course_id: int ):
-    """Upload a document to be processed and added to memory"""
+async def upload_document(course_id: int, full: bool = False):
+    """Queue a background job that syncs new or changed course materials into the graph database"""
     try:
-        print("Uploading course materials to graph database...", course_id)
-        # ai_agent.moodle.debug_course_structure(9)
-        result = ai_agent.moodle.save_as_graph(course_id, chunk_overlap=200, chunk_size=1000)
-        return {"status": "success", "message": "Documents Uploaded Successfuly", "result":result}
+        print("Queueing course materials upload to graph database...", course_id)
+        submitted = submit_course_sync(course_id, full=full)
+        return {
+            "status": "accepted",
+            "message": "Course sync already in progress" if submitted["deduplicated"] else "Course sync started",
+            "job_id": submitted["job_id"],
+            "deduplicated": submitted["deduplicated"]
+        }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/jobs")
+async def list_jobs(limit: int = 50):
+    """List recent background jobs"""
+    return {"jobs": job_queue.list(limit=limit)}
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Get the status, latest progress and result of a background job"""
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+    return job
+
+
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    """Cancel a queued or running background job"""
+    if not job_queue.cancel(job_id):
+        raise HTTPException(status_code=409, detail="Job is not queued or running")
+    return {"status": "success", "message": "Cancellation requested", "job_id": job_id}
+
+
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str):
+    """Stream job progress (files, chunks, batches) as server-sent events"""
+    if job_queue.get(job_id) is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+    return StreamingResponse(stream_job_progress(job_id), media_type="text/event-stream")
+
+
+async def stream_job_progress(job_id: str) -> AsyncGenerator[str, None]:
+    offset = 0
+    while True:
+        job = job_queue.get(job_id)
+        events = job_queue.events_since(job_id, offset)
+        offset += len(events)
+        for event in events:
+            yield "data: " + json.dumps(event, default=str) + "\n\n"
+
+        if job is None or job["status"] not in job_queue.ACTIVE_STATES:
+            if offset == 0 and job is not None:
+                # Events were pruned or belong to a previous process; report the final state
+                yield "data: " + json.dumps({"type": "status", "status": job["status"], "result": job["result"]}, default=str) + "\n\n"
+            yield "data: " + json.dumps({"type": "complete", "content": ""}) + "\n\n"
+            return
+        await asyncio.sleep(0.5)
     
 
 @app.post("/confirm-action")
@@ -145,6 +360,7 @@ async def confirm_action(request: ConfirmationRequest):
                     context={
                         "course_id": request.original_request.get("course_id"),
                         "forum_id": request.original_request.get("forum_id"),
+                        "session_id": request.original_request.get("session_id"),
                         "confirmed": True  # Add flag to indicate confirmation
                     }
                 ),
@@ -166,15 +382,21 @@ async def confirm_action(request: ConfirmationRequest):
 async def stream_agent_response(user_prompt: str, context: dict) -> AsyncGenerator[str, None]:
     """Stream agent response with thoughts, actions, and final answer"""
     try:
+        # request_id ties this turn's model usage together (see /usage?request_id=...) and is
+        # also its trace id (see /traces/{request_id})
+        request_id = uuid.uuid4().hex
         # Stream initial processing message
-        yield "data: " + json.dumps({"type": "status", "content": "🤔 Processing your request..."}) + "\n\n"
+        yield "data: " + json.dumps({"type": "status", "content": "🤔 Processing your request...", "request_id": request_id}) + "\n\n"
         await asyncio.sleep(0.1)
         
         # Get the agent's response
-        result = ai_agent.handle_user_request(
-            user_prompt=user_prompt,
-            context=context
-        )
+        with metric_labels(course=context.get("course_id"), request_id=request_id,
+                           session_id=context.get("session_id")), \
+                stage_timer("chat", trace_id=request_id, session_id=context.get("session_id")):
+            result = ai_agent.handle_user_request(
+                user_prompt=user_prompt,
+                context=context
+            )
         
         # Check if this is a Moodle action that requires confirmation
         moodle_actions = ["generate_quiz", "post_announcement"]
@@ -203,10 +425,13 @@ async def stream_agent_response(user_prompt: str, context: dict) -> AsyncGenerat
                 "content": f"✅ I've generated the {result['intent'].replace('_', ' ')}. Would you like to proceed and post it to Moodle?",
                 "intent": result["intent"],
                 "generated_content": generated_content,
+                "artifact_id": result.get("artifact_id"),
                 "original_request": {
                     "message": user_prompt,
                     "course_id": context.get("course_id"),
-                    "forum_id": context.get("forum_id")
+                    "forum_id": context.get("forum_id"),
+                    "session_id": context.get("session_id"),
+                    "artifact_id": result.get("artifact_id")
                 }
             }) + "\n\n"
             return
@@ -229,6 +454,9 @@ async def stream_agent_response(user_prompt: str, context: dict) -> AsyncGenerat
             final_response = f"❌ Sorry, I encountered an error: {result['error']}"
         else:
             final_response = "❓ Unknown response status"
+        if not isinstance(final_response, str):
+            # tools may answer with structured results
+            final_response = json.dumps(final_response, default=str)
         
         # Stream the final response
         words = final_response.split()
@@ -286,6 +514,7 @@ async def execute_confirmed_action(request: ConfirmationRequest):
         context = {
             "course_id": request.original_request.get("course_id"),
             "forum_id": request.original_request.get("forum_id"),
+            "session_id": request.original_request.get("session_id"),
             "confirmed": True,
             "generated_content": request.original_request.get("generated_content")
         }
@@ -295,7 +524,8 @@ async def execute_confirmed_action(request: ConfirmationRequest):
             stream_confirmed_action(
                 user_prompt=request.original_request.get("message", ""),
                 context=context,
-                intent=request.original_request.get("intent")
+                intent=request.original_request.get("intent"),
+                artifact_id=request.original_request.get("artifact_id")
             ),
             media_type="text/event-stream"
         )
@@ -305,17 +535,25 @@ async def execute_confirmed_action(request: ConfirmationRequest):
             content={"error": str(e)}
         )
 
-async def stream_confirmed_action(user_prompt: str, context: dict, intent: str) -> AsyncGenerator[str, None]:
+async def stream_confirmed_action(user_prompt: str, context: dict, intent: str, artifact_id: str = None) -> AsyncGenerator[str, None]:
     """Stream the execution of a confirmed action"""
     try:
         yield "data: " + json.dumps({"type": "status", "content": "🚀 Executing confirmed action..."}) + "\n\n"
         await asyncio.sleep(0.1)
         
-        # Execute the action with confirmation
-        result = ai_agent.handle_user_request(
-            user_prompt=user_prompt,
-            context=context
-        )
+        if artifact_id:
+            # Publish exactly what the user previewed - no intent analysis or regeneration
+            result = await asyncio.to_thread(ai_agent.publish_artifact, artifact_id, intent, context.get("session_id"))
+        else:
+            # Execute the action with confirmation
+            request_id = uuid.uuid4().hex
+            with metric_labels(course=context.get("course_id"), request_id=request_id,
+                               session_id=context.get("session_id")), \
+                    span("confirmed_action", trace_id=request_id, intent=intent):
+                result = ai_agent.handle_user_request(
+                    user_prompt=user_prompt,
+                    context=context
+                )
         
         # Stream the execution process
         if "thought_process" in result:
@@ -325,6 +563,20 @@ async def stream_confirmed_action(user_prompt: str, context: dict, intent: str)
         yield "data: " + json.dumps({"type": "action", "content": f"Posting to Moodle: {intent.replace('_', ' ')}"}) + "\n\n"
         await asyncio.sleep(0.1)
         
+        if result.get("outbox_id"):
+            # Delivery happens in the MCP server's outbox; report progress until the post is live
+            yield "data: " + json.dumps({"type": "status", "content": "📬 Queued for posting to Moodle...", "outbox_id": result["outbox_id"]}) + "\n\n"
+            async for event in stream_publish_progress(result["outbox_id"]):
+                if event.get("status") == "delivered":
+                    yield "data: " + json.dumps({"type": "published", "content": event["result"].get("url"), "outbox_id": result["outbox_id"]}) + "\n\n"
+                    result = {"status": "success", "message": event["result"].get("message", "Posted to Moodle")}
+                elif event.get("status") == "failed":
+                    result = {"status": "error", "error": event.get("error")}
+                elif event.get("status") == "pending" and event.get("attempts"):
+                    yield "data: " + json.dumps({"type": "status", "content": f"⏳ Moodle did not accept the post yet, retrying (attempt {event['attempts'] + 1})..."}) + "\n\n"
+            if result.get("status") == "queued":
+                result = {"status": "success", "message": f"Still posting in the background. Check /publish/{result['outbox_id']} for the link."}
+
         # Stream the result
         if result.get("status") == "success":
             final_response = result["message"]
@@ -345,29 +597,157 @@ async def stream_confirmed_action(user_prompt: str, context: dict, intent: str)
 
 
 
+# How often and for how long a confirmation stream follows its outbox entry
+PUBLISH_POLL_SECONDS = float(os.getenv("PUBLISH_POLL_SECONDS", "1"))
+PUBLISH_STREAM_TIMEOUT = float(os.getenv("PUBLISH_STREAM_TIMEOUT", "120"))
+
+async def stream_publish_progress(outbox_id: str) -> AsyncGenerator[Dict, None]:
+    """Yield the outbox entry whenever its state changes, until it is delivered, failed or the timeout passes"""
+    deadline = asyncio.get_event_loop().time() + PUBLISH_STREAM_TIMEOUT
+    last_state = None
+    while asyncio.get_event_loop().time() < deadline:
+        entry = await asyncio.to_thread(ai_agent.get_publish_status, outbox_id)
+        state = (entry.get("status"), entry.get("attempts"))
+        if state != last_state:
+            last_state = state
+            yield entry
+        if entry.get("status") in ("delivered", "failed"):
+            return
+        await asyncio.sleep(PUBLISH_POLL_SECONDS)
+
+@app.get("/publish/{outbox_id}")
+async def get_publish_status(outbox_id: str):
+    """Delivery state of a confirmed quiz or announcement; result.url is the form or forum link once posted"""
+    try:
+        return await asyncio.to_thread(ai_agent.get_publish_status, outbox_id)
+    except Exception as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+@app.post("/upload")
+async def upload_document_file(file: UploadFile = File(...), course_id: Optional[int] = Form(None)):
+    """
+    Stream a document (multipart) into graph memory. The upload is spooled to disk past
+    UPLOAD_SPOOL_MAX_MB and hashed while it is copied; ingestion progress comes back as SSE.
+    """
+    try:
+        spool = await spool_upload_file(file)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    return StreamingResponse(ingest_document(spool, course_id=course_id), media_type="text/event-stream")
+
+
 async def feed_graph(file: str, filename: str = None, course_id: int = None ):
-    file_text = None
+    """Legacy /chat path: the document arrives base64-encoded inside the JSON body"""
     try:
-        decoded_bytes = base64.b64decode(file)
-        
-        # Heuristic: PDF files start with "%PDF"
-        if decoded_bytes[:4] == b"%PDF":
-            file_text = extract_pdf_text(decoded_bytes)
-        else:
-            # Not PDF → Treat as plain text
-            file_text = decoded_bytes.decode("utf-8", errors="ignore")
+        spool = await asyncio.to_thread(spool_base64, file, filename)
+    except UploadTooLarge as e:
+        yield "data: " + json.dumps({"type": "error", "content": f"❌ {str(e)}"}) + "\n\n"
+        return
     except Exception:
         # fallback → assume text
-        file_text = file
+        spool = SpooledUpload(filename)
+        spool.write(file.encode("utf-8"))
+        spool.finish()
+
+    async for event in ingest_document(spool, course_id=course_id):
+        yield event
+
 
+async def ingest_document(spool: SpooledUpload, course_id: int = None, embed_batch_size: int = 256) -> AsyncGenerator[str, None]:
+    """
+    Extract, chunk, embed and store a spooled document, reporting each stage as SSE.
+    The document is streamed through in batches of embed_batch_size chunks: PDF pages are read
+    from the spooled file range by range (and written to the extraction cache as they pass),
+    chunked as they arrive, and each batch is embedded and written before the next is read, so
+    memory stays bounded by one batch whatever the file size.
+    """
+    filename = spool.filename
+    graph_memory = ai_agent.graph_memory
+    doc_id = str(uuid.uuid4())
+    chunker = graph_memory.chunker()
+    stripper = None
+    progress = {"pages_done": 0, "pages_total": 0, "raw_words": 0}
     try:
-    
-    # 2. Push file into Neo4j Graph Memory
-        ai_agent.graph_memory.addGraphFile(
-            doc_text=file_text,
-            title=filename or "Uploaded Document",
-            metadata={"course_id": course_id,"chapter": filename}
-        )
+        where = "disk" if spool.on_disk else "memory"
+        print(f"📥 Upload {filename}: {spool.size:,} bytes spooled to {where}, sha256 {spool.content_hash[:12]}")
+        yield "data: " + json.dumps({"type": "status", "content": f"📥 Received {filename} ({spool.size / (1024 * 1024):.1f} MB)", "stage": "received", "bytes": spool.size, "sha256": spool.content_hash}) + "\n\n"
+
+        if spool.is_pdf:
+            cache = get_extraction_cache()
+            cached_pages = cache.get(spool.content_hash)
+            cached = cached_pages is not None
+            if cached:
+                progress["pages_total"] = len(cached_pages)
+            else:
+                progress["pages_total"] = await asyncio.to_thread(pdf_page_count, spool.file)
+
+            def extracted_pages():
+                if cached:
+                    yield from cached_pages
+                else:
+                    for start, end in pdf_page_ranges(progress["pages_total"]):
+                        yield from iter_pdf_pages(spool.file, start, end)
+
+            def counted_pages(pages):
+                for page_no, text in pages:
+                    progress["pages_done"] += 1
+                    progress["raw_words"] += len(text.split())
+                    yield page_no, text
+
+            pages = counted_pages(extracted_pages() if cached else cache.caching(spool.content_hash, extracted_pages()))
+            if boilerplate_enabled():
+                # Drop headers/footers repeated on most pages before the graph chunks and embeds the text
+                stripper = BoilerplateStripper()
+                pages = stripper.filter(pages)
+            # pages are joined with newlines, as when the document was chunked whole
+            pieces = (text + "\n" for _, text in pages)
+        else:
+            # Not PDF → Treat as plain text
+            cached = False
+            pieces = spool.iter_text(block_size=64 * 1024)
+
+        def next_batch() -> List[str]:
+            batch = []
+            for piece in pieces:
+                batch.extend(chunker.feed(piece))
+                if len(batch) >= embed_batch_size:
+                    return batch
+            return batch + chunker.finish()
+
+        def store_batch(batch: List[str], start_position: int) -> int:
+            # runs in a worker thread per batch, so the course label is set here rather than around the stream
+            with metric_labels(tool="upload", course=course_id):
+                embeddings = graph_memory.embed_in_batches(batch)
+                return graph_memory.add_document_chunks(
+                    doc_id, filename, batch, embeddings,
+                    {"course_id": course_id, "chapter": filename}, start_position=start_position,
+                    invalidate=False
+                )
+
+        # 2. Push file into Neo4j Graph Memory, one batch at a time
+        written = 0
+        reported_pages = 0
+        while True:
+            batch = await asyncio.to_thread(next_batch)
+            if progress["pages_done"] > reported_pages:
+                reported_pages = progress["pages_done"]
+                yield "data: " + json.dumps({"type": "status", "content": f"📄 Extracted {reported_pages}/{progress['pages_total']} pages", "stage": "extract", "pages_done": reported_pages, "pages_total": progress["pages_total"], "cached": cached}) + "\n\n"
+            if not batch:
+                break
+            written += await asyncio.to_thread(store_batch, batch, written)
+            del batch
+            yield "data: " + json.dumps({"type": "status", "content": f"🧠 Embedded and stored {written} chunks", "stage": "embed", "chunks_done": written}) + "\n\n"
+        # The batches kept the embedding matrix; rebuild it once now that the whole document is in
+        graph_memory.invalidate_embedding_matrix()
+
+        if stripper is not None:
+            boilerplate = stripper.report(graph_memory.chunk_count(progress["raw_words"]), written)
+            if boilerplate["lines_removed"]:
+                print(f"🧹 {filename}: stripped {boilerplate['lines_removed']} boilerplate lines, "
+                      f"{boilerplate['chunks_saved']} chunks / ~{boilerplate['tokens_saved']} tokens saved")
+                yield "data: " + json.dumps({"type": "status", "content": f"🧹 Removed repeated headers/footers: {boilerplate['chunks_saved']} fewer chunks, ~{boilerplate['tokens_saved']:,} tokens saved", "boilerplate": boilerplate}) + "\n\n"
+        yield "data: " + json.dumps({"type": "status", "content": f"💾 Stored {written} chunks", "stage": "stored", "doc_id": doc_id, "chunks": written}) + "\n\n"
 
         response = "Document uploaded and processed successfully."
                 # Stream the final response
@@ -383,7 +763,14 @@ async def feed_graph(file: str, filename: str = None, course_id: int = None ):
 
     except Exception as e:
         print(f"❌ Error uploading document to graph memory: {str(e)}")
-        raise HTTPException(status_code=500, detail="Failed to upload document to graph memory.")
+        # batches already written would leave a partial document behind
+        try:
+            await asyncio.to_thread(graph_memory.delete_document, doc_id)
+        except Exception:
+            pass
+        yield "data: " + json.dumps({"type": "error", "content": "❌ Failed to upload document to graph memory."}) + "\n\n"
+    finally:
+        spool.close()
 
 
 if __name__ == "__main__":
@@ -1,26 +1,43 @@
 import requests
 import json
-from typing import Dict, Any
+from typing import Dict, Any, List
+
+from metrics import current_labels
+from tracing import TracedSession, current_span
 
 class MCPClient:
     """Handles MCP tool calls"""
     
     def __init__(self, base_url: str = "http://localhost:8001/mcp"):
         self.base_url = base_url
+        # sends traceparent, so the MCP server's spans join the caller's trace
+        self.session = TracedSession(propagate=True)
+
+    def _headers(self) -> Dict[str, str]:
+        """Attribution of the current request, so the MCP server can account tool usage to it"""
+        labels = current_labels()
+        headers = {}
+        if labels.get("request_id"):
+            headers["X-Request-ID"] = labels["request_id"]
+        if labels.get("session_id"):
+            headers["X-Session-ID"] = labels["session_id"]
+        return headers
 
     def call_tool(self, tool_name: str, params: Dict[str, Any]) -> Dict:
         """Execute a tool through MCP"""
-        print(f"🔧 Calling tool: {tool_name}")
+        active = current_span()
+        print(f"🔧 Calling tool: {tool_name}" + (f" (trace {active.trace_id})" if active else ""))
         print(f"📍 URL: {self.base_url}/call")
         print(f"📦 Params: {json.dumps(params, indent=2)}")
         
         try:
-            response = requests.post(
+            response = self.session.post(
                 f"{self.base_url}/call",
                 json={
                     "tool_name": tool_name,
                     "params": params
                 },
+                headers=self._headers(),
             )
             print(f"📡 Response status: {response.status_code}")
             print(f"📄 Response content: {response.text[:500]}")
@@ -38,8 +55,25 @@ class MCPClient:
             print(f"❌ Unexpected error in call_tool: {str(e)}")
             raise
 
+    def call_batch(self, calls: List[Dict[str, Any]], max_parallel: int = None) -> Dict:
+        """Execute several tools through MCP in one round-trip"""
+        print(f"🔧 Calling {len(calls)} tools in batch")
+        payload = {"requests": calls}
+        if max_parallel:
+            payload["max_parallel"] = max_parallel
+
+        response = self.session.post(f"{self.base_url}/call_batch", json=payload, headers=self._headers())
+        response.raise_for_status()
+        return response.json()
+
+    def get_outbox_entry(self, outbox_id: str) -> Dict:
+        """Delivery state of a queued publish action"""
+        response = self.session.get(f"{self.base_url}/outbox/{outbox_id}")
+        response.raise_for_status()
+        return response.json()
+
     def list_tools(self) -> Dict:
         """Get available tools"""
-        response = requests.get(f"{self.base_url}/tools")
+        response = self.session.get(f"{self.base_url}/tools")
         response.raise_for_status()
         return response.json()
\ No newline at end of file
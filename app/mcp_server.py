@@ -1,17 +1,33 @@
 # app/mcp_server.py
-from fastapi import FastAPI, APIRouter, HTTPException
-from typing import Dict, Any
-from ai_agent import AcademicAIAgent
-from models import GraphQARequest, QuizRequest, GradingRequest, AnnouncementRequest, ToolRequest
+from fastapi import FastAPI, APIRouter, Header, HTTPException
+from fastapi.responses import JSONResponse, Response
+from typing import Dict, Any, Optional
+from app_container import get_container
+from artifact_store import ArtifactStore
+from publish_outbox import PublishOutbox, PermanentPublishError
+from warmup import DEFAULT_STEPS, create_warmup, readiness_status
+from metrics import CONTENT_TYPE, REGISTRY, metric_labels, observe_stage
+from usage import get_usage_tracker
+from tracing import current_traceparent, get_exporter, set_service_name, span
+from models import GraphQARequest, QuizRequest, GradingRequest, AnnouncementRequest, ToolRequest, BatchToolRequest
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 import json
+import os
 import re
+import time
 
 
 router = APIRouter()
-ai_agent = AcademicAIAgent()
+# tools run through the container's agent, so they share its graph, Moodle and OpenAI clients
+ai_agent = get_container().agent
+artifact_store = ArtifactStore()
 
 app = FastAPI(title="MCP Server for Academic Assistant")
 
+# Upper bound on concurrent tool executions for a single /call_batch request
+BATCH_MAX_PARALLEL = int(os.getenv("MCP_BATCH_MAX_PARALLEL", "4"))
+
 
 @router.get("/tools")
 def list_tools():
@@ -38,13 +54,28 @@ def list_tools():
 
 
 @router.post("/call")
-def call_tool(req: ToolRequest):
+def call_tool(req: ToolRequest, x_request_id: Optional[str] = Header(None), x_session_id: Optional[str] = Header(None),
+              traceparent: Optional[str] = Header(None)):
     """Execute the tool dynamically based on AI agent's decision"""
-    tool_name = req.tool_name
     params = req.params or {}
+    start = time.perf_counter()
+    with metric_labels(tool=req.tool_name, course=params.get("course_id"), request_id=x_request_id, session_id=x_session_id), \
+            span("mcp.call_tool", traceparent=traceparent, tool=req.tool_name, course=params.get("course_id")) as active:
+        result = _run_tool(req.tool_name, params)
+        # tool failures come back as {"error": ...} rather than raising
+        failed = isinstance(result, dict) and "error" in result
+        observe_stage("tool", time.perf_counter() - start, failed=failed)
+        if failed:
+            active.error = str(result["error"])[:200]
+    return result
+
 
+def _run_tool(tool_name: str, params: Dict[str, Any]):
     try:
-        if tool_name == "generate_quiz":
+        if tool_name == "publish_artifact":
+            return _publish_artifact(params.get("artifact_id"))
+
+        elif tool_name == "generate_quiz":
             qr = QuizRequest(**params)
 
             # Try to fetch course content from Moodle; fallback to empty string
@@ -63,25 +94,15 @@ def call_tool(req: ToolRequest):
 
             # Check if this is a confirmation request
             if params.get("confirmed"):
-                # If confirmed, post to Moodle
-                moodle_result = None
-                try:
-                    moodle_result = ai_agent.moodle.create_and_upload_quiz_pdf(
-                            quiz_json=quiz
-                    )
-
-                except Exception as e:
-                    moodle_result = {"error": str(e)}
-
-                return {
-                    "message": f"Quiz posted to Moodle successfully: {moodle_result.get('message', 'Posted')}",
-                    "generated_content": quiz  # Still return the content for reference
-                }
+                # If confirmed, queue it for posting to Moodle
+                return _enqueue_publish("generate_quiz", quiz, params)
             else:
-                # If not confirmed, just return the generated content
+                # If not confirmed, keep the preview so confirmation can publish it as-is
+                artifact_id = artifact_store.put("generate_quiz", quiz, params)
                 return {
                     "message": "Quiz generated successfully. Please confirm to post to Moodle.",
-                    "generated_content": str(quiz)
+                    "generated_content": str(quiz),
+                    "artifact_id": artifact_id
                 }
 
         elif tool_name == "post_announcement":
@@ -93,37 +114,15 @@ def call_tool(req: ToolRequest):
             
             # Check if this is a confirmation request
             if params.get("confirmed"):
-                # If confirmed, post to Moodle
-                forum_result = None
-                try:
-                    # prefer posting by forum id if provided, otherwise try course-level posting
-                    forum_id = params.get("forum_id")
-                    course_id = params.get("course_id")
-                    if forum_id and hasattr(ai_agent.moodle, "post_forum_discussion"):
-                        forum_result = ai_agent.moodle.post_forum_discussion(
-                            forum_id=forum_id,
-                            message=announcement,
-                            subject="AI Generated Announcement"
-                        )
-                    elif hasattr(ai_agent.moodle, "post_forum_discussion"):
-                        # try best-effort using course_id if forum_id not available
-                        forum_result = ai_agent.moodle.post_forum_discussion(
-                            forum_id=ar.course_id,
-                            message=announcement,
-                            subject="AI Generated Announcement"
-                        )
-                except Exception as e:
-                    forum_result = {"error": str(e)}
-
-                return {
-                    "message": f"Announcement posted to Moodle successfully!",
-                    "generated_content": announcement
-                }
+                # If confirmed, queue it for posting to Moodle
+                return _enqueue_publish("post_announcement", announcement, params)
             else:
-                # If not confirmed, just return the generated content
+                # If not confirmed, keep the preview so confirmation can publish it as-is
+                artifact_id = artifact_store.put("post_announcement", announcement, params)
                 return {
                     "message": "Announcement generated successfully. Please confirm to post to Moodle.",
-                    "generated_content": announcement
+                    "generated_content": announcement,
+                    "artifact_id": artifact_id
                 }
 
         elif tool_name == "grade_assignment":
@@ -167,6 +166,240 @@ def call_tool(req: ToolRequest):
     except Exception as e:
         # return error payload for MCP clients (and log)
         return {"error": str(e)}
+
+
+# Forum the Google Forms quiz link is posted to (same default as create_and_upload_quiz_pdf)
+QUIZ_FORUM_ID = 6
+
+
+def _deliver_publish(kind: str, payload: Dict[str, Any], checkpoint: Dict[str, Any], idempotency_key: str) -> Dict[str, Any]:
+    """
+    Outbox delivery for a confirmed quiz or announcement. Completed steps are recorded in
+    checkpoint, so a retry after a failure resumes instead of creating a second form or post.
+    """
+    content, params = payload["content"], payload.get("params") or {}
+    # A visible tag in the subject: Moodle's format_text strips HTML comments from messages,
+    # but a plain-text subject comes back from mod_forum_get_forum_discussions unchanged
+    marker = f"[ref {idempotency_key[:10]}]"
+
+    if kind == "generate_quiz":
+        if "form_url" not in checkpoint:
+            checkpoint.update(ai_agent.moodle.create_google_form(content, idempotency_key))
+        _post_discussion_once(
+            QUIZ_FORUM_ID, checkpoint, marker,
+            lambda: ai_agent.moodle._post_quiz_to_moodle_forum(QUIZ_FORUM_ID, content, checkpoint["form_url"], marker)
+        )
+        return {
+            "message": f"Quiz posted to Moodle successfully: {checkpoint['form_url']}",
+            "url": checkpoint["form_url"],
+            "discussion_url": ai_agent.moodle.discussion_url(checkpoint["discussion_id"]),
+        }
+
+    if kind == "post_announcement":
+        # prefer posting by forum id if provided, otherwise try course-level posting
+        forum_id = params.get("forum_id") or params.get("course_id")
+        _post_discussion_once(
+            forum_id, checkpoint, marker,
+            lambda: ai_agent.moodle.post_forum_discussion(
+                forum_id=forum_id,
+                message=content,
+                subject=f"AI Generated Announcement {marker}"
+            )
+        )
+        url = ai_agent.moodle.discussion_url(checkpoint["discussion_id"])
+        return {"message": f"Announcement posted to Moodle successfully: {url}", "url": url}
+
+    raise PermanentPublishError(f"Unknown publish kind: {kind}")
+
+
+def _post_discussion_once(forum_id: int, checkpoint: Dict[str, Any], marker: str, post) -> None:
+    """Post a forum discussion unless an earlier attempt already did; records discussion_id in checkpoint"""
+    if checkpoint.get("discussion_id"):
+        return
+    if checkpoint.get("post_attempted") or checkpoint.get("recovered"):
+        # The earlier attempt may have reached Moodle before failing; look for its marker first
+        existing = ai_agent.moodle.find_forum_discussion(forum_id, marker)
+        if existing:
+            checkpoint["discussion_id"] = existing
+            return
+
+    checkpoint["post_attempted"] = True
+    result = post()
+    if isinstance(result, dict) and "exception" in result:
+        raise PermanentPublishError(result.get("message") or result.get("errorcode"))
+    if not isinstance(result, dict) or "discussionid" not in result:
+        raise ValueError(f"Unexpected forum response: {result}")
+    checkpoint["discussion_id"] = result["discussionid"]
+
+
+# Built by the MCP app's startup hook only: main.py imports this module for its router,
+# and must not run a second delivery worker against the same outbox
+publish_outbox: Optional[PublishOutbox] = None
+
+
+def _outbox() -> PublishOutbox:
+    if publish_outbox is None:
+        raise HTTPException(status_code=503, detail="The publish outbox is not running in this process")
+    return publish_outbox
+
+
+@app.on_event("startup")
+def start_publish_outbox():
+    global publish_outbox
+    publish_outbox = PublishOutbox(_deliver_publish)
+    publish_outbox.start()
+
+
+# graph_qa runs in this process, so it also preloads the chunk embedding matrix
+warmup = create_warmup(get_container(), env_var="MCP_WARMUP_STEPS", default_steps=DEFAULT_STEPS + ("embedding_matrix",))
+
+
+@app.on_event("startup")
+def start_warmup():
+    warmup.start()
+
+
+@app.on_event("startup")
+def name_trace_service():
+    set_service_name("mcp-server")
+
+
+@app.on_event("shutdown")
+def flush_usage():
+    get_usage_tracker().stop()
+    get_exporter().stop()
+
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus scrape target for the MCP server: per-tool stage latencies and errors of this process"""
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+
+@app.get("/ready")
+def readiness():
+    """Readiness probe for the MCP server (MCP_WARMUP_STEPS, which also load the embedding matrix)"""
+    status_code, status = readiness_status(warmup, get_container())
+    return JSONResponse(status_code=status_code, content=status)
+
+
+def _enqueue_publish(kind: str, content: Any, params: Dict[str, Any], idempotency_key: str = None) -> Dict[str, Any]:
+    """Queue a confirmed quiz or announcement for background delivery"""
+    entry = _outbox().enqueue(
+        kind,
+        {"content": content, "params": {k: v for k, v in params.items() if k != "generated_content"}},
+        idempotency_key
+    )
+    return {
+        "message": "Queued for posting to Moodle.",
+        "status": "queued",
+        "outbox_id": entry["outbox_id"],
+        "generated_content": content
+    }
+
+
+def _publish_artifact(artifact_id: str) -> Dict[str, Any]:
+    """Queue a previously previewed artifact for publishing without regenerating it"""
+    # take() is atomic: of two concurrent confirmations only one gets the artifact and publishes it
+    artifact = artifact_store.take(artifact_id) if artifact_id else None
+    if artifact is None:
+        return {"error": "The generated content has expired or was already posted. Please generate it again."}
+
+    if artifact["kind"] not in ("generate_quiz", "post_announcement"):
+        return {"error": f"Unknown artifact kind: {artifact['kind']}"}
+
+    # The artifact ID doubles as the idempotency key, as a second line of defence in the outbox
+    try:
+        result = _enqueue_publish(artifact["kind"], artifact["content"], artifact["params"], idempotency_key=artifact_id)
+    except Exception:
+        artifact_store.restore(artifact)
+        raise
+    result["intent"] = artifact["kind"]
+    return result
+
+
+@router.get("/outbox")
+def list_outbox(limit: int = 50):
+    """Recent publish actions and their delivery state"""
+    return {"entries": _outbox().list(limit)}
+
+
+@router.get("/outbox/{outbox_id}")
+def get_outbox_entry(outbox_id: str):
+    """Delivery state of one publish action; result holds the final URL once delivered"""
+    entry = _outbox().get(outbox_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Outbox entry not found")
+    return entry
+
+
+def _retrieval_queries(requests):
+    """Collect the graph retrieval queries a batch will issue, so they can be embedded together."""
+    queries = []
+    for r in requests:
+        params = r.params or {}
+        if r.tool_name == "graph_qa":
+            queries.append(params.get("question"))
+        elif r.tool_name == "generate_quiz":
+            queries.append(params.get("focus_area") or params.get("topic"))
+    return [q for q in queries if isinstance(q, str)]
+
+
+@router.post("/call_batch")
+def call_tool_batch(batch: BatchToolRequest, x_request_id: Optional[str] = Header(None),
+                    x_session_id: Optional[str] = Header(None), traceparent: Optional[str] = Header(None)):
+    """Execute several tool calls concurrently and return the results in request order"""
+    with span("mcp.call_batch", traceparent=traceparent, calls=len(batch.requests)):
+        return _run_batch(batch, x_request_id, x_session_id, current_traceparent())
+
+
+def _run_batch(batch: BatchToolRequest, x_request_id: Optional[str], x_session_id: Optional[str],
+               traceparent: Optional[str]) -> Dict[str, Any]:
+    max_parallel = min(batch.max_parallel or BATCH_MAX_PARALLEL, BATCH_MAX_PARALLEL)
+    max_parallel = max(1, min(max_parallel, len(batch.requests) or 1))
+
+    def run(index: int, req: ToolRequest) -> Dict[str, Any]:
+        start = time.perf_counter()
+        try:
+            # pool threads do not inherit the span context, so each call is parented explicitly
+            result = call_tool(req, x_request_id, x_session_id, traceparent)
+        except HTTPException as e:
+            result = {"error": e.detail}
+        except Exception as e:
+            result = {"error": str(e)}
+        failed = isinstance(result, dict) and "error" in result
+        return {
+            "index": index,
+            "tool_name": req.tool_name,
+            "status": "error" if failed else "success",
+            "result": None if failed else result,
+            "error": result.get("error") if failed else None,
+            "elapsed_ms": round((time.perf_counter() - start) * 1000, 2),
+        }
+
+    start = time.perf_counter()
+    queries = _retrieval_queries(batch.requests)
+
+    with ExitStack() as stack:
+        if queries:
+            try:
+                stack.enter_context(ai_agent.graph_memory.shared_retrieval(queries))
+            except Exception as e:
+                # shared prefetch is only an optimisation; the calls then retrieve independently
+                print(f"⚠ Shared retrieval unavailable for batch: {str(e)}")
+        # the batch runs exactly once, so a failure can never post its writes twice
+        with ThreadPoolExecutor(max_workers=max_parallel) as pool:
+            results = list(pool.map(run, range(len(batch.requests)), batch.requests))
+
+    return {
+        "results": results,
+        "succeeded": sum(1 for r in results if r["status"] == "success"),
+        "failed": sum(1 for r in results if r["status"] == "error"),
+        "max_parallel": max_parallel,
+        "elapsed_ms": round((time.perf_counter() - start) * 1000, 2),
+    }
+
+
 app.include_router(router, prefix="/mcp")
 
 if __name__ == "__main__":
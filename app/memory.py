@@ -1,46 +1,452 @@
-from typing import List, Dict
-import uuid
+import contextvars
+import hashlib
+import os
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from state_backend import StateBackend, get_state_backend
+from tokens import CHARS_PER_TOKEN, count_tokens
+
+DEFAULT_SESSION = "default"
+EMPTY_CONTEXT = "No previous conversation history."
+CONTEXT_HEADER = "Recent conversation history:\n"
+
+
+def _render_line(role: str, content: str) -> str:
+    return f"{'User' if role == 'user' else 'Assistant'}: {content}\n"
+
+
+class HistoryCompactor:
+    """
+    Keeps prompt history within a token budget. Messages longer than reference_tokens are stored
+    aside and replaced by a short reference; turns that no longer fit the budget are folded into a
+    running summary by summarize(previous_summary, evicted_messages). The stores run that call in the
+    background, so a full history never makes a chat request wait for it; turns evicted while one runs
+    are folded in by the next pass, so bursts of turns share one call.
+    References belong to their session: release() drops one with its message, release_session()
+    drops them all when the session is cleared or evicted.
+    """
+
+    namespace = "memory_refs"
+
+    def __init__(self, summarize: Callable[[str, List[Dict[str, str]]], str] = None, backend: StateBackend = None,
+                 token_budget: int = None, summary_tokens: int = None, reference_tokens: int = None):
+        self.summarize_fn = summarize
+        self.backend = backend or get_state_backend()
+        self.token_budget = token_budget or int(os.getenv("MEMORY_TOKEN_BUDGET", "800"))
+        self.summary_tokens = summary_tokens or int(os.getenv("MEMORY_SUMMARY_TOKENS", "150"))
+        self.reference_tokens = reference_tokens or int(os.getenv("MEMORY_REFERENCE_TOKENS", "200"))
+        self.reference_ttl = float(os.getenv("MEMORY_REFERENCE_TTL", "86400"))
+        self.summary_workers = int(os.getenv("MEMORY_SUMMARY_WORKERS", "2"))
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    @staticmethod
+    def _session_tag(session_id: str) -> str:
+        return f"session:{session_id or DEFAULT_SESSION}"
+
+    def prepare(self, role: str, content: Any, session_id: str = None) -> Dict[str, Any]:
+        """
+        Message as stored in history: {"role", "content", "tokens", "raw_tokens"}, plus "ref_id" and
+        "ref_chars" (the size of the text stored aside) when it was replaced by a reference
+        """
+        content = str(content)
+        raw_tokens = count_tokens(content)
+        message = {"role": role}
+        if raw_tokens > self.reference_tokens:
+            session_id = session_id or DEFAULT_SESSION
+            ref_id = hashlib.sha256(f"{session_id}\n{content}".encode("utf-8")).hexdigest()[:12]
+            self.backend.set(self.namespace, ref_id, content, ttl=self.reference_ttl,
+                             tags=[self._session_tag(session_id)])
+            message.update(ref_id=ref_id, ref_chars=len(content))
+            preview = " ".join(content.split())[:160]
+            content = f"[{raw_tokens}-token message stored as ref:{ref_id}] {preview}…"
+        message.update(content=content, tokens=count_tokens(content), raw_tokens=raw_tokens)
+        return message
+
+    def reference(self, ref_id: str) -> Optional[str]:
+        return self.backend.get(self.namespace, ref_id)
+
+    def release(self, message: Dict[str, Any], remaining: List[Dict[str, Any]] = ()):
+        """Drop the text stored aside for a message leaving history (unless a remaining message shares it)"""
+        ref_id = message.get("ref_id")
+        if ref_id and not any(m.get("ref_id") == ref_id for m in remaining):
+            self.backend.delete(self.namespace, ref_id)
+
+    def release_session(self, session_id: str):
+        """Drop every reference stored for a session"""
+        self.backend.delete_tag(self.namespace, self._session_tag(session_id))
+
+    @property
+    def message_budget(self) -> int:
+        """Tokens left for verbatim messages once the header and summary are accounted for"""
+        return self.token_budget - self.summary_tokens - count_tokens(CONTEXT_HEADER)
+
+    def summarize(self, previous: str, evicted: List[Dict[str, Any]]) -> str:
+        messages = [{"role": m["role"], "content": m["content"]} for m in evicted]
+        summary = None
+        if self.summarize_fn is not None:
+            try:
+                summary = self.summarize_fn(previous, messages)
+            except Exception as e:
+                print(f"⚠ History summary failed, keeping a truncated transcript: {str(e)}")
+        if summary is None:
+            # fallback: the previous summary followed by the evicted lines
+            summary = (previous + " " if previous else "") + " ".join(
+                _render_line(m["role"], m["content"]).strip() for m in messages)
+        if count_tokens(summary) > self.summary_tokens:
+            # keep the newest part so the summary never eats into the verbatim budget
+            summary = summary[-self.summary_tokens * CHARS_PER_TOKEN:]
+        return summary
+
+    def run_in_background(self, fn: Callable[[], None]):
+        """Run fn on the summary worker threads, with the caller's metric labels"""
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.summary_workers,
+                                                    thread_name_prefix="history-summary")
+
+        def run():
+            try:
+                fn()
+            except Exception as e:
+                print(f"⚠ History summary failed: {str(e)}")
+
+        self._executor.submit(contextvars.copy_context().run, run)
+
+    def render(self, summary: str, lines: List[str]) -> str:
+        if not summary and not lines:
+            return EMPTY_CONTEXT
+        earlier = f"Summary of earlier conversation: {summary}\n" if summary else ""
+        return CONTEXT_HEADER + earlier + "".join(lines)
+
 
 class ConversationMemory:
-    """Manages short-term conversation history"""
-    
-    def __init__(self, max_turns: int = 5):
-        self.conversation_history: List[Dict[str, str]] = []
+    """
+    Manages short-term conversation history. Not thread-safe: SessionMemoryStore calls it under its lock.
+    """
+
+    def __init__(self, max_turns: int = 5, compactor: HistoryCompactor = None, session_id: str = DEFAULT_SESSION):
         self.max_memory_turns = max_turns
+        self.compactor = compactor or HistoryCompactor()
+        self.session_id = session_id
+        # deques drop the oldest message in O(1); rendered lines are kept alongside so the
+        # prompt context is only re-joined after a change, never re-formatted from scratch
+        self._messages: deque = deque()
+        self._lines: deque = deque()
+        self._tokens = 0
+        # token sizes of the last max_turns turns as they were sent, to report what compaction saves
+        self._raw_tokens: deque = deque(maxlen=max_turns * 2)
+        self.summary = ""
+        # evicted messages waiting to be folded into the summary, and whether a summary pass is running;
+        # clear() bumps the generation so a pass started before it never writes into the new history
+        self._pending: List[Dict[str, Any]] = []
+        self._summarizing = False
+        self.generation = 0
+        self._context = None
+        self._context_tokens = 0
+        self.size_chars = 0
 
-    def add(self, user_message: str, assistant_response: str):
-        """Add user and assistant messages to history"""
-        self.conversation_history.append({
-            "role": "user",
-            "content": user_message
-        })
-        self.conversation_history.append({
-            "role": "assistant",
-            "content": assistant_response
-        })
-        
-        # Keep only recent history
-        if len(self.conversation_history) > self.max_memory_turns * 2:
-            self.conversation_history = self.conversation_history[-(self.max_memory_turns * 2):]
+    def add(self, user_message: str, assistant_response: str) -> Tuple[int, bool]:
+        """
+        Add user and assistant messages to history. Messages evicted to stay within the turn and token
+        budgets wait for the summary. Returns the change in stored characters (including text stored
+        aside as references) and whether the caller should start a summary pass (see take_pending).
+        """
+        before = self.size_chars
+        for role, content in (("user", user_message), ("assistant", assistant_response)):
+            message = self.compactor.prepare(role, content, self.session_id)
+            self._messages.append(message)
+            self._lines.append(_render_line(role, message["content"]))
+            self._tokens += message["tokens"]
+            self._raw_tokens.append(message["raw_tokens"])
+            self.size_chars += len(message["content"]) + message.get("ref_chars", 0)
+
+        # the newest turn always stays verbatim
+        while len(self._messages) > 2 and (
+                len(self._messages) > self.max_memory_turns * 2 or self._tokens > self.compactor.message_budget):
+            message = self._messages.popleft()
+            self._lines.popleft()
+            self._tokens -= message["tokens"]
+            self.size_chars -= len(message["content"]) + message.get("ref_chars", 0)
+            self.compactor.release(message, self._messages)
+            self._pending.append(message)
+        self._context = None
+        start_summary = bool(self._pending) and not self._summarizing
+        self._summarizing = self._summarizing or start_summary
+        return self.size_chars - before, start_summary
+
+    def take_pending(self, generation: int) -> Optional[Tuple[str, List[Dict[str, Any]]]]:
+        """
+        The current summary and the messages waiting to be folded into it, or None once there are
+        none left (which ends the summary pass) or the history was cleared since generation.
+        """
+        if generation != self.generation:
+            return None
+        if not self._pending:
+            self._summarizing = False
+            return None
+        pending, self._pending = self._pending, []
+        return self.summary, pending
+
+    def apply_summary(self, summary: str, generation: int) -> int:
+        """Replace the running summary with one built from take_pending; returns the change in stored characters"""
+        if generation != self.generation:
+            return 0
+        delta = len(summary) - len(self.summary)
+        self.summary = summary
+        self._context = None
+        self.size_chars += delta
+        return delta
 
     def get_context(self) -> str:
         """Format conversation history for prompts"""
-        if not self.conversation_history:
-            return "No previous conversation history."
-        
-        memory_text = "Recent conversation history:\n"
-        for msg in self.conversation_history:
-            role = "User" if msg["role"] == "user" else "Assistant"
-            memory_text += f"{role}: {msg['content']}\n"
-        
-        return memory_text
+        if self._context is None:
+            self._context = self.compactor.render(self.summary, list(self._lines))
+            self._context_tokens = count_tokens(self._context) if self._messages or self.summary else 0
+        return self._context
+
+    def get_context_stats(self) -> Dict[str, Any]:
+        """The prompt context plus its token count and the tokens compaction saved"""
+        context = self.get_context()
+        raw_tokens = count_tokens(CONTEXT_HEADER) + sum(self._raw_tokens) if self._raw_tokens else 0
+        return {
+            "context": context,
+            "context_tokens": self._context_tokens,
+            "raw_tokens": raw_tokens,
+            "tokens_saved": max(0, raw_tokens - self._context_tokens),
+        }
 
     def clear(self):
         """Clear all history"""
-        self.conversation_history = []
+        self.compactor.release_session(self.session_id)
+        self._messages.clear()
+        self._lines.clear()
+        self._raw_tokens.clear()
+        self._tokens = 0
+        self.summary = ""
+        self._pending = []
+        self._summarizing = False
+        self.generation += 1
+        self._context = None
+        self.size_chars = 0
 
     def get_history(self) -> List[Dict[str, str]]:
         """Get raw history"""
-        return self.conversation_history
-    
+        return [{"role": m["role"], "content": m["content"]} for m in self._messages]
+
+    @property
+    def conversation_history(self) -> List[Dict[str, str]]:
+        return self.get_history()
+
+
+class SessionMemoryStore:
+    """
+    Conversation memory per chat session, so concurrent users never see each other's history.
+    Sessions are kept in least-recently-used order; the idlest ones are evicted once there are
+    more than max_sessions or their history together exceeds max_chars.
+    """
+
+    def __init__(self, max_turns: int = 5, max_sessions: int = None, max_chars: int = None,
+                 compactor: HistoryCompactor = None):
+        self.max_turns = max_turns
+        self.max_sessions = max_sessions or int(os.getenv("MEMORY_MAX_SESSIONS", "1000"))
+        self.max_chars = max_chars or int(os.getenv("MEMORY_MAX_MB", "64")) * 1024 * 1024
+        self.compactor = compactor or HistoryCompactor()
+        self._sessions: "OrderedDict[str, ConversationMemory]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._total_chars = 0
+        self._evictions = 0
+
+    def _touch(self, session_id: str) -> Tuple[str, ConversationMemory]:
+        session_id = session_id or DEFAULT_SESSION
+        memory = self._sessions.get(session_id)
+        if memory is None:
+            memory = self._sessions[session_id] = ConversationMemory(
+                max_turns=self.max_turns, compactor=self.compactor, session_id=session_id)
+        else:
+            self._sessions.move_to_end(session_id)
+        return session_id, memory
+
+    def get_context(self, session_id: str = None) -> str:
+        with self._lock:
+            return self._touch(session_id)[1].get_context()
+
+    def get_context_stats(self, session_id: str = None) -> Dict[str, Any]:
+        with self._lock:
+            return self._touch(session_id)[1].get_context_stats()
+
+    def add(self, session_id: str, user_message: str, assistant_response: str):
+        with self._lock:
+            session_id, memory = self._touch(session_id)
+            delta, start_summary = memory.add(user_message, assistant_response)
+            self._total_chars += delta
+            self._evict(keep=session_id)
+            generation = memory.generation
+        if start_summary:
+            self.compactor.run_in_background(lambda: self._summarize(session_id, memory, generation))
+
+    def _summarize(self, session_id: str, memory: ConversationMemory, generation: int):
+        # the model call runs outside the store lock; every change to the session (and its size) under it
+        while True:
+            with self._lock:
+                work = memory.take_pending(generation)
+            if work is None:
+                return
+            summary = self.compactor.summarize(*work)
+            with self._lock:
+                delta = memory.apply_summary(summary, generation)
+                if self._sessions.get(session_id) is memory:
+                    self._total_chars += delta
+
+    def _evict(self, keep: str):
+        while len(self._sessions) > 1 and (len(self._sessions) > self.max_sessions or self._total_chars > self.max_chars):
+            session_id, memory = next(iter(self._sessions.items()))
+            if session_id == keep:
+                break
+            del self._sessions[session_id]
+            self._total_chars -= memory.size_chars
+            memory.clear()
+            self._evictions += 1
+
+    def clear(self, session_id: str = None):
+        with self._lock:
+            memory = self._sessions.pop(session_id or DEFAULT_SESSION, None)
+            if memory is not None:
+                self._total_chars -= memory.size_chars
+                memory.clear()
+
+    def get_history(self, session_id: str = None) -> List[Dict[str, str]]:
+        with self._lock:
+            memory = self._sessions.get(session_id or DEFAULT_SESSION)
+            return memory.get_history() if memory else []
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"sessions": len(self._sessions), "characters": self._total_chars, "evictions": self._evictions}
+
+
+class SharedSessionMemoryStore:
+    """
+    Session memory kept in a shared StateBackend, so any worker process can continue any
+    conversation. Each session is one entry holding its recent messages, running summary and
+    rendered context; appends are atomic read-modify-writes, and idle sessions expire after
+    MEMORY_SESSION_TTL or are evicted least-recently-written first past max_sessions.
+    """
+
+    namespace = "conversation"
+
+    def __init__(self, backend: StateBackend, max_turns: int = 5, max_sessions: int = None,
+                 session_ttl: float = None, compactor: HistoryCompactor = None):
+        self.backend = backend
+        self.max_turns = max_turns
+        self.max_sessions = max_sessions or int(os.getenv("MEMORY_MAX_SESSIONS", "1000"))
+        self.session_ttl = session_ttl or float(os.getenv("MEMORY_SESSION_TTL", "86400"))
+        self.compactor = compactor or HistoryCompactor(backend=backend)
+        self._adds = 0
+        self._evictions = 0
+        # sessions with a summary pass running in this process
+        self._summarizing = set()
+        self._summarizing_lock = threading.Lock()
+
+    def _session(self, session_id: str) -> Optional[Dict[str, Any]]:
+        return self.backend.get(self.namespace, session_id or DEFAULT_SESSION)
+
+    def _rendered(self, session: Dict[str, Any]) -> Dict[str, Any]:
+        lines = [_render_line(m["role"], m["content"]) for m in session["messages"]]
+        session["context"] = self.compactor.render(session["summary"], lines)
+        session["context_tokens"] = count_tokens(session["context"])
+        return session
+
+    def get_context(self, session_id: str = None) -> str:
+        session = self._session(session_id)
+        return session["context"] if session else EMPTY_CONTEXT
+
+    def get_context_stats(self, session_id: str = None) -> Dict[str, Any]:
+        session = self._session(session_id)
+        if session is None:
+            return {"context": EMPTY_CONTEXT, "context_tokens": 0, "raw_tokens": 0, "tokens_saved": 0}
+        raw_tokens = count_tokens(CONTEXT_HEADER) + sum(session["raw_tokens"])
+        return {
+            "context": session["context"],
+            "context_tokens": session["context_tokens"],
+            "raw_tokens": raw_tokens,
+            "tokens_saved": max(0, raw_tokens - session["context_tokens"]),
+        }
+
+    def add(self, session_id: str, user_message: str, assistant_response: str):
+        session_id = session_id or DEFAULT_SESSION
+        new_messages = [self.compactor.prepare("user", user_message, session_id),
+                        self.compactor.prepare("assistant", assistant_response, session_id)]
+
+        def append(session: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+            session = session or {"messages": [], "summary": "", "pending": [], "raw_tokens": []}
+            messages = session["messages"] + new_messages
+            session["raw_tokens"] = (session["raw_tokens"] + [m["raw_tokens"] for m in new_messages])[-self.max_turns * 2:]
+            # the newest turn always stays verbatim; evicted messages wait in "pending" for the summary
+            while len(messages) > 2 and (len(messages) > self.max_turns * 2 or
+                                         sum(m["tokens"] for m in messages) > self.compactor.message_budget):
+                session["pending"].append(messages.pop(0))
+            session["messages"] = messages
+            return self._rendered(session)
+
+        session = self.backend.update(self.namespace, session_id, append, ttl=self.session_ttl)
+        if session["pending"]:
+            with self._summarizing_lock:
+                start_summary = session_id not in self._summarizing
+                self._summarizing.add(session_id)
+            if start_summary:
+                self.compactor.run_in_background(lambda: self._summarize_pending(session_id, session))
+        self._adds += 1
+        if self._adds % 50 == 0:
+            self._evictions += self.backend.evict_lru(self.namespace, self.max_sessions)
+
+    def _summarize_pending(self, session_id: str, session: Dict[str, Any]):
+        # the model call runs outside the write transaction; if another worker summarized the
+        # same messages first, its result wins and this one is dropped. Messages evicted while a
+        # pass runs are picked up by its next round (or, if they land as it ends, by the next turn).
+        try:
+            while session is not None and session["pending"]:
+                pending = session["pending"]
+                summary = self.compactor.summarize(session["summary"], pending)
+
+                def fold(current: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+                    if current is None or current["pending"][:len(pending)] != pending:
+                        return current
+                    current["pending"] = current["pending"][len(pending):]
+                    current["summary"] = summary
+                    return self._rendered(current)
+
+                current = self.backend.update(self.namespace, session_id, fold, ttl=self.session_ttl)
+                if current is not None and current["summary"] == summary:
+                    for message in pending:
+                        self.compactor.release(message, current["messages"] + current["pending"])
+                session = current
+        finally:
+            with self._summarizing_lock:
+                self._summarizing.discard(session_id)
+
+    def clear(self, session_id: str = None):
+        self.backend.delete(self.namespace, session_id or DEFAULT_SESSION)
+        self.compactor.release_session(session_id)
+
+    def get_history(self, session_id: str = None) -> List[Dict[str, str]]:
+        session = self._session(session_id)
+        return [{"role": m["role"], "content": m["content"]} for m in session["messages"]] if session else []
+
+    def stats(self) -> Dict[str, int]:
+        return {"sessions": self.backend.count(self.namespace), "evictions": self._evictions}
+
 
+def create_session_memory(max_turns: int = 5, summarize: Callable[[str, List[Dict[str, str]]], str] = None):
+    """
+    Session memory for the configured STATE_BACKEND: process-local deques, or shared across workers.
+    summarize(previous_summary, messages) condenses turns that fall out of the token budget.
+    """
+    backend = get_state_backend()
+    compactor = HistoryCompactor(summarize=summarize, backend=backend)
+    if backend.shared:
+        return SharedSessionMemoryStore(backend, max_turns=max_turns, compactor=compactor)
+    return SessionMemoryStore(max_turns=max_turns, compactor=compactor)
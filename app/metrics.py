@@ -0,0 +1,175 @@
+# app/metrics.py
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from tracing import span
+
+# Latency buckets in seconds: fast cache hits up to slow LLM calls
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# tool / course (and request / session) of the request being handled, inherited by every
+# stage timed and every model call made under it
+_labels: contextvars.ContextVar = contextvars.ContextVar("metric_labels", default={})
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Monotonic counter per label set"""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    """Cumulative-bucket histogram per label set, in the Prometheus sense"""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # per label set: [count per bucket (+Inf last), sum]
+        self._series: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = sorted((key, list(counts), total) for key, (counts, total) in self._series.items())
+        for key, counts, total in snapshot:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """Process-wide metrics, rendered in the Prometheus text exposition format"""
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+# Content type Prometheus expects from a /metrics endpoint (Starlette appends the charset)
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+STAGE_LABELS = ("stage", "tool", "course")
+STAGE_SECONDS = REGISTRY.histogram("assistant_stage_seconds", "Time spent in each request stage", STAGE_LABELS)
+STAGE_ERRORS = REGISTRY.counter("assistant_stage_errors_total", "Request stages that raised or returned an error", STAGE_LABELS)
+
+
+@contextmanager
+def metric_labels(tool: Optional[str] = None, course=None, request_id: Optional[str] = None,
+                  session_id: Optional[str] = None) -> Iterator[None]:
+    """
+    Attribute every stage timed and every model call made inside this block (unset values are
+    inherited). Stage metrics are labelled by tool and course only; request_id and session_id
+    are for usage accounting, where their cardinality does not matter.
+    """
+    labels = dict(_labels.get())
+    for name, value in (("tool", tool), ("course", course), ("request_id", request_id), ("session_id", session_id)):
+        if value is not None:
+            labels[name] = str(value)
+    token = _labels.set(labels)
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+
+def current_labels() -> Dict[str, str]:
+    """Attribution of the code running now: any of tool, course, request_id, session_id"""
+    return dict(_labels.get())
+
+
+def observe_stage(stage: str, seconds: float, failed: bool = False):
+    """Record one finished stage under the current tool / course labels"""
+    labels = _labels.get()
+    tool, course = labels.get("tool", ""), labels.get("course", "")
+    STAGE_SECONDS.observe(seconds, stage=stage, tool=tool, course=course)
+    if failed:
+        STAGE_ERRORS.inc(stage=stage, tool=tool, course=course)
+
+
+@contextmanager
+def stage_timer(stage: str, **span_args) -> Iterator[None]:
+    """
+    Time the block as stage, also traced as a span of that name (span_args go to tracing.span).
+    An exception counts as a stage error and is re-raised.
+    """
+    labels = _labels.get()
+    start = time.perf_counter()
+    failed = False
+    try:
+        with span(stage, tool=labels.get("tool"), course=labels.get("course"), **span_args):
+            yield
+    except Exception:
+        failed = True
+        raise
+    finally:
+        observe_stage(stage, time.perf_counter() - start, failed)
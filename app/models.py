@@ -65,11 +65,22 @@ class UserRequest(BaseModel):
     action_type: Optional[str] = None
     file: Optional[str] = None
     filename: Optional[str] = None
+    session_id: Optional[str] = None
 
 class ToolRequest(BaseModel):
     tool_name: str
     params: Dict[str, Any]
 
+class BatchToolRequest(BaseModel):
+    requests: List[ToolRequest]
+    max_parallel: Optional[int] = None
+
+class NotifyRequest(BaseModel):
+    """Message a course's enrolled users; $firstname, $fullname etc. are filled in per student."""
+    template: str
+    user_ids: Optional[List[int]] = None
+    batch_size: Optional[int] = None
+
 class GraphQARequest(BaseModel):
     question: str = Field(..., description="The user question to answer from graph.")
 
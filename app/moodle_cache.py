@@ -0,0 +1,84 @@
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from state_backend import StateBackend, get_state_backend
+
+
+class TTLCache:
+    """
+    Thread-safe TTL cache with tag invalidation and single-flight loading:
+    concurrent misses on the same key wait for one loader instead of all hitting the backend.
+    Entries live in the configured StateBackend, so with a shared backend every worker process
+    serves (and invalidates) the same cache; single-flight applies within each process.
+    """
+
+    def __init__(self, namespace: str = "moodle", backend: StateBackend = None):
+        self.namespace = namespace
+        self.backend = backend or get_state_backend()
+        # expired entries are revalidated, so the backend must keep them for a while
+        self.backend.keep_stale(namespace)
+        self._inflight: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "revalidated": 0, "invalidated": 0}
+
+    def _fresh(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self.backend.get_entry(self.namespace, key)
+        if entry is not None and entry["expires_at"] is not None and entry["expires_at"] > time.time():
+            return entry
+        return None
+
+    def _count(self, stat: str, n: int = 1):
+        with self._lock:
+            self._stats[stat] += n
+
+    def get_or_load(self, key: str, ttl: float, loader: Callable[[], Any], tags: Iterable[str] = (),
+                    revalidate: Callable[[Dict[str, Any]], bool] = None) -> Any:
+        """
+        Return the cached value for key, loading it with loader() when missing or expired.
+        If revalidate(entry) returns True for an expired entry, it is kept for another ttl
+        instead of being reloaded.
+        """
+        entry = self._fresh(key)
+        if entry is not None:
+            self._count("hits")
+            return entry["value"]
+        with self._lock:
+            key_lock = self._inflight.setdefault(key, threading.Lock())
+
+        with key_lock:
+            stale = self.backend.get_entry(self.namespace, key)
+            if stale is not None and stale["expires_at"] is not None and stale["expires_at"] > time.time():
+                # another thread loaded it while we were waiting
+                self._count("hits")
+                return stale["value"]
+
+            if stale is not None and revalidate is not None and revalidate(stale):
+                self.backend.touch(self.namespace, key, ttl)
+                self._count("revalidated")
+                return stale["value"]
+
+            value = loader()
+            self.backend.set(self.namespace, key, value, ttl=ttl, tags=tags)
+            self._count("misses")
+            with self._lock:
+                self._inflight.pop(key, None)
+            return value
+
+    def invalidate(self, key: str):
+        if self.backend.delete(self.namespace, key):
+            self._count("invalidated")
+
+    def invalidate_tag(self, tag: str) -> int:
+        """Drop every entry carrying tag; returns how many were removed"""
+        removed = self.backend.delete_tag(self.namespace, tag)
+        self._count("invalidated", removed)
+        return removed
+
+    def clear(self):
+        self.backend.clear(self.namespace)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = dict(self._stats)
+        return {**stats, "entries": self.backend.count(self.namespace)}
@@ -4,32 +4,235 @@ import json
 from typing import Dict, List, Any
 import os
 from dotenv import load_dotenv
-from reportlab.lib.pagesizes import A4
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, PageBreak
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib import colors
 import os
 import json
-import PyPDF2
 from io import BytesIO
 import tempfile
 import shutil
-from typing import Tuple, List
+from typing import Tuple, List, Iterable, Iterator
+import bisect
 import hashlib
+import threading
+import time
+import uuid
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from moodle_cache import TTLCache
+from utils import extract_pdf_text
+from sync_pipeline import CourseSyncPipeline
+from sync_manifest import SyncManifest
+from metrics import observe_stage
+from tracing import TracedSession, span
 # Load environment variables from .env (if present)
 load_dotenv()
 
 
+# HTTP statuses worth retrying for idempotent (read-only) web-service calls
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+# Auth strategies for pluginfile downloads, in default order
+DOWNLOAD_STRATEGIES = ['bearer', 'wstoken', 'token', 'files_api', 'direct']
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class DownloadTooLarge(ValueError):
+    """Raised when a download exceeds MOODLE_MAX_DOWNLOAD_BYTES"""
+
+
+class _MultipartFileBody:
+    """
+    multipart/form-data body that reads the file part from disk as the request is sent,
+    so an upload never holds more than one read block of the file in memory.
+    """
+
+    def __init__(self, fields: Dict, file_field: str, filename: str, fileobj, size: int,
+                 file_content_type: str = 'application/octet-stream'):
+        self.boundary = uuid.uuid4().hex
+        filename = filename.replace('"', '%22')
+        head = ''.join(
+            f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+            for name, value in fields.items()
+        )
+        head += (
+            f'--{self.boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+            f'Content-Type: {file_content_type}\r\n\r\n'
+        )
+        tail = f'\r\n--{self.boundary}--\r\n'.encode()
+        self._parts = [BytesIO(head.encode()), fileobj, BytesIO(tail)]
+        self._length = len(head.encode()) + size + len(tail)
+
+    @property
+    def content_type(self) -> str:
+        return f'multipart/form-data; boundary={self.boundary}'
+
+    def __len__(self) -> int:
+        return self._length
+
+    def read(self, size: int = -1) -> bytes:
+        out = b''
+        while self._parts and (size < 0 or len(out) < size):
+            chunk = self._parts[0].read(-1 if size < 0 else size - len(out))
+            if not chunk:
+                self._parts.pop(0)
+                continue
+            out += chunk
+        return out
+
+
+# Seconds each read-only wsfunction result may be served from cache
+CACHE_TTLS = {
+    'core_webservice_get_site_info': 3600,
+    'core_course_get_courses': 600,
+    'core_course_get_courses_by_field': 3600,
+    'core_enrol_get_users_courses': 300,
+    'core_course_get_contents': 300,
+    'mod_forum_get_forums_by_courses': 600,
+}
+
+# Cached course contents are revalidated against changes from this long before they were loaded or last revalidated
+REVALIDATE_MARGIN_SECONDS = int(os.getenv("MOODLE_REVALIDATE_MARGIN_SECONDS", "60"))
+
+
+def is_read_only_wsfunction(function: str) -> bool:
+    """Moodle names read-only web-service functions with a get verb (e.g. core_course_get_contents)."""
+    return '_get_' in function or function.endswith('_get')
+
+
+def _course_ids_from_params(data: Dict) -> List[int]:
+    """Course IDs a web-service call refers to, used to tag and invalidate cache entries"""
+    data = data or {}
+    ids = []
+    for key, value in data.items():
+        if key in ('courseid', 'course_id') or key.startswith('courseids['):
+            ids.append(value)
+    if data.get('field') == 'id' and 'value' in data:
+        ids.append(data['value'])
+    return [int(i) for i in ids if str(i).isdigit()]
+
+
 class MoodleIntegration:
-    def __init__(self, neo4j_graph_memory=None):
+    def __init__(self, neo4j_graph_memory=None, graph_memory_factory=None):
         # Read base URL and token from environment variables. If not set, fall back to the previous defaults.
         # NOTE: Ensure your .env uses KEY=VALUE format (not KEY:VALUE) so python-dotenv can parse it.
         self.base_url = os.getenv('MOODLE_BASE_URL', 'https://teaching-assistant-agent.moodlecloud.com/webservice/rest/server.php')
         self.token = os.getenv('EXTERNAL_MOODLE_TOKEN', '4140e426c7adb15979c0c18ce57bd45d')
-        self.neo4j_graph = neo4j_graph_memory
+        # the graph (Neo4j driver + schema) is only built when a course sync first needs it
+        self._neo4j_graph = neo4j_graph_memory
+        self._graph_memory_factory = graph_memory_factory
+
+        # One pooled keep-alive session for every Moodle (and Apps Script) request
+        self.timeout = (
+            float(os.getenv('MOODLE_CONNECT_TIMEOUT', '5')),
+            float(os.getenv('MOODLE_READ_TIMEOUT', '30'))
+        )
+        self.max_retries = int(os.getenv('MOODLE_MAX_RETRIES', '3'))
+        self.retry_backoff = float(os.getenv('MOODLE_RETRY_BACKOFF', '0.5'))
+        pool_size = int(os.getenv('MOODLE_POOL_SIZE', '10'))
+
+        self.session = TracedSession()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._metrics_lock = threading.Lock()
+        self._api_metrics: Dict[str, Dict[str, float]] = {}
+
+        # Read-through cache for slow-changing read-only calls, invalidated by writes to the same course
+        self.cache_enabled = os.getenv('MOODLE_CACHE_ENABLED', 'true').lower() != 'false'
+        self.cache = TTLCache()
+        self._forum_courses: Dict[int, int] = {}
+        self._sync_manifest = None
+
+        # Streaming downloads: size cap and the auth strategy that last worked per Moodle host
+        self.max_download_bytes = int(os.getenv('MOODLE_MAX_DOWNLOAD_BYTES', str(100 * 1024 * 1024)))
+        self._download_strategies: Dict[str, str] = {}
+
+        # Uploads go to webservice/upload.php as streamed multipart; draft items are reused for identical files
+        self.upload_url = os.getenv(
+            'MOODLE_UPLOAD_URL',
+            self.base_url.split('/webservice/rest/server.php')[0] + '/webservice/upload.php'
+        )
+        self.draft_ttl = int(os.getenv('MOODLE_DRAFT_TTL', '3600'))
+        self._user_id = None
+
+    @property
+    def neo4j_graph(self):
+        if self._neo4j_graph is None and self._graph_memory_factory is not None:
+            self._neo4j_graph = self._graph_memory_factory()
+        return self._neo4j_graph
+
+    @property
+    def sync_manifest(self) -> SyncManifest:
+        """Per-course record of synced files (created on first use)"""
+        if self._sync_manifest is None:
+            self._sync_manifest = SyncManifest()
+        return self._sync_manifest
 
     def make_api_call(self, function: str, data: Dict = None) -> Dict:
-        """Make API call to Moodle"""
+        """Make API call to Moodle, serving cacheable read-only functions from the TTL cache"""
+        ttl = CACHE_TTLS.get(function)
+        if self.cache_enabled and ttl:
+            key = function + ':' + json.dumps(data or {}, sort_keys=True, default=str)
+            tags = [f"course:{course_id}" for course_id in _course_ids_from_params(data)]
+            revalidate = None
+            if function == 'core_course_get_contents':
+                revalidate = lambda entry: self._course_contents_unchanged(data['courseid'], entry)
+            result = self.cache.get_or_load(key, ttl, lambda: self._call(function, data), tags, revalidate)
+            if isinstance(result, dict) and 'exception' in result:
+                # Moodle reports errors in a 200 response; never keep serving them
+                self.cache.invalidate(key)
+            # indexed on hits too: with a shared cache the entry may have been loaded by another worker
+            self._index_result(function, result)
+            return result
+
+        result = self._call(function, data)
+        if self.cache_enabled and not is_read_only_wsfunction(function):
+            self._invalidate_after_write(data)
+        return result
+
+    def _index_result(self, function: str, result):
+        if function == 'mod_forum_get_forums_by_courses' and isinstance(result, list):
+            for forum in result:
+                if 'id' in forum and 'course' in forum:
+                    self._forum_courses[forum['id']] = forum['course']
+
+    def _invalidate_after_write(self, data: Dict = None):
+        course_ids = _course_ids_from_params(data)
+        forum_id = (data or {}).get('forumid')
+        if forum_id in self._forum_courses:
+            course_ids.append(self._forum_courses[forum_id])
+        for course_id in course_ids:
+            self.invalidate_course_cache(course_id)
+
+    def invalidate_course_cache(self, course_id: int) -> int:
+        """Drop cached read results for a course (e.g. after content was changed outside this app)"""
+        return self.cache.invalidate_tag(f"course:{int(course_id)}")
+
+    def _course_contents_unchanged(self, course_id: int, entry: Dict) -> bool:
+        """
+        Ask Moodle which modules changed since the cached contents were loaded or last revalidated
+        (the entry's updated_at, which touch() restamps, less REVALIDATE_MARGIN_SECONDS for the
+        fetch time and clock skew).
+        An empty answer means the cached entry is still valid and need not be refetched.
+        """
+        if not entry.get('updated_at'):
+            return False
+        since = int(entry['updated_at'] - REVALIDATE_MARGIN_SECONDS)
+
+        try:
+            updates = self._call('core_course_get_updates_since', {'courseid': course_id, 'since': since})
+        except Exception as e:
+            print(f"⚠ Could not check course {course_id} for updates: {str(e)}")
+            return False
+        return isinstance(updates, dict) and not updates.get('instances')
+
+    def _call(self, function: str, data: Dict = None) -> Dict:
+        """Send one web-service request to Moodle (one span; each HTTP attempt is a child span)"""
+        with span("moodle", wsfunction=function):
+            return self._call_with_retries(function, data)
+
+    def _call_with_retries(self, function: str, data: Dict = None) -> Dict:
         # The .env value can include the full REST endpoint (server.php). Use it as provided.
         url = self.base_url
         params = {
@@ -40,9 +243,57 @@ class MoodleIntegration:
         if data:
             params.update(data)
 
-        response = requests.post(url, data=params)
-        response.raise_for_status()
-        return response.json()
+        # Writes are only retried when the request never reached Moodle, so they cannot be applied twice
+        idempotent = is_read_only_wsfunction(function)
+        attempt = 0
+        start = time.perf_counter()
+        while True:
+            try:
+                response = self.session.post(url, data=params, timeout=self.timeout)
+                if idempotent and response.status_code in RETRYABLE_STATUSES and attempt < self.max_retries:
+                    raise requests.exceptions.HTTPError(f"HTTP {response.status_code}", response=response)
+                response.raise_for_status()
+                result = response.json()
+                self._record_api_call(function, time.perf_counter() - start, attempt, failed=False)
+                return result
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.HTTPError) as e:
+                safe_to_retry = idempotent or isinstance(e, requests.exceptions.ConnectTimeout)
+                retryable_http = not isinstance(e, requests.exceptions.HTTPError) or (
+                    e.response is not None and e.response.status_code in RETRYABLE_STATUSES
+                )
+                if not (safe_to_retry and retryable_http) or attempt >= self.max_retries:
+                    self._record_api_call(function, time.perf_counter() - start, attempt, failed=True)
+                    raise
+                delay = self.retry_backoff * (2 ** attempt)
+                attempt += 1
+                print(f"⚠ Moodle {function} failed ({str(e)}), retry {attempt}/{self.max_retries} in {delay:.1f}s")
+                time.sleep(delay)
+            except Exception:
+                self._record_api_call(function, time.perf_counter() - start, attempt, failed=True)
+                raise
+
+    def _record_api_call(self, function: str, elapsed: float, retries: int, failed: bool):
+        observe_stage(f"moodle:{function}", elapsed, failed)
+        with self._metrics_lock:
+            stats = self._api_metrics.setdefault(function, {
+                'calls': 0, 'errors': 0, 'retries': 0, 'total_seconds': 0.0, 'max_seconds': 0.0
+            })
+            stats['calls'] += 1
+            stats['errors'] += int(failed)
+            stats['retries'] += retries
+            stats['total_seconds'] += elapsed
+            stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+
+    def get_api_metrics(self) -> Dict[str, Dict[str, float]]:
+        """Per-wsfunction call counts, errors, retries and latency"""
+        with self._metrics_lock:
+            return {
+                function: {
+                    **stats,
+                    'avg_seconds': stats['total_seconds'] / stats['calls'] if stats['calls'] else 0.0
+                }
+                for function, stats in self._api_metrics.items()
+            }
 
     def get_courses(self) -> List[Dict]:
         """Get all courses"""
@@ -76,6 +327,22 @@ class MoodleIntegration:
             'message': message
         })
 
+    def find_forum_discussion(self, forum_id: int, marker: str) -> int:
+        """Return the ID of a recent discussion in the forum whose subject contains marker, if any"""
+        result = self.make_api_call('mod_forum_get_forum_discussions', {
+            'forumid': forum_id,
+            'page': 0,
+            'perpage': 20
+        })
+        for discussion in (result or {}).get('discussions', []) if isinstance(result, dict) else []:
+            if marker in (discussion.get('subject') or discussion.get('name') or ''):
+                return discussion.get('discussion') or discussion.get('id')
+        return None
+
+    def discussion_url(self, discussion_id: int) -> str:
+        site = self.base_url.split('/webservice/rest/server.php')[0]
+        return f"{site}/mod/forum/discuss.php?d={discussion_id}"
+
     def get_user_grades(self, course_id: int, user_id: int = None) -> List[Dict]:
         """Get user grades"""
         params = {'courseid': course_id}
@@ -85,14 +352,22 @@ class MoodleIntegration:
 
     def send_message(self, user_id: int, message: str) -> Dict:
         """Send message to user"""
-        messages = [{
-            'touserid': user_id,
-            'text': message,
-            'textformat': 1
-        }]
-        return self.make_api_call('core_message_send_instant_messages', {
-            'messages': messages
-        })
+        return self.send_instant_messages([{'touserid': user_id, 'text': message}])
+
+    def send_instant_messages(self, messages: List[Dict]) -> List[Dict]:
+        """
+        Send several instant messages in one core_message_send_instant_messages call.
+        Each message needs touserid and text; Moodle answers with one result per message
+        (msgid is -1 and errormessage is set for messages it could not deliver).
+        """
+        params = {}
+        for i, message in enumerate(messages):
+            params[f'messages[{i}][touserid]'] = message['touserid']
+            params[f'messages[{i}][text]'] = message['text']
+            params[f'messages[{i}][textformat]'] = message.get('textformat', 1)
+            if message.get('clientmsgid'):
+                params[f'messages[{i}][clientmsgid]'] = message['clientmsgid']
+        return self.make_api_call('core_message_send_instant_messages', params)
 
     def get_enrolled_students(self, course_id: int) -> List[Dict]:
         """Get all students enrolled in a specific course"""
@@ -214,143 +489,124 @@ class MoodleIntegration:
     def export_quiz_to_pdf(self, quiz_json: dict, output_path: str, include_answer_key: bool = True):
         """
         Export a quiz (already parsed into a dict) to a professional PDF format.
-        """  
-        print(quiz_json)
-        print(output_path)
+        """
         # Ensure directory exists
         directory = os.path.dirname(output_path)
         if directory:
             os.makedirs(directory, exist_ok=True)
 
-        questions = quiz_json.get("questions", [])
-
-        # PDF setup
-        doc = SimpleDocTemplate(output_path, pagesize=A4,
-                                rightMargin=50, leftMargin=50, topMargin=50, bottomMargin=50)
-
-        styles = getSampleStyleSheet()
-        title_style = ParagraphStyle(
-            'QuizTitle', parent=styles['Title'], fontSize=24, spaceAfter=20, alignment=1
-        )
-        question_style = ParagraphStyle(
-            'Question', parent=styles['Heading3'], fontSize=12, spaceAfter=6
-        )
-        option_style = ParagraphStyle(
-            'Option', parent=styles['Normal'], leftIndent=20, fontSize=11, spaceAfter=4
-        )
-        answer_style = ParagraphStyle(
-            'Answer', parent=styles['Normal'], textColor=colors.green,
-            spaceAfter=10, leftIndent=20, fontSize=11
-        )
-
-        elements = []
-
-        # Cover Page
-        elements.append(Paragraph("🎯 AI-Generated Quiz", title_style))
-        elements.append(Spacer(1, 20))
-        elements.append(Paragraph(f"<b>Number of Questions:</b> {len(questions)}", styles["Normal"]))
-        elements.append(Spacer(1, 40))
-
-        # Questions
-        for i, q in enumerate(questions, 1):
-            elements.append(Paragraph(f"{i}. {q['question']}", question_style))
-            for idx, option in enumerate(q.get("options", [])):
-                letter = chr(65 + idx)
-                elements.append(Paragraph(f"{letter}. {option}", option_style))
-            elements.append(Spacer(1, 10))
-
-        # Answer Key
-        if include_answer_key:
-            elements.append(PageBreak())
-            elements.append(Paragraph("Answer Key", title_style))
-            elements.append(Spacer(1, 20))
-            for i, q in enumerate(questions, 1):
-                elements.append(Paragraph(f"{i}. {q['answer']}", answer_style))
-
-        doc.build(elements)
+        from quiz_pdf import render_quiz_pdf  # reportlab is only loaded when a PDF is rendered
+        with open(output_path, 'wb') as f:
+            f.write(render_quiz_pdf(quiz_json, include_answer_key))
         print("PDF created at:", output_path)
         return output_path
 
 
     def upload_file(self, filepath: str, course_id: int, section_num: int = 0) -> dict:
         """
-        Upload PDF to Moodle draft area using core_files_upload.
+        Upload a file to a new Moodle draft area through webservice/upload.php.
+        The file is streamed from disk as multipart, and an identical file uploaded
+        within MOODLE_DRAFT_TTL seconds reuses its existing draft item.
         """
         filename = os.path.basename(filepath)
-        
-        # Upload to draft area first
-        with open(filepath, "rb") as f:
-            file_content = f.read()
-            
-        # Encode file content as base64
-        import base64
-        file_content_base64 = base64.b64encode(file_content).decode('utf-8')
-        
-        # Get user ID
-        user_id = self.get_user_id()
-        
-        params = {
-            "component": "user",
-            "filearea": "draft",
-            "itemid": 0,  # 0 will create a new draft area
-            "filepath": "/",
-            "filename": filename,
-            "filecontent": file_content_base64,
-            "contextlevel": "user",
-            "instanceid": user_id
+        content_hash = self._file_sha256(filepath)
+        return self._upload_cached(content_hash, filename, lambda: self._upload_path_to_draft(filepath))
+
+    def upload_bytes(self, data: bytes, filename: str) -> dict:
+        """Upload in-memory content (e.g. a rendered PDF) to a new draft area without touching disk"""
+        content_hash = hashlib.sha256(data).hexdigest()
+        return self._upload_cached(
+            content_hash, filename,
+            lambda: self._upload_to_draft(BytesIO(data), filename, len(data))
+        )
+
+    def _upload_cached(self, content_hash: str, filename: str, upload) -> dict:
+        try:
+            file_info = self.cache.get_or_load(f"draft:{content_hash}:{filename}", self.draft_ttl, upload)
+        except Exception as e:
+            print(f"❌ Upload of {filename} failed: {str(e)}")
+            return {"success": False, "message": f"Upload failed: {str(e)}"}
+        return self._upload_result(file_info)
+
+    def upload_files(self, filepaths: List[str]) -> dict:
+        """
+        Upload several files into one shared draft area (e.g. for a forum post with
+        multiple attachments). Uploads run one after another over the same pooled connection.
+        """
+        draft_item_id = 0
+        uploaded, errors = [], []
+        for filepath in filepaths:
+            try:
+                file_info = self._upload_path_to_draft(filepath, draft_item_id)
+            except Exception as e:
+                print(f"❌ Upload of {os.path.basename(filepath)} failed: {str(e)}")
+                errors.append({"filename": os.path.basename(filepath), "error": str(e)})
+                continue
+            draft_item_id = file_info.get('itemid', draft_item_id)
+            uploaded.append(self._upload_result(file_info))
+
+        return {
+            "success": not errors and bool(uploaded),
+            "draft_itemid": draft_item_id or None,
+            "files": uploaded,
+            "errors": errors,
+            "message": f"Uploaded {len(uploaded)}/{len(filepaths)} files to draft area {draft_item_id}"
         }
-        
+
+    def _upload_path_to_draft(self, filepath: str, draft_item_id: int = 0) -> Dict:
+        with open(filepath, 'rb') as f:
+            return self._upload_to_draft(f, os.path.basename(filepath), os.path.getsize(filepath), draft_item_id)
+
+    def _upload_to_draft(self, fileobj, filename: str, size: int, draft_item_id: int = 0) -> Dict:
+        """Stream one file to webservice/upload.php; itemid 0 makes Moodle create a new draft area"""
         print(f"Uploading {filename} to draft area...")
-        response = self.make_api_call("core_files_upload", params)
-        
-        # Check if response is a list with file info
-        if response and isinstance(response, list) and len(response) > 0:
-            file_info = response[0]
-            draft_item_id = file_info.get('itemid')
-            file_url = file_info.get('url', '')
-            
-            print(f"✓ File uploaded successfully!")
-            print(f"  Draft itemid: {draft_item_id}")
-            print(f"  URL: {file_url}")
-            
-            return {
-                "success": True,
-                "draft_itemid": draft_item_id,
-                "filename": filename,
-                "url": file_url,
-                "file_info": file_info,
-                "message": f"File uploaded to draft area with itemid: {draft_item_id}"
-            }
-        
-        # If response is a dict (like in your output), it might be the file info directly
-        elif response and isinstance(response, dict) and 'itemid' in response:
-            draft_item_id = response.get('itemid')
-            file_url = response.get('url', '')
-            
-            print(f"✓ File uploaded successfully!")
-            print(f"  Draft itemid: {draft_item_id}")
-            print(f"  URL: {file_url}")
-            
-            return {
-                "success": True,
-                "draft_itemid": draft_item_id,
-                "filename": filename,
-                "url": file_url,
-                "file_info": response,
-                "message": f"File uploaded to draft area with itemid: {draft_item_id}"
-            }
-        
+        body = _MultipartFileBody(
+            {'token': self.token, 'filearea': 'draft', 'itemid': draft_item_id, 'filepath': '/'},
+            'file_1', filename, fileobj, size
+        )
+        response = self.session.post(
+            self.upload_url,
+            data=body,
+            headers={'Content-Type': body.content_type, 'Content-Length': str(len(body))},
+            timeout=self.timeout
+        )
+        response.raise_for_status()
+        result = response.json()
+
+        if isinstance(result, dict) and (result.get('error') or result.get('exception')):
+            raise ValueError(result.get('error') or result.get('message') or result.get('errorcode'))
+        if not isinstance(result, list) or not result or 'itemid' not in result[0]:
+            raise ValueError(f"unexpected response format: {result}")
+
+        file_info = result[0]
+        print(f"✓ File uploaded successfully!")
+        print(f"  Draft itemid: {file_info['itemid']}")
+        return file_info
+
+    def _upload_result(self, file_info: Dict) -> dict:
+        draft_item_id = file_info.get('itemid')
         return {
-            "success": False, 
-            "message": "Upload failed - unexpected response format",
-            "response": response
+            "success": True,
+            "draft_itemid": draft_item_id,
+            "filename": file_info.get('filename'),
+            "url": file_info.get('url', ''),
+            "file_info": file_info,
+            "message": f"File uploaded to draft area with itemid: {draft_item_id}"
         }
 
+    def _file_sha256(self, filepath: str) -> str:
+        digest = hashlib.sha256()
+        with open(filepath, 'rb') as f:
+            for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
 
     def get_user_id(self) -> int:
-        """Get current user's ID."""
-        response = self.make_api_call("core_webservice_get_site_info", {})
-        return response.get('userid')
+        """Get current user's ID (fixed for the token, so looked up once)."""
+        if self._user_id is None:
+            response = self.make_api_call("core_webservice_get_site_info", {})
+            self._user_id = response.get('userid')
+        return self._user_id
 
 
     def post_pdf_to_forum_with_attachment(self, forum_id: int, subject: str, message: str, draft_itemid: int) -> dict:
@@ -452,13 +708,13 @@ class MoodleIntegration:
         This is more reliable than forum attachments.
         """
         
-        # Step 1: Create PDF
-        local_path = f"/tmp/{filename}"
-        self.export_quiz_to_pdf(quiz_json, local_path)
-        print(f"✓ PDF created: {filename}")
+        # Step 1: Render PDF in memory
+        from quiz_pdf import render_quiz_pdf  # reportlab is only loaded when a PDF is rendered
+        pdf_bytes = render_quiz_pdf(quiz_json)
+        print(f"✓ PDF rendered: {filename}")
         
         # Step 2: Upload to Moodle draft area
-        upload_result = self.upload_file(local_path, course_id)
+        upload_result = self.upload_bytes(pdf_bytes, filename)
         
         if not upload_result.get('success'):
             return {"success": False, "message": "Failed to upload PDF"}
@@ -500,62 +756,21 @@ class MoodleIntegration:
         Enhanced with better error handling and data formatting.
         """
         try:
-            script_url = os.getenv('APPS_SCRIPT_WEB_APP_URL', "https://script.google.com/macros/s/AKfycbxQlmRO42rpDCytcXzIIAVXmXoUnQ9SLoZDbw3k9Eu5RWMFZJV1bB7GICM5K7DgQfKz/exec")
-            if not script_url:
-                return {
-                    "success": False, 
-                    "error": "APPS_SCRIPT_WEB_APP_URL not set in environment variables"
-                }
-
-            # Format quiz data for Apps Script
-            formatted_quiz = self._format_quiz_for_google_forms(quiz_data)
-            
-            print(f"📤 Sending quiz data to Google Apps Script...")
-            print(f"📝 Quiz: {formatted_quiz['quiz_title']}")
-            print(f"❓ Questions: {len(formatted_quiz.get('questions', []))}")
+            form = self.create_google_form(quiz_data)
 
-            # Send request to Apps Script
-            response = requests.post(
-                script_url,
-                json=formatted_quiz,
-                headers={'Content-Type': 'application/json'},
-                timeout=30
+            # Post to Moodle forum
+            forum_result = self._post_quiz_to_moodle_forum(
+                forum_id, quiz_data, form['form_url']
             )
 
-            if response.status_code == 200:
-                result = response.json()
-                
-                if result.get('success'):
-                    form_url = result['form_url']
-                    form_id = result['form_id']
-                    
-                    print(f"✅ Google Forms quiz created successfully!")
-                    print(f"🔗 Form URL: {form_url}")
-                    print(f"🆔 Form ID: {form_id}")
-
-                    # Post to Moodle forum
-                    forum_result = self._post_quiz_to_moodle_forum(
-                        forum_id, quiz_data, form_url
-                    )
-
-                    return {
-                        "success": True,
-                        "form_url": form_url,
-                        "form_id": form_id,
-                        "edit_url": result.get('edit_url'),
-                        "forum_discussion_id": forum_result.get('discussionid'),
-                        "message": "Google Forms quiz created and posted to Moodle"
-                    }
-                else:
-                    return {
-                        "success": False, 
-                        "error": f"Apps Script error: {result.get('error', 'Unknown error')}"
-                    }
-            else:
-                return {
-                    "success": False, 
-                    "error": f"HTTP {response.status_code}: {response.text}"
-                }
+            return {
+                "success": True,
+                "form_url": form['form_url'],
+                "form_id": form['form_id'],
+                "edit_url": form.get('edit_url'),
+                "forum_discussion_id": forum_result.get('discussionid'),
+                "message": "Google Forms quiz created and posted to Moodle"
+            }
 
         except requests.exceptions.Timeout:
             return {"success": False, "error": "Request timeout - Apps Script took too long to respond"}
@@ -564,6 +779,47 @@ class MoodleIntegration:
         except Exception as e:
             return {"success": False, "error": f"Unexpected error: {str(e)}"}
 
+    def create_google_form(self, quiz_data: Dict, idempotency_key: str = None) -> Dict:
+        """
+        Create the Google Form through the Apps Script web app and return its form_url, form_id and edit_url.
+        Raises on HTTP or script errors; idempotency_key is passed along as request_id.
+        """
+        script_url = os.getenv('APPS_SCRIPT_WEB_APP_URL', "https://script.google.com/macros/s/AKfycbxQlmRO42rpDCytcXzIIAVXmXoUnQ9SLoZDbw3k9Eu5RWMFZJV1bB7GICM5K7DgQfKz/exec")
+        if not script_url:
+            raise ValueError("APPS_SCRIPT_WEB_APP_URL not set in environment variables")
+
+        # Format quiz data for Apps Script
+        formatted_quiz = self._format_quiz_for_google_forms(quiz_data)
+        if idempotency_key:
+            formatted_quiz['request_id'] = idempotency_key
+
+        print(f"📤 Sending quiz data to Google Apps Script...")
+        print(f"📝 Quiz: {formatted_quiz['quiz_title']}")
+        print(f"❓ Questions: {len(formatted_quiz.get('questions', []))}")
+
+        # Send request to Apps Script
+        response = self.session.post(
+            script_url,
+            json=formatted_quiz,
+            headers={'Content-Type': 'application/json'},
+            timeout=30
+        )
+        if response.status_code != 200:
+            raise ValueError(f"HTTP {response.status_code}: {response.text}")
+
+        result = response.json()
+        if not result.get('success'):
+            raise ValueError(f"Apps Script error: {result.get('error', 'Unknown error')}")
+
+        print(f"✅ Google Forms quiz created successfully!")
+        print(f"🔗 Form URL: {result['form_url']}")
+        print(f"🆔 Form ID: {result['form_id']}")
+        return {
+            'form_url': result['form_url'],
+            'form_id': result['form_id'],
+            'edit_url': result.get('edit_url')
+        }
+
     def _format_quiz_for_google_forms(self, quiz_data: Dict) -> Dict:
         """Format quiz data for Google Forms API"""
         questions = []
@@ -583,8 +839,8 @@ class MoodleIntegration:
             'questions': questions
         }
 
-    def _post_quiz_to_moodle_forum(self, forum_id: int, quiz_data: Dict, form_url: str) -> Dict:
-        """Post the Google Forms quiz link to Moodle forum"""
+    def _post_quiz_to_moodle_forum(self, forum_id: int, quiz_data: Dict, form_url: str, marker: str = "") -> Dict:
+        """Post the Google Forms quiz link to Moodle forum (marker goes in the subject, to find the post again)"""
         
         message = f"""
         <div style="font-family: Arial, sans-serif; padding: 20px;">
@@ -611,6 +867,556 @@ class MoodleIntegration:
 
         return self.post_forum_discussion(
             forum_id=forum_id,  # Default forum ID for quizzes
-            subject=f"Google Forms Quiz: {quiz_data.get('name', 'AI Generated Quiz')}",
+            subject=f"Google Forms Quiz: {quiz_data.get('name', 'AI Generated Quiz')} {marker}".strip(),
             message=message
         )
+
+    def extract_pdf_files_from_course_contents(self, course_data: List[Dict], course_id: int = None) -> List[Dict]:
+        """
+        CORRECTED: Extract all PDF files from Moodle course data.
+        
+        Args:
+            course_data: The JSON response from core_course_get_contents
+            course_id: The Moodle course ID recorded in chunk metadata
+            
+        Returns:
+            List of dictionaries containing PDF information
+        """
+        pdf_files = []
+        
+        for section in course_data:
+            section_id = section.get('id')
+            section_name = section.get('name', 'Unknown Section')
+            
+            # Check if section has modules
+            if 'modules' not in section:
+                continue
+            
+            for module in section['modules']:
+                # Check if module has contents (this is where PDFs are stored)
+                if 'contents' not in module or not module['contents']:
+                    continue
+                
+                # Process each content item in the module
+                for content in module['contents']:
+                    # Check if it's a PDF file
+                    if content.get('mimetype') == 'application/pdf':
+                        pdf_info = {
+                            'doc_id': f"moodle_{section_id}_{module['id']}_{content['filename']}",
+                            'filename': content['filename'],
+                            'fileurl': content['fileurl'],
+                            'filesize': content['filesize'],
+                            'timecreated': content.get('timecreated'),
+                            'timemodified': content.get('timemodified'),
+                            'author': content.get('author', 'Unknown'),
+                            'module_name': module.get('name', 'Unknown Module'),
+                            'section_name': section_name,
+                            'section_id': section_id,
+                            'module_id': module['id'],
+                            'context_id': module.get('contextid'),  # Use module's contextid
+                            'metadata': {
+                                'section': section_name,
+                                'module': module.get('name'),
+                                'author': content.get('author'),
+                                'filesize': content['filesize'],
+                                'timecreated': content.get('timecreated'),
+                                'timemodified': content.get('timemodified'),
+                                'source': 'moodle',
+                                'moodle_url': content['fileurl'].split('?')[0],
+                                'course_id': course_id if course_id is not None else section_id
+                            }
+                        }
+                        pdf_files.append(pdf_info)
+        
+        return pdf_files
+
+    def get_resource_file_url(self, module_id: int, context_id: int) -> str:
+        """
+        Get the downloadable file URL using core_files_get_files API.
+        This uses the core_files_get_files function you have enabled.
+        """
+        try:
+            # Try using core_files_get_files with the context ID
+            result = self.make_api_call(
+                'core_files_get_files',
+                {
+                    'contextid': context_id,
+                    'component': 'mod_resource',
+                    'filearea': 'content',
+                    'itemid': 0
+                }
+            )
+            
+            # Get the file URL from the response
+            if 'files' in result and result['files']:
+                for file_info in result['files']:
+                    if file_info.get('mimetype') == 'application/pdf':
+                        return file_info.get('fileurl')
+            
+        except Exception as e:
+            print(f"    Could not use files API: {e}")
+        
+        return None
+    
+    def download_pdf(self, file_url: str, module_id: int = None, context_id: int = None) -> bytes:
+        """
+        Download a PDF into memory (streamed in fixed-size chunks, subject to the size cap).
+        Prefer download_pdf_to_file for large files.
+        """
+        buffer = BytesIO()
+        self._download(file_url, context_id, buffer)
+        return buffer.getvalue()
+
+    def download_pdf_to_file(self, file_url: str, dest_path: str, module_id: int = None, context_id: int = None) -> Dict:
+        """
+        Stream a PDF straight to disk in fixed-size chunks, hashing it on the way.
+
+        Returns:
+            Dict with path, size and SHA-256 content_hash
+        """
+        try:
+            with open(dest_path, 'wb') as f:
+                result = self._download(file_url, context_id, f)
+        except BaseException:
+            if os.path.exists(dest_path):
+                os.remove(dest_path)
+            raise
+        return {'path': dest_path, **result}
+
+    def _download(self, file_url: str, context_id: int, sink) -> Dict:
+        """
+        Try each auth strategy, starting with the one that last worked for this Moodle host,
+        and stream the first PDF response into sink.
+        """
+        print(f"  Downloading {file_url.split('/')[-1]}...")
+        host = urlparse(file_url).netloc
+        remembered = self._download_strategies.get(host)
+        strategies = [remembered] + [s for s in DOWNLOAD_STRATEGIES if s != remembered] if remembered else DOWNLOAD_STRATEGIES
+
+        for strategy in strategies:
+            sink.seek(0)
+            sink.truncate()
+            try:
+                result = self._try_download_strategy(strategy, file_url, context_id, sink)
+            except DownloadTooLarge:
+                raise
+            except Exception as e:
+                print(f"    ✗ {strategy}: {str(e)}")
+                continue
+            if result is not None:
+                if remembered != strategy:
+                    print(f"    ✓ Success with {strategy}; using it first for {host} from now on")
+                self._download_strategies[host] = strategy
+                return result
+
+        raise ValueError(
+            "All download methods failed. Required admin action:\n"
+            "1. Moodle Admin: Site Administration → Users → Permissions → Define roles\n"
+            "   - Edit 'Web service user' role\n" 
+            "   - Enable: 'moodle/course:view', 'mod/resource:view', 'repository/filesystem:view'\n"
+            "2. Or enable 'Download files' capability for web service user\n"
+            "3. Alternative: Use manual download workaround below"
+        )
+
+    def _try_download_strategy(self, strategy: str, file_url: str, context_id: int, sink) -> Dict:
+        """Stream one strategy's response into sink; returns None if it did not yield a PDF"""
+        if strategy == 'files_api':
+            # The files API returns base64 content inline, so this strategy cannot stream
+            if not context_id:
+                return None
+            result = self.make_api_call('core_files_get_files', {
+                'contextid': context_id,
+                'component': 'mod_resource',
+                'filearea': 'content',
+                'itemid': 0,
+                'returncontents': 1
+            })
+            for file_info in result.get('files', []) if isinstance(result, dict) else []:
+                if file_info.get('mimetype') == 'application/pdf' and file_info.get('content'):
+                    import base64
+                    pdf_content = base64.b64decode(file_info['content'])
+                    if pdf_content.startswith(b'%PDF-'):
+                        return self._stream_into(iter([pdf_content]), sink, None)
+            return None
+
+        if strategy == 'bearer':
+            url = file_url
+            headers = {
+                'Authorization': f'Bearer {self.token}',
+                'User-Agent': 'MoodleBot/1.0',
+                'Accept': 'application/pdf, */*'
+            }
+        elif strategy in ('wstoken', 'token'):
+            url = f"{file_url}{'&' if '?' in file_url else '?'}{strategy}={self.token}"
+            headers = None
+        elif strategy == 'direct':
+            # Format: /webservice/pluginfile.php/{contextid}/mod_resource/content/1/filename.pdf
+            parts = file_url.split('/pluginfile.php/')
+            if len(parts) < 2:
+                return None
+            base_domain = self.base_url.split('/webservice/rest/server.php')[0]
+            url = f"{base_domain}/pluginfile.php/{parts[1]}"
+            headers = None
+        else:
+            return None
+
+        with self.session.get(url, headers=headers, timeout=self.timeout, stream=True, allow_redirects=True) as response:
+            if response.status_code != 200:
+                print(f"    ✗ {strategy}: HTTP {response.status_code}")
+                return None
+            if 'application/json' in response.headers.get('content-type', ''):
+                print(f"    ✗ {strategy}: {response.json().get('errorcode', 'unknown error')}")
+                return None
+            return self._stream_into(
+                response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE),
+                sink,
+                int(response.headers['content-length']) if response.headers.get('content-length', '').isdigit() else None
+            )
+
+    def _stream_into(self, chunks, sink, content_length: int = None) -> Dict:
+        """Copy chunks into sink while hashing; aborts early on non-PDF content or oversized files"""
+        if content_length is not None and content_length > self.max_download_bytes:
+            raise DownloadTooLarge(f"File is {content_length:,} bytes, above the {self.max_download_bytes:,} byte limit")
+
+        digest = hashlib.sha256()
+        size = 0
+        for chunk in chunks:
+            if not chunk:
+                continue
+            if size == 0 and not chunk.startswith(b'%PDF-'):
+                return None
+            size += len(chunk)
+            if size > self.max_download_bytes:
+                raise DownloadTooLarge(f"File exceeds the {self.max_download_bytes:,} byte limit")
+            digest.update(chunk)
+            sink.write(chunk)
+        if size == 0:
+            return None
+        return {'size': size, 'content_hash': digest.hexdigest()}
+
+    def extract_text_from_pdf_file(self, file_path: str) -> str:
+        """
+        Extract text from a local PDF file.
+        
+        Args:
+            file_path: Path to local PDF file
+            
+        Returns:
+            Extracted text as string
+        """
+        try:
+            with open(file_path, 'rb') as f:
+                pdf_content = f.read()
+            return extract_pdf_text(pdf_content)
+        except Exception as e:
+            raise ValueError(f"Failed to extract text from {file_path}: {str(e)}")
+
+    def chunk_text(self, text: str, chunk_size: int = 1000, chunk_overlap: int = 200) -> List[Dict]:
+        """
+        Split text into chunks with overlap.
+        
+        Args:
+            text: The text to chunk
+            chunk_size: Size of each chunk in characters
+            chunk_overlap: Overlap between chunks in characters
+            
+        Returns:
+            List of chunk dictionaries with text and metadata
+        """
+        if not text or len(text.strip()) == 0:
+            return []
+        return list(self.chunk_pages([(1, text)], chunk_size, chunk_overlap))
+
+    def chunk_pages(self, pages: Iterable[Tuple[int, str]], chunk_size: int = 1000,
+                    chunk_overlap: int = 200) -> Iterator[Dict]:
+        """
+        Chunk (page_no, text) pages as they arrive, yielding each chunk as soon as enough text
+        follows it to place its boundary. Pages are joined with newlines, and every chunk
+        records the first and last page it covers (page_start, page_end).
+        """
+        text = ""           # text from char offset `base` onwards
+        base = 0
+        page_starts = []    # (absolute offset, page_no)
+        start = 0
+        chunk_id = 0
+        pages = iter(pages)
+        exhausted = False
+
+        def page_at(offset: int) -> int:
+            index = bisect.bisect_right([o for o, _ in page_starts], offset) - 1
+            return page_starts[max(index, 0)][1]
+
+        while True:
+            total = base + len(text)
+            # A boundary may look up to 50 chars past the nominal end, so wait for that much text
+            if not exhausted and total <= start + chunk_size + 50:
+                try:
+                    page_no, page_text = next(pages)
+                except StopIteration:
+                    exhausted = True
+                    continue
+                if page_starts:
+                    text += "\n"
+                page_starts.append((base + len(text), page_no))
+                text += page_text
+                continue
+
+            if start >= total:
+                break
+
+            # Calculate end position
+            end = start + chunk_size
+            
+            # Adjust end to not break in the middle of a word if possible
+            if end < total:
+                # Try to find a sentence boundary
+                sentence_breaks = ['.', '!', '?', '\n\n', '\n']
+                for break_char in sentence_breaks:
+                    break_pos = text.find(break_char, max(end - 50 - base, 0), end + 50 - base)
+                    if break_pos != -1 and break_pos + base > start + chunk_size // 2:
+                        end = break_pos + base + 1
+                        break
+                else:
+                    # Find word boundary
+                    word_break = text.rfind(' ', start + chunk_size // 2 - base, end - base)
+                    if word_break != -1:
+                        end = word_break + base
+            
+            # Extract chunk
+            chunk_text = text[start - base:end - base].strip()
+            
+            if chunk_text:
+                yield {
+                    'chunk_id': chunk_id,
+                    'text': chunk_text,
+                    'start_char': start,
+                    'end_char': end,
+                    'length': len(chunk_text),
+                    'page_start': page_at(start),
+                    'page_end': page_at(max(start, min(end, total) - 1))
+                }
+                chunk_id += 1
+            
+            # Move to next chunk with overlap
+            start = end - chunk_overlap
+            
+            # Prevent infinite loop
+            if start >= total and exhausted:
+                break
+
+            # Drop text no later chunk can reach
+            if start - base > 4 * chunk_size:
+                cut = start - base - 100
+                text = text[cut:]
+                base += cut
+
+    def cleanup_temp_directory(self, temp_dir: str):
+        """
+        Safely remove temporary directory and all contents.
+        
+        Args:
+            temp_dir: Path to temporary directory to remove
+        """
+        try:
+            if os.path.exists(temp_dir):
+                shutil.rmtree(temp_dir)
+                return True
+        except Exception as e:
+            print(f"Warning: Could not clean up temp directory {temp_dir}: {str(e)}")
+            return False
+
+    def get_current_timestamp(self) -> str:
+        """Get current timestamp in ISO format."""
+        from datetime import datetime
+        return datetime.now().isoformat()
+
+    def generate_text_hash(self, text: str) -> str:
+        """Generate SHA-256 hash of text for duplicate detection."""
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def save_as_graph(self, course_id: int, chunk_size: int = 1000, chunk_overlap: int = 200, progress=None,
+                      full: bool = False):
+        """
+        Enhanced function to download PDFs locally, process with chunking/embedding,
+        save to Neo4j, then clean up local files.
+
+        Syncs are incremental: only files that are new or changed since the last sync
+        (per the course's sync manifest) are downloaded and ingested, and chunks of files
+        removed from Moodle are deleted.
+        
+        Args:
+            course_id: The Moodle course ID
+            chunk_size: Size of text chunks for processing
+            chunk_overlap: Overlap between chunks
+            progress: Optional callback(stage, **data) receiving "files", "chunks"
+                and "batches" progress events (used by the background job queue)
+            full: Re-ingest every file, ignoring the manifest
+        """
+        progress = progress or (lambda stage, **data: None)
+        print(f"\n{'='*60}")
+        print(f"Starting Enhanced Moodle to Neo4j Processing")
+        print(f"Course ID: {course_id}")
+        print(f"Chunk Size: {chunk_size}, Overlap: {chunk_overlap}")
+        print(f"{'='*60}\n")
+        
+        # Check if Neo4j graph memory is initialized
+        if self.neo4j_graph is None:
+            raise ValueError("Neo4j graph memory not initialized. Pass it during __init__")
+        
+        # Create temporary directory for downloads
+        temp_dir = tempfile.mkdtemp(prefix="moodle_pdfs_")
+        print(f"Created temporary directory: {temp_dir}")
+        
+        try:
+            # Step 1: Get course contents (bypassing the read cache - a sync must see the live listing)
+            print("Step 1: Fetching course contents from Moodle...")
+            sync_started_at = time.time()
+            self.invalidate_course_cache(course_id)
+            course_content = self.get_course_contents(course_id)
+            print(f"  ✓ Retrieved {len(course_content)} sections")
+            
+            # Step 2: Extract PDF files
+            print("\nStep 2: Extracting PDF information...")
+            pdf_files = self.extract_pdf_files_from_course_contents(course_content, course_id=course_id)
+            progress("files", phase="listed", total=len(pdf_files))
+
+            # Compare against the manifest; drop chunks of files that disappeared from Moodle
+            manifest = self.sync_manifest
+            changes = manifest.diff(course_id, pdf_files)
+            known = manifest.files(course_id)
+            for doc_id in changes['removed']:
+                self.neo4j_graph.delete_document(doc_id, invalidate=False)
+                manifest.remove(course_id, doc_id)
+            to_sync = pdf_files if full else changes['new'] + changes['changed']
+            print(f"  Manifest: {len(changes['new'])} new, {len(changes['changed'])} changed, "
+                  f"{len(changes['unchanged'])} unchanged, {len(changes['removed'])} removed")
+            progress("files", phase="diffed", new=len(changes['new']), changed=len(changes['changed']),
+                     unchanged=len(changes['unchanged']), removed=len(changes['removed']))
+            
+            if not to_sync:
+                print("  ⚠ No new or changed PDF files in this course")
+                manifest.mark_synced(course_id, sync_started_at)
+                return {
+                    'total_pdfs': len(pdf_files),
+                    'successful': 0,
+                    'failed': 0,
+                    'unchanged': len(changes['unchanged']),
+                    'removed': len(changes['removed']),
+                    'pdf_files': []
+                }
+            
+            print(f"  ✓ Syncing {len(to_sync)} PDF files\n")
+            for pdf in to_sync:
+                print(f"  - {pdf['filename']} ({pdf['filesize']:,} bytes)")
+                print(f"    Section: {pdf['section_name']}")
+                print(f"    Module: {pdf['module_name']}")
+            
+            # Steps 3-4: Download, extract, chunk, embed and write through the staged pipeline
+            print(f"\nStep 3: Running download → extract → chunk → embed → write pipeline...")
+            print(f"{'='*60}")
+
+            pipeline = CourseSyncPipeline(
+                moodle=self,
+                graph_memory=self.neo4j_graph,
+                temp_dir=temp_dir,
+                chunk_size=chunk_size,
+                chunk_overlap=chunk_overlap,
+                progress=progress,
+                known_hashes={} if full else {doc_id: f['content_hash'] for doc_id, f in known.items()}
+            )
+            summary = pipeline.run(to_sync)
+
+            # Record what is now in the graph; files whose bytes were unchanged only get new metadata
+            unchanged_files = summary.pop('unchanged_files')
+            for f in summary.pop('synced_files'):
+                manifest.record(course_id, f, f['content_hash'], f['chunks'])
+            for f in unchanged_files:
+                manifest.record(course_id, f, f['content_hash'], known[f['doc_id']]['chunks'])
+            if not summary['errors']:
+                manifest.mark_synced(course_id, sync_started_at)
+            else:
+                # files that failed are retried by the scheduler, with backoff
+                manifest.mark_failed(course_id)
+            
+            # Step 5: Clean up local files (the finally block below does the work)
+            print(f"\nStep 5: Cleaning up local files...")
+            
+            # Final summary
+            print(f"\n{'='*60}")
+            print(f"Processing Complete!")
+            print(f"{'='*60}")
+            print(f"  Total PDFs found: {len(pdf_files)}")
+            print(f"  Needing sync: {len(to_sync)}")
+            print(f"  Successfully downloaded: {summary['downloaded']}")
+            print(f"  Successfully processed: {summary['successful']}")
+            print(f"  Failed: {summary['failed']}")
+            print(f"  Total chunks created: {summary['total_chunks']}")
+            print(f"  Boilerplate stripped: {summary['boilerplate']['chunks_saved']} chunks, "
+                  f"~{summary['boilerplate']['tokens_saved']:,} tokens saved")
+            
+            if summary['errors']:
+                print(f"\nErrors encountered:")
+                for error in summary['errors']:
+                    print(f"  - {error}")
+            
+            print(f"{'='*60}\n")
+            
+            return {
+                'total_pdfs': len(pdf_files),
+                **summary,
+                'unchanged': len(pdf_files) - len(to_sync) + len(unchanged_files),
+                'removed': len(changes['removed']),
+                'temp_dir': temp_dir
+            }
+
+        except Exception:
+            self.sync_manifest.mark_failed(course_id)
+            raise
+        finally:
+            # Deletes and writes above kept the embedding matrix; rebuild it once per sync
+            self.neo4j_graph.invalidate_embedding_matrix()
+            # Ensure cleanup even if the main process fails or the job is cancelled
+            self.cleanup_temp_directory(temp_dir)
+            print(f"  ✓ Temporary directory cleaned: {temp_dir}")
+        
+
+    def debug_course_structure(self, course_id: int):
+        """
+        Debug method to see the actual course structure and find PDFs.
+        """
+        print(f"\n{'='*60}")
+        print(f"DEBUG: Course Structure Analysis")
+        print(f"{'='*60}")
+        
+        course_content = self.get_course_contents(course_id)
+        
+        for i, section in enumerate(course_content):
+            print(f"\nSection {i}: {section.get('name')} (ID: {section.get('id')})")
+            
+            if 'modules' in section:
+                for j, module in enumerate(section['modules']):
+                    print(f"  Module {j}: {module.get('name')} (Type: {module.get('modname')})")
+                    print(f"    Context ID: {module.get('contextid')}")
+                    print(f"    Module ID: {module.get('id')}")
+                    
+                    if 'contents' in module and module['contents']:
+                        print(f"    Contents found: {len(module['contents'])}")
+                        for k, content in enumerate(module['contents']):
+                            print(f"      Content {k}: {content.get('filename')}")
+                            print(f"        MIME Type: {content.get('mimetype')}")
+                            print(f"        File URL: {content.get('fileurl')}")
+                            print(f"        Size: {content.get('filesize')} bytes")
+                    else:
+                        print(f"    No contents in this module")
+        
+        print(f"\n{'='*60}")
+        print(f"Testing PDF extraction...")
+        
+        pdf_files = self.extract_pdf_files_from_course_contents(course_content)
+        print(f"Found {len(pdf_files)} PDF files:")
+        
+        for pdf in pdf_files:
+            print(f"  - {pdf['filename']}")
+            print(f"    Context ID: {pdf.get('context_id')}")
+            print(f"    Module ID: {pdf.get('module_id')}")
+            print(f"    File URL: {pdf['fileurl'][:100]}...")
@@ -0,0 +1,240 @@
+# app/publish_outbox.py
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional
+
+
+class PermanentPublishError(Exception):
+    """Raised by a deliver function when retrying cannot help (e.g. Moodle rejected the post)"""
+
+
+class PublishOutbox:
+    """
+    Durable queue of confirmed publish actions (quizzes, announcements).
+    Confirmations are written to SQLite and return at once; a background worker delivers them
+    with exponential backoff. Each entry keeps a checkpoint dict that the deliver function updates
+    as external steps succeed, so a retry never repeats a step that already happened.
+
+    Workers claim an entry with a conditional UPDATE, so one entry is delivered by one worker even
+    when several processes share the database. A claim is a lease, renewed every lease_seconds / 4
+    while the deliver function runs: an entry whose lease is lease_seconds old belongs to a worker
+    that died and is claimed again. A worker only records the outcome while it still holds the lease.
+    """
+
+    def __init__(self, deliver: Callable[[str, Dict[str, Any], Dict[str, Any], str], Dict[str, Any]],
+                 db_path: str = None, max_attempts: int = None, retry_backoff: float = None):
+        self.deliver = deliver
+        self.db_path = db_path or os.getenv("OUTBOX_DB_PATH", "outbox.db")
+        self.max_attempts = max_attempts or int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+        self.retry_backoff = retry_backoff or float(os.getenv("OUTBOX_RETRY_BACKOFF", "2.0"))
+        self.lease_seconds = float(os.getenv("OUTBOX_LEASE_SECONDS", "300"))
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._init_db()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _init_db(self):
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    outbox_id TEXT PRIMARY KEY,
+                    idempotency_key TEXT UNIQUE NOT NULL,
+                    kind TEXT NOT NULL,
+                    payload_json TEXT NOT NULL,
+                    checkpoint_json TEXT,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    result_json TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)")
+
+    def enqueue(self, kind: str, payload: Dict[str, Any], idempotency_key: str = None) -> Dict[str, Any]:
+        """
+        Persist a publish action and wake the worker. Enqueueing the same idempotency_key
+        again (e.g. a double-clicked confirm) returns the existing entry.
+        """
+        idempotency_key = idempotency_key or uuid.uuid4().hex
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT * FROM outbox WHERE idempotency_key = ?", (idempotency_key,)).fetchone()
+            if row is None:
+                outbox_id = uuid.uuid4().hex
+                conn.execute(
+                    "INSERT INTO outbox (outbox_id, idempotency_key, kind, payload_json, checkpoint_json, status, "
+                    "next_attempt_at, created_at, updated_at) VALUES (?, ?, ?, ?, '{}', 'pending', ?, ?, ?)",
+                    (outbox_id, idempotency_key, kind, json.dumps(payload, default=str), now, now, now)
+                )
+                row = conn.execute("SELECT * FROM outbox WHERE outbox_id = ?", (outbox_id,)).fetchone()
+        self.start()
+        self._wake.set()
+        return self._row_to_dict(row)
+
+    def get(self, outbox_id: str) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM outbox WHERE outbox_id = ?", (outbox_id,)).fetchone()
+        return self._row_to_dict(row) if row else None
+
+    def list(self, limit: int = 50) -> List[Dict[str, Any]]:
+        with self._connect() as conn:
+            rows = conn.execute("SELECT * FROM outbox ORDER BY created_at DESC LIMIT ?", (limit,)).fetchall()
+        return [self._row_to_dict(row) for row in rows]
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._loop, name="publish-outbox", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            row = self._claim_due()
+            if row is not None:
+                self._deliver(row)
+                continue
+            self._wake.wait(self._seconds_until_next())
+            self._wake.clear()
+
+    def _claim_due(self) -> Optional[sqlite3.Row]:
+        """
+        Claim the next due entry, or one whose delivery lease expired. The UPDATE only succeeds
+        if the row is unchanged since it was read, so two workers can never claim the same entry.
+        """
+        with self._lock, self._connect() as conn:
+            while True:
+                now = time.time()
+                row = conn.execute(
+                    "SELECT * FROM outbox WHERE (status = 'pending' AND next_attempt_at <= ?) "
+                    "OR (status = 'delivering' AND updated_at <= ?) ORDER BY next_attempt_at LIMIT 1",
+                    (now, now - self.lease_seconds)
+                ).fetchone()
+                if row is None:
+                    return None
+                checkpoint_json = row["checkpoint_json"]
+                if row["status"] == "delivering":
+                    # the previous worker died mid-delivery; "recovered" tells the retry to check for a half-done step
+                    checkpoint_json = json.dumps({**json.loads(checkpoint_json or "{}"), "recovered": True})
+                claimed = conn.execute(
+                    "UPDATE outbox SET status = 'delivering', checkpoint_json = ?, updated_at = ? "
+                    "WHERE outbox_id = ? AND status = ? AND updated_at = ?",
+                    (checkpoint_json, now, row["outbox_id"], row["status"], row["updated_at"])
+                )
+                conn.commit()
+                if claimed.rowcount == 1:
+                    return conn.execute("SELECT * FROM outbox WHERE outbox_id = ?", (row["outbox_id"],)).fetchone()
+
+    def _seconds_until_next(self) -> float:
+        with self._connect() as conn:
+            pending = conn.execute("SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'pending'").fetchone()[0]
+            leased = conn.execute("SELECT MIN(updated_at) FROM outbox WHERE status = 'delivering'").fetchone()[0]
+        due = [t for t in (pending, leased + self.lease_seconds if leased is not None else None) if t is not None]
+        if not due:
+            return 60.0
+        return max(0.0, min(60.0, min(due) - time.time()))
+
+    def _deliver(self, row: sqlite3.Row):
+        outbox_id = row["outbox_id"]
+        attempts = row["attempts"] + 1
+        checkpoint = json.loads(row["checkpoint_json"] or "{}")
+        lease = {"updated_at": row["updated_at"]}
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self._renew_lease, args=(outbox_id, lease, done),
+                                     name="publish-outbox-lease", daemon=True)
+        heartbeat.start()
+        error = None
+        try:
+            result = self.deliver(row["kind"], json.loads(row["payload_json"]), checkpoint, row["idempotency_key"])
+        except Exception as e:
+            error = e
+        finally:
+            done.set()
+            heartbeat.join()
+
+        if error is not None:
+            permanent = isinstance(error, PermanentPublishError) or attempts >= self.max_attempts
+            delay = self.retry_backoff * (2 ** (attempts - 1))
+            recorded = self._update(
+                outbox_id,
+                lease["updated_at"],
+                status="failed" if permanent else "pending",
+                attempts=attempts,
+                checkpoint_json=json.dumps(checkpoint, default=str),
+                next_attempt_at=time.time() + delay,
+                error=str(error)
+            )
+            if not recorded:
+                print(f"⚠ Publish {outbox_id} ({row['kind']}) failed ({str(error)}) after another worker took it over")
+            elif permanent:
+                print(f"❌ Publish {outbox_id} ({row['kind']}) failed for good: {str(error)}")
+            else:
+                print(f"⚠ Publish {outbox_id} ({row['kind']}) failed ({str(error)}), retry {attempts} in {delay:.1f}s")
+            return
+
+        recorded = self._update(
+            outbox_id,
+            lease["updated_at"],
+            status="delivered",
+            attempts=attempts,
+            checkpoint_json=json.dumps(checkpoint, default=str),
+            result_json=json.dumps(result, default=str),
+            error=None
+        )
+        if recorded:
+            print(f"✅ Published {outbox_id} ({row['kind']})")
+        else:
+            print(f"⚠ Published {outbox_id} ({row['kind']}) after another worker took it over; its outcome stands")
+
+    def _renew_lease(self, outbox_id: str, lease: Dict[str, float], done: threading.Event):
+        """Keep the claim fresh while deliver() runs; stops once another worker has taken the entry"""
+        while not done.wait(self.lease_seconds / 4):
+            now = time.time()
+            try:
+                with self._lock, self._connect() as conn:
+                    renewed = conn.execute(
+                        "UPDATE outbox SET updated_at = ? WHERE outbox_id = ? AND status = 'delivering' AND updated_at = ?",
+                        (now, outbox_id, lease["updated_at"])
+                    ).rowcount == 1
+            except Exception as e:
+                print(f"⚠ Renewing outbox lease for {outbox_id} failed: {e}")
+                continue
+            if not renewed:
+                print(f"⚠ Outbox entry {outbox_id} was claimed by another worker")
+                return
+            lease["updated_at"] = now
+
+    def _update(self, outbox_id: str, claimed_at: float, **fields) -> bool:
+        """Record a delivery outcome, only if the entry is still leased to us (updated_at is our last heartbeat)"""
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{key} = ?" for key in fields)
+        with self._lock, self._connect() as conn:
+            updated = conn.execute(
+                f"UPDATE outbox SET {assignments} WHERE outbox_id = ? AND status = 'delivering' AND updated_at = ?",
+                (*fields.values(), outbox_id, claimed_at)
+            )
+            return updated.rowcount == 1
+
+    def _row_to_dict(self, row: sqlite3.Row) -> Dict[str, Any]:
+        entry = dict(row)
+        entry.pop("payload_json", None)
+        entry["checkpoint"] = json.loads(entry.pop("checkpoint_json") or "{}")
+        entry["result"] = json.loads(entry.pop("result_json") or "null")
+        return entry
@@ -0,0 +1,79 @@
+# app/quiz_pdf.py
+import os
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from typing import Dict, List
+
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
+from reportlab.platypus import PageBreak, Paragraph, SimpleDocTemplate, Spacer
+
+# Styles are immutable once built, so one set is shared by every render in the process
+_STYLES = None
+
+
+def _get_styles() -> Dict[str, ParagraphStyle]:
+    global _STYLES
+    if _STYLES is None:
+        base = getSampleStyleSheet()
+        _STYLES = {
+            "normal": base["Normal"],
+            "title": ParagraphStyle('QuizTitle', parent=base['Title'], fontSize=24, spaceAfter=20, alignment=1),
+            "question": ParagraphStyle('Question', parent=base['Heading3'], fontSize=12, spaceAfter=6),
+            "option": ParagraphStyle('Option', parent=base['Normal'], leftIndent=20, fontSize=11, spaceAfter=4),
+            "answer": ParagraphStyle('Answer', parent=base['Normal'], textColor=colors.green,
+                                     spaceAfter=10, leftIndent=20, fontSize=11),
+        }
+    return _STYLES
+
+
+def render_quiz_pdf(quiz_json: Dict, include_answer_key: bool = True) -> bytes:
+    """Render a parsed quiz to PDF bytes in memory (top-level so it can run in a process pool)."""
+    styles = _get_styles()
+    questions = quiz_json.get("questions", [])
+
+    buffer = BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4,
+                            rightMargin=50, leftMargin=50, topMargin=50, bottomMargin=50)
+
+    elements = []
+
+    # Cover Page
+    elements.append(Paragraph("🎯 AI-Generated Quiz", styles["title"]))
+    elements.append(Spacer(1, 20))
+    elements.append(Paragraph(f"<b>Number of Questions:</b> {len(questions)}", styles["normal"]))
+    elements.append(Spacer(1, 40))
+
+    # Questions
+    for i, q in enumerate(questions, 1):
+        elements.append(Paragraph(f"{i}. {q['question']}", styles["question"]))
+        for idx, option in enumerate(q.get("options", [])):
+            letter = chr(65 + idx)
+            elements.append(Paragraph(f"{letter}. {option}", styles["option"]))
+        elements.append(Spacer(1, 10))
+
+    # Answer Key
+    if include_answer_key:
+        elements.append(PageBreak())
+        elements.append(Paragraph("Answer Key", styles["title"]))
+        elements.append(Spacer(1, 20))
+        for i, q in enumerate(questions, 1):
+            elements.append(Paragraph(f"{i}. {q['answer']}", styles["answer"]))
+
+    doc.build(elements)
+    return buffer.getvalue()
+
+
+def render_quiz_pdfs(quizzes: List[Dict], include_answer_key: bool = True, max_workers: int = None) -> List[bytes]:
+    """
+    Render many quizzes (e.g. one variant per section), in a process pool when there is more
+    than one, since ReportLab layout is CPU-bound. Results keep the order of quizzes.
+    """
+    max_workers = max_workers or int(os.getenv("QUIZ_RENDER_WORKERS", str(min(4, os.cpu_count() or 1))))
+    if len(quizzes) < 2 or max_workers < 2:
+        return [render_quiz_pdf(quiz, include_answer_key) for quiz in quizzes]
+
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(quizzes))) as pool:
+        return list(pool.map(render_quiz_pdf, quizzes, [include_answer_key] * len(quizzes)))
+
@@ -0,0 +1,76 @@
+# app/startup_benchmark.py
+"""
+Cold-start benchmark: imports an app module in fresh interpreters with `python -X importtime`
+and reports wall time, the slowest imports and any heavy library loaded at import time.
+
+    python startup_benchmark.py [module] [--runs N] [--budget-ms MS]
+
+Exits non-zero when the median import time exceeds the budget or a deferred library
+(openai, neo4j, reportlab, PyPDF2, numpy, fpdf) is imported eagerly again.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+DEFERRED_MODULES = ("openai", "neo4j", "reportlab", "PyPDF2", "numpy", "fpdf")
+
+
+def run_importtime(module: str) -> List[Tuple[int, str]]:
+    """(cumulative microseconds, module) for every import made while importing module"""
+    env = {**os.environ, "OPENAI_API_KEY": os.getenv("OPENAI_API_KEY", "benchmark")}
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True
+    )
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        imports.append((int(cumulative), name.rstrip()))
+    return imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("module", nargs="?", default="main")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=float(os.getenv("STARTUP_BUDGET_MS", "1500")))
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    totals, slowest = [], {}
+    eager = set()
+    for _ in range(args.runs):
+        imports = run_importtime(args.module)
+        top_level: Dict[str, int] = {name.strip(): us for us, name in imports if not name.startswith("  ")}
+        totals.append(top_level.get(args.module, max(us for us, _ in imports)) / 1000)
+        for us, name in imports:
+            stripped = name.strip()
+            slowest[stripped] = max(slowest.get(stripped, 0), us)
+            if stripped in DEFERRED_MODULES:
+                eager.add(stripped)
+
+    median = statistics.median(totals)
+    print(f"⏱ import {args.module}: median {median:.0f} ms over {args.runs} runs "
+          f"(min {min(totals):.0f}, max {max(totals):.0f})")
+    print("Slowest imports (cumulative):")
+    for name, us in sorted(slowest.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"  {us / 1000:8.1f} ms  {name}")
+
+    failed = False
+    if eager:
+        print(f"❌ Loaded at import time but should be deferred: {', '.join(sorted(eager))}")
+        failed = True
+    if median > args.budget_ms:
+        print(f"❌ Over the {args.budget_ms:.0f} ms startup budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,332 @@
+# app/state_backend.py
+import copy
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Optional
+
+
+class StateBackend:
+    """
+    Namespaced key-value store for state that must survive across requests: conversation memory,
+    generated artifacts and read caches. Entries carry an optional expiry and tags.
+
+    get() hides expired entries; get_entry() still returns them (with expires_at) so callers such
+    as TTLCache can revalidate a stale value instead of reloading it. Expired entries are purged
+    right away, except in namespaces registered with keep_stale(), where they are kept for
+    stale_grace seconds for revalidation. Values must be JSON-serializable.
+    """
+
+    # True when several worker processes see the same state
+    shared = False
+    stale_namespaces = frozenset()
+    stale_grace = float(os.getenv("STATE_STALE_GRACE", "86400"))
+
+    def keep_stale(self, namespace: str):
+        """Keep expired entries of namespace for stale_grace seconds (for callers that revalidate them)"""
+        self.stale_namespaces = self.stale_namespaces | {namespace}
+
+    def _purge_cutoff(self, namespace: str, now: float) -> float:
+        """Entries of namespace that expired before this time can be purged"""
+        return now - self.stale_grace if namespace in self.stale_namespaces else now
+
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        entry = self.get_entry(namespace, key)
+        if entry is None or (entry["expires_at"] is not None and entry["expires_at"] <= time.time()):
+            return None
+        return entry["value"]
+
+    def get_entry(self, namespace: str, key: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def set(self, namespace: str, key: str, value: Any, ttl: float = None, tags: Iterable[str] = ()):
+        raise NotImplementedError
+
+    def update(self, namespace: str, key: str, fn: Callable[[Optional[Any]], Any], ttl: float = None) -> Any:
+        """Atomically replace the value with fn(current value or None) and return the new value"""
+        raise NotImplementedError
+
+    def touch(self, namespace: str, key: str, ttl: float):
+        """
+        Push an entry's expiry ttl seconds into the future and stamp it updated now: its value was
+        just confirmed current (e.g. revalidated), so it counts as fresh for updated_at readers and LRU
+        """
+        raise NotImplementedError
+
+    def delete(self, namespace: str, key: str) -> bool:
+        raise NotImplementedError
+
+    def pop(self, namespace: str, key: str) -> Optional[Any]:
+        """Atomically remove an entry and return its value (None if missing or expired); only one caller gets it"""
+        raise NotImplementedError
+
+    def delete_tag(self, namespace: str, tag: str) -> int:
+        raise NotImplementedError
+
+    def clear(self, namespace: str):
+        raise NotImplementedError
+
+    def count(self, namespace: str) -> int:
+        raise NotImplementedError
+
+    def evict_lru(self, namespace: str, max_entries: int) -> int:
+        """Drop the least recently written entries beyond max_entries; returns how many were removed"""
+        raise NotImplementedError
+
+
+class InProcessBackend(StateBackend):
+    """State in a dict of this process (the default; right for a single uvicorn worker)"""
+
+    def __init__(self):
+        self._entries: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._lock = threading.RLock()
+        self.purge_interval = float(os.getenv("STATE_PURGE_SECONDS", "60"))
+        self._next_purge = time.time() + self.purge_interval
+
+    def _namespace(self, namespace: str) -> Dict[str, Dict[str, Any]]:
+        return self._entries.setdefault(namespace, {})
+
+    def get_entry(self, namespace: str, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entries = self._namespace(namespace)
+            entry = entries.get(key)
+            if entry is not None and entry["expires_at"] is not None \
+                    and entry["expires_at"] < self._purge_cutoff(namespace, time.time()):
+                del entries[key]
+                return None
+            return copy.deepcopy(entry) if entry is not None else None
+
+    def purge_expired(self) -> int:
+        """Drop expired entries in every namespace; returns how many were removed"""
+        now = time.time()
+        removed = 0
+        with self._lock:
+            self._next_purge = now + self.purge_interval
+            for namespace, entries in self._entries.items():
+                cutoff = self._purge_cutoff(namespace, now)
+                expired = [key for key, entry in entries.items()
+                           if entry["expires_at"] is not None and entry["expires_at"] < cutoff]
+                for key in expired:
+                    del entries[key]
+                removed += len(expired)
+        return removed
+
+    def set(self, namespace: str, key: str, value: Any, ttl: float = None, tags: Iterable[str] = ()):
+        now = time.time()
+        with self._lock:
+            entries = self._namespace(namespace)
+            entries.pop(key, None)
+            entries[key] = {
+                "value": copy.deepcopy(value),
+                "expires_at": now + ttl if ttl else None,
+                "updated_at": now,
+                "tags": sorted(set(tags)),
+            }
+            if now >= self._next_purge:
+                self.purge_expired()
+
+    def update(self, namespace: str, key: str, fn: Callable[[Optional[Any]], Any], ttl: float = None) -> Any:
+        with self._lock:
+            value = fn(self.get(namespace, key))
+            self.set(namespace, key, value, ttl)
+            return value
+
+    def touch(self, namespace: str, key: str, ttl: float):
+        with self._lock:
+            entries = self._namespace(namespace)
+            entry = entries.pop(key, None)
+            if entry is not None:
+                # re-inserted, as set() does, so evict_lru sees it as just written
+                entries[key] = entry
+                now = time.time()
+                entry["expires_at"] = now + ttl
+                entry["updated_at"] = now
+
+    def delete(self, namespace: str, key: str) -> bool:
+        with self._lock:
+            return self._namespace(namespace).pop(key, None) is not None
+
+    def pop(self, namespace: str, key: str) -> Optional[Any]:
+        with self._lock:
+            value = self.get(namespace, key)
+            self.delete(namespace, key)
+            return value
+
+    def delete_tag(self, namespace: str, tag: str) -> int:
+        with self._lock:
+            entries = self._namespace(namespace)
+            keys = [key for key, entry in entries.items() if tag in entry["tags"]]
+            for key in keys:
+                del entries[key]
+            return len(keys)
+
+    def clear(self, namespace: str):
+        with self._lock:
+            self._namespace(namespace).clear()
+
+    def count(self, namespace: str) -> int:
+        with self._lock:
+            return len(self._namespace(namespace))
+
+    def evict_lru(self, namespace: str, max_entries: int) -> int:
+        with self._lock:
+            entries = self._namespace(namespace)
+            # dicts keep insertion order and set() re-inserts, so the oldest writes come first
+            excess = list(entries)[:max(0, len(entries) - max_entries)]
+            for key in excess:
+                del entries[key]
+            return len(excess)
+
+
+class SQLiteBackend(StateBackend):
+    """
+    State in a local SQLite database in WAL mode, shared by every worker process on the host
+    (uvicorn --workers N). Expired entries are purged every 500 writes (after STATE_STALE_GRACE
+    seconds in keep_stale() namespaces).
+    """
+
+    shared = True
+
+    def __init__(self, db_path: str = None, stale_grace: float = None):
+        self.db_path = db_path or os.getenv("STATE_DB_PATH", "state.db")
+        self.stale_grace = stale_grace or self.stale_grace
+        self._local = threading.local()
+        self._writes = 0
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS state (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value_json TEXT NOT NULL,
+                    expires_at REAL,
+                    updated_at REAL NOT NULL,
+                    tags TEXT NOT NULL DEFAULT '',
+                    PRIMARY KEY (namespace, key)
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS state_lru ON state (namespace, updated_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        # one connection per thread; autocommit, with explicit transactions where atomicity matters
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get_entry(self, namespace: str, key: str) -> Optional[Dict[str, Any]]:
+        row = self._connect().execute(
+            "SELECT value_json, expires_at, updated_at, tags FROM state WHERE namespace = ? AND key = ?",
+            (namespace, key)
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "value": json.loads(row[0]),
+            "expires_at": row[1],
+            "updated_at": row[2],
+            "tags": [tag for tag in row[3].strip("|").split("|") if tag],
+        }
+
+    def _write(self, conn: sqlite3.Connection, namespace: str, key: str, value: Any, ttl: float, tags: Iterable[str]):
+        now = time.time()
+        # tags are stored as |a|b| so one LIKE finds an exact tag
+        tag_text = "|" + "|".join(sorted(set(tags))) + "|" if tags else ""
+        conn.execute(
+            "INSERT OR REPLACE INTO state (namespace, key, value_json, expires_at, updated_at, tags) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (namespace, key, json.dumps(value, default=str), now + ttl if ttl else None, now, tag_text)
+        )
+        self._writes += 1
+        if self._writes % 500 == 0:
+            self.purge_expired(conn)
+
+    def purge_expired(self, conn: sqlite3.Connection = None) -> int:
+        """Drop expired entries (stale ones after stale_grace); returns how many were removed"""
+        now = time.time()
+        keep = sorted(self.stale_namespaces)
+        cursor = (conn or self._connect()).execute(
+            "DELETE FROM state WHERE expires_at IS NOT NULL AND expires_at < CASE WHEN namespace IN "
+            f"({', '.join('?' * len(keep)) or 'NULL'}) THEN ? ELSE ? END",
+            (*keep, now - self.stale_grace, now)
+        )
+        return cursor.rowcount
+
+    def set(self, namespace: str, key: str, value: Any, ttl: float = None, tags: Iterable[str] = ()):
+        self._write(self._connect(), namespace, key, value, ttl, list(tags))
+
+    def update(self, namespace: str, key: str, fn: Callable[[Optional[Any]], Any], ttl: float = None) -> Any:
+        conn = self._connect()
+        # BEGIN IMMEDIATE takes the write lock up front, so concurrent workers serialize here
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            value = fn(self.get(namespace, key))
+            self._write(conn, namespace, key, value, ttl, ())
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return value
+
+    def touch(self, namespace: str, key: str, ttl: float):
+        now = time.time()
+        self._connect().execute("UPDATE state SET expires_at = ?, updated_at = ? WHERE namespace = ? AND key = ?",
+                                (now + ttl, now, namespace, key))
+
+    def delete(self, namespace: str, key: str) -> bool:
+        cursor = self._connect().execute("DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, key))
+        return cursor.rowcount > 0
+
+    def pop(self, namespace: str, key: str) -> Optional[Any]:
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            value = self.get(namespace, key)
+            conn.execute("DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, key))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return value
+
+    def delete_tag(self, namespace: str, tag: str) -> int:
+        cursor = self._connect().execute("DELETE FROM state WHERE namespace = ? AND tags LIKE ?",
+                                         (namespace, f"%|{tag}|%"))
+        return cursor.rowcount
+
+    def clear(self, namespace: str):
+        self._connect().execute("DELETE FROM state WHERE namespace = ?", (namespace,))
+
+    def count(self, namespace: str) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM state WHERE namespace = ?", (namespace,)).fetchone()[0]
+
+    def evict_lru(self, namespace: str, max_entries: int) -> int:
+        cursor = self._connect().execute(
+            "DELETE FROM state WHERE namespace = ? AND key NOT IN "
+            "(SELECT key FROM state WHERE namespace = ? ORDER BY updated_at DESC LIMIT ?)",
+            (namespace, namespace, max_entries)
+        )
+        return cursor.rowcount
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_state_backend() -> StateBackend:
+    """Process-wide state backend chosen by STATE_BACKEND: "memory" (default) or "sqlite" """
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            kind = os.getenv("STATE_BACKEND", "memory").lower()
+            if kind == "sqlite":
+                _backend = SQLiteBackend()
+            elif kind == "memory":
+                _backend = InProcessBackend()
+            else:
+                raise ValueError(f"Unknown STATE_BACKEND '{kind}' (expected 'memory' or 'sqlite')")
+        return _backend
@@ -0,0 +1,172 @@
+# app/sync_manifest.py
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
+
+class SyncManifest:
+    """Per-course record of which Moodle files are in the graph, so a sync only ingests what changed"""
+
+    def __init__(self, db_path: str = None):
+        self.db_path = db_path or os.getenv("SYNC_MANIFEST_PATH", "sync_manifest.db")
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS sync_files (
+                    course_id INTEGER NOT NULL,
+                    doc_id TEXT NOT NULL,
+                    fileurl TEXT,
+                    timemodified INTEGER,
+                    filesize INTEGER,
+                    content_hash TEXT,
+                    chunks INTEGER,
+                    synced_at REAL,
+                    PRIMARY KEY (course_id, doc_id)
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS sync_courses (
+                    course_id INTEGER PRIMARY KEY,
+                    last_synced_at REAL,
+                    failures INTEGER NOT NULL DEFAULT 0,
+                    failed_at REAL
+                )
+            """)
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(sync_courses)")}
+            if "failures" not in columns:
+                conn.execute("ALTER TABLE sync_courses ADD COLUMN failures INTEGER NOT NULL DEFAULT 0")
+                conn.execute("ALTER TABLE sync_courses ADD COLUMN failed_at REAL")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def files(self, course_id: int) -> Dict[str, Dict[str, Any]]:
+        with self._connect() as conn:
+            rows = conn.execute("SELECT * FROM sync_files WHERE course_id = ?", (course_id,)).fetchall()
+        return {row["doc_id"]: dict(row) for row in rows}
+
+    def diff(self, course_id: int, pdf_files: List[Dict]) -> Dict[str, List]:
+        """
+        Split the current Moodle listing into new, changed and unchanged files,
+        and return the doc_ids that were synced before but are gone from Moodle.
+        """
+        known = self.files(course_id)
+        result = {"new": [], "changed": [], "unchanged": [], "removed": []}
+        for pdf in pdf_files:
+            entry = known.get(pdf["doc_id"])
+            if entry is None:
+                result["new"].append(pdf)
+            elif (entry["timemodified"] != pdf.get("timemodified")
+                  or entry["filesize"] != pdf.get("filesize")
+                  or entry["fileurl"] != pdf["fileurl"].split("?")[0]):
+                result["changed"].append(pdf)
+            else:
+                result["unchanged"].append(pdf)
+        listed = {pdf["doc_id"] for pdf in pdf_files}
+        result["removed"] = [doc_id for doc_id in known if doc_id not in listed]
+        return result
+
+    def record(self, course_id: int, pdf_info: Dict, content_hash: str, chunks: int):
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sync_files "
+                "(course_id, doc_id, fileurl, timemodified, filesize, content_hash, chunks, synced_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (course_id, pdf_info["doc_id"], pdf_info["fileurl"].split("?")[0], pdf_info.get("timemodified"),
+                 pdf_info.get("filesize"), content_hash, chunks, time.time())
+            )
+
+    def remove(self, course_id: int, doc_id: str):
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM sync_files WHERE course_id = ? AND doc_id = ?", (course_id, doc_id))
+
+    def mark_synced(self, course_id: int, synced_at: float):
+        """Record a complete sync (which also clears any failures)"""
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sync_courses (course_id, last_synced_at) VALUES (?, ?)",
+                (course_id, synced_at)
+            )
+
+    def mark_failed(self, course_id: int):
+        """Count a failed or partial sync of a course that has synced before (see SyncScheduler backoff)"""
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "UPDATE sync_courses SET failures = failures + 1, failed_at = ? WHERE course_id = ?",
+                (time.time(), course_id)
+            )
+
+    def synced_courses(self) -> Dict[int, float]:
+        with self._connect() as conn:
+            rows = conn.execute("SELECT course_id, last_synced_at FROM sync_courses").fetchall()
+        return {row["course_id"]: row["last_synced_at"] for row in rows}
+
+    def course_states(self) -> List[Dict[str, Any]]:
+        """course_id, last_synced_at, failures (since the last complete sync) and failed_at per synced course"""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT * FROM sync_courses").fetchall()
+        return [dict(row) for row in rows]
+
+
+class SyncScheduler:
+    """
+    Periodically asks Moodle which previously synced courses changed (core_course_get_updates_since)
+    and queues an incremental sync only for those, without listing every course's contents.
+    Updates are asked for since the last sync less since_margin, for clock skew between this host
+    and Moodle. A course whose last sync failed is retried with exponential backoff (retry_backoff,
+    doubling per failure up to retry_max) rather than on every check.
+    """
+
+    def __init__(self, moodle, manifest: SyncManifest, submit_sync: Callable[[int], Any], interval: int = None):
+        self.moodle = moodle
+        self.manifest = manifest
+        self.submit_sync = submit_sync
+        self.interval = interval if interval is not None else int(os.getenv("SYNC_INTERVAL_SECONDS", "0"))
+        self.since_margin = float(os.getenv("SYNC_SINCE_MARGIN_SECONDS", "60"))
+        self.retry_backoff = float(os.getenv("SYNC_RETRY_BACKOFF_SECONDS", "300"))
+        self.retry_max = float(os.getenv("SYNC_RETRY_MAX_SECONDS", "86400"))
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name="sync-scheduler", daemon=True)
+        self._thread.start()
+        print(f"🔁 Course sync scheduler running every {self.interval}s")
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check_once()
+            except Exception as e:
+                print(f"⚠ Sync scheduler check failed: {str(e)}")
+
+    def retry_at(self, failures: int, failed_at: float) -> float:
+        """When a course whose sync failed failures times in a row may be synced again"""
+        return failed_at + min(self.retry_backoff * 2 ** (failures - 1), self.retry_max)
+
+    def check_once(self) -> List[int]:
+        """Queue a sync for every synced course that reports module updates; returns their IDs"""
+        queued = []
+        now = time.time()
+        for course in self.manifest.course_states():
+            course_id = course["course_id"]
+            if course["failures"] and now < self.retry_at(course["failures"], course["failed_at"] or 0):
+                continue
+            since = max(0, int((course["last_synced_at"] or 0) - self.since_margin))
+            updates = self.moodle.make_api_call(
+                'core_course_get_updates_since',
+                {'courseid': course_id, 'since': since}
+            )
+            if isinstance(updates, dict) and updates.get('instances'):
+                self.submit_sync(course_id)
+                queued.append(course_id)
+        return queued
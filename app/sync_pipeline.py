@@ -0,0 +1,458 @@
+# app/sync_pipeline.py
+import contextvars
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from boilerplate import BoilerplateStripper, boilerplate_enabled
+from extraction_cache import get_extraction_cache
+from utils import extract_pdf_page_range, iter_pdf_pages, pdf_page_count, pdf_page_ranges
+
+_DONE = object()
+
+
+class StageStats:
+    """Item, byte and busy-time counters for one pipeline stage"""
+
+    def __init__(self, name: str, unit: str):
+        self.name = name
+        self.unit = unit
+        self.items = 0
+        self.bytes = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    def record(self, items: int = 1, nbytes: int = 0, seconds: float = 0.0, failed: bool = False):
+        with self._lock:
+            now = time.perf_counter()
+            self.started_at = self.started_at or now - seconds
+            self.finished_at = now
+            self.items += 0 if failed else items
+            self.bytes += nbytes
+            self.errors += int(failed)
+            self.busy_seconds += seconds
+
+    def summary(self) -> Dict[str, Any]:
+        wall = (self.finished_at - self.started_at) if self.started_at else 0.0
+        return {
+            "unit": self.unit,
+            "items": self.items,
+            "errors": self.errors,
+            "bytes": self.bytes,
+            "wall_seconds": round(wall, 3),
+            "busy_seconds": round(self.busy_seconds, 3),
+            "items_per_second": round(self.items / wall, 2) if wall > 0 else None,
+        }
+
+
+class CourseSyncPipeline:
+    """
+    Staged course ingestion connected by bounded queues:
+
+        download (thread pool) -> extract (process pool, page ranges)
+            -> chunk (streams pages as they arrive, minus repeated headers/footers)
+            -> embed (large cross-file batches) -> write (one bulk Document per file)
+
+    Progress callbacks are only invoked from the thread that calls run(), so a
+    callback may raise (e.g. to cancel a job) and the pipeline shuts down cleanly.
+    """
+
+    def __init__(self, moodle, graph_memory, temp_dir: str, chunk_size: int = 1000, chunk_overlap: int = 200,
+                 progress: Callable[..., None] = None, known_hashes: Dict[str, str] = None):
+        self.moodle = moodle
+        self.graph = graph_memory
+        self.temp_dir = temp_dir
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.progress = progress or (lambda stage, **data: None)
+        # doc_id -> content hash already in the graph; identical downloads skip extraction and embedding
+        self.known_hashes = known_hashes or {}
+        self.extraction_cache = get_extraction_cache()
+
+        self.download_workers = int(os.getenv("SYNC_DOWNLOAD_WORKERS", "4"))
+        self.extract_workers = int(os.getenv("SYNC_EXTRACT_WORKERS", str(min(4, os.cpu_count() or 1))))
+        self.embed_batch_size = int(os.getenv("SYNC_EMBED_BATCH_SIZE", "256"))
+        # Pages per extraction task, and chunks per group streamed to the embedder before a file is done
+        self.pages_per_task = int(os.getenv("PDF_PAGES_PER_TASK", "20"))
+        self.stream_group_size = int(os.getenv("SYNC_STREAM_GROUP_SIZE", "32"))
+        self.strip_boilerplate = boilerplate_enabled()
+        queue_size = int(os.getenv("SYNC_QUEUE_SIZE", "8"))
+
+        self._extract_q = queue.Queue(maxsize=queue_size)
+        self._chunk_q = queue.Queue(maxsize=queue_size)
+        self._embed_q = queue.Queue(maxsize=queue_size)
+        self._write_q = queue.Queue(maxsize=queue_size)
+        self._events = queue.Queue()
+        self._stop = threading.Event()
+
+        self.stats = {
+            "download": StageStats("download", "files"),
+            "extract": StageStats("extract", "files"),
+            "chunk": StageStats("chunk", "chunks"),
+            "embed": StageStats("embed", "chunks"),
+            "write": StageStats("write", "chunks"),
+        }
+
+    # -- plumbing ---------------------------------------------------------
+
+    def _put(self, q: queue.Queue, item) -> bool:
+        """Blocking put that gives up once the pipeline is stopping"""
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q: queue.Queue):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _emit(self, stage: str, **data):
+        self._events.put((stage, data))
+
+    def _fail(self, pdf_info: Dict, stage: str, error: Exception):
+        print(f"  ✗ {stage} failed for {pdf_info['filename']}: {str(error)}")
+        self._events.put(("error", {"filename": pdf_info["filename"], "stage": stage, "error": str(error)}))
+
+    def _guard(self, target, *args):
+        """Run a stage; an unexpected crash stops the pipeline instead of leaving run() waiting forever"""
+        try:
+            target(*args)
+        except Exception as e:
+            print(f"❌ Sync pipeline stage {target.__name__} crashed: {str(e)}")
+            self._events.put(("crashed", {"error": f"{target.__name__}: {str(e)}"}))
+
+    # -- stages -----------------------------------------------------------
+
+    def _download_one(self, pdf_info: Dict, index: int, total: int):
+        if self._stop.is_set():
+            return
+        start = time.perf_counter()
+        local_path = os.path.join(self.temp_dir, f"{index}_{pdf_info['filename']}")
+        try:
+            downloaded = self.moodle.download_pdf_to_file(
+                pdf_info["fileurl"], local_path, pdf_info.get("module_id"), pdf_info.get("context_id")
+            )
+        except Exception as e:
+            self.stats["download"].record(seconds=time.perf_counter() - start, failed=True)
+            self._fail(pdf_info, "download", e)
+            return
+
+        self.stats["download"].record(nbytes=downloaded["size"], seconds=time.perf_counter() - start)
+        pdf_info = {**pdf_info, "content_hash": downloaded["content_hash"]}
+        if self.known_hashes.get(pdf_info["doc_id"]) == pdf_info["content_hash"]:
+            os.remove(local_path)
+            self._events.put(("unchanged", {"pdf_info": pdf_info}))
+            return
+
+        self._emit("files", phase="downloaded", index=index, total=total,
+                   filename=pdf_info["filename"], size=downloaded["size"])
+        self._put(self._extract_q, (pdf_info, local_path))
+
+    def _download_stage(self, pdf_files: List[Dict]):
+        with ThreadPoolExecutor(max_workers=self.download_workers, thread_name_prefix="sync-download") as pool:
+            for i, pdf_info in enumerate(pdf_files, 1):
+                pool.submit(contextvars.copy_context().run, self._download_one, pdf_info, i, len(pdf_files))
+        self._put(self._extract_q, _DONE)
+
+    def _extract_stage(self):
+        """Submit each downloaded file to the extraction pool as page-range tasks, in arrival order"""
+        pool = None
+        if self.extract_workers > 0:
+            try:
+                pool = ProcessPoolExecutor(max_workers=self.extract_workers)
+            except Exception as e:
+                print(f"⚠ Process pool unavailable, extracting in-thread: {str(e)}")
+
+        try:
+            while True:
+                item = self._get(self._extract_q)
+                if item is _DONE:
+                    break
+                pdf_info, local_path = item
+                cached = self.extraction_cache.get(pdf_info["content_hash"])
+                if cached is not None:
+                    # Same bytes were extracted before (by a sync or a chat upload); skip PyPDF2 entirely
+                    done = Future()
+                    done.set_result(cached)
+                    if not self._put(self._chunk_q, (pdf_info, local_path, [((0, len(cached)), done)],
+                                                     time.perf_counter(), True)):
+                        break
+                    continue
+                try:
+                    ranges = pdf_page_ranges(pdf_page_count(local_path), self.pages_per_task)
+                except Exception as e:
+                    self.stats["extract"].record(failed=True)
+                    self._fail(pdf_info, "extract", e)
+                    os.remove(local_path)
+                    continue
+                # Large files are split so several workers parse them at once
+                tasks = [
+                    (page_range, pool.submit(extract_pdf_page_range, local_path, *page_range) if pool else None)
+                    for page_range in ranges
+                ]
+                if not self._put(self._chunk_q, (pdf_info, local_path, tasks, time.perf_counter(), False)):
+                    break
+            self._put(self._chunk_q, _DONE)
+        finally:
+            if pool is not None:
+                # outstanding futures are still awaited by the chunk stage
+                pool.shutdown(wait=False, cancel_futures=self._stop.is_set())
+
+    def _iter_pages(self, local_path: str, tasks: List) -> Iterator[Tuple[int, str]]:
+        """Yield a file's pages in order as each page-range task finishes"""
+        for (start, end), future in tasks:
+            if future is None:
+                yield from iter_pdf_pages(local_path, start, end)
+                continue
+            try:
+                pages = future.result()
+            except BrokenProcessPool:
+                pages = extract_pdf_page_range(local_path, start, end)
+            yield from pages
+
+    def _chunk_estimate(self, characters: int, pages: int) -> int:
+        """
+        How many chunks chunk_pages makes of this much page text (pages joined with newlines),
+        the character-based counterpart of GraphMemory.chunk_count
+        """
+        total = characters + max(pages - 1, 0)
+        if not total:
+            return 0
+        step = self.chunk_size - self.chunk_overlap
+        return max(1, -(-(total - self.chunk_overlap) // step))
+
+    def _chunk_stage(self):
+        """
+        Chunk each file while its pages are still being extracted, handing chunks to the
+        embedder in groups so embedding of a large file starts before the file is fully parsed.
+        """
+        while True:
+            item = self._get(self._chunk_q)
+            if item is _DONE:
+                break
+            pdf_info, local_path, tasks, submitted_at, cached = item
+            characters = 0
+            page_count = 0
+            count = 0
+            group = []
+            start = time.perf_counter()
+
+            def counted_pages():
+                nonlocal characters, page_count
+                pages = self._iter_pages(local_path, tasks)
+                if not cached:
+                    # written to the cache as they pass, so the file's pages are never all held
+                    pages = self.extraction_cache.caching(pdf_info["content_hash"], pages)
+                for page in pages:
+                    characters += len(page[1])
+                    page_count += 1
+                    yield page
+
+            stripper = BoilerplateStripper() if self.strip_boilerplate else None
+            pages = stripper.filter(counted_pages()) if stripper else counted_pages()
+            try:
+                for chunk in self.moodle.chunk_pages(pages, self.chunk_size, self.chunk_overlap):
+                    group.append(chunk)
+                    count += 1
+                    if len(group) >= self.stream_group_size:
+                        if not self._put(self._embed_q, (pdf_info, group, False)):
+                            return
+                        group = []
+            except Exception as e:
+                self.stats["extract"].record(failed=True)
+                self._fail(pdf_info, "extract", e)
+                # drop what was already sent for this file
+                self._put(self._embed_q, (pdf_info, None, True))
+                continue
+            finally:
+                try:
+                    os.remove(local_path)
+                except OSError:
+                    pass
+
+            boilerplate = None
+            if stripper:
+                boilerplate = stripper.report(self._chunk_estimate(characters, page_count), count)
+            self.stats["extract"].record(nbytes=characters, seconds=time.perf_counter() - submitted_at)
+            self.stats["chunk"].record(items=count, seconds=time.perf_counter() - start)
+            self._emit("chunks", filename=pdf_info["filename"], characters=characters, chunks=count,
+                       pages=page_count, cached=cached, boilerplate=boilerplate)
+            if not self._put(self._embed_q, (pdf_info, group, True)):
+                break
+        self._put(self._embed_q, _DONE)
+
+    def _embed_stage(self):
+        """Accumulate chunks across files so each embedding request carries a full batch"""
+        pending_files = []   # [pdf_info, chunks, embeddings, error, complete]
+        open_files = {}      # doc_id -> entry still receiving chunk groups
+        pending_texts = []   # (file_entry, chunk_index, text)
+
+        def flush():
+            if pending_texts:
+                texts = [text for _, _, text in pending_texts]
+                start = time.perf_counter()
+                try:
+                    embeddings = self.graph._embed_texts(texts)
+                except Exception as e:
+                    self.stats["embed"].record(seconds=time.perf_counter() - start, failed=True)
+                    for entry in {id(entry): entry for entry, _, _ in pending_texts}.values():
+                        entry[3] = entry[3] or e
+                    embeddings = [None] * len(texts)
+                else:
+                    self.stats["embed"].record(items=len(texts), seconds=time.perf_counter() - start)
+                    self._emit("batches", step="embed", size=len(texts))
+                for (entry, idx, _), emb in zip(pending_texts, embeddings):
+                    entry[2][idx] = emb
+                pending_texts.clear()
+
+            # hand every complete, fully embedded file to the writer, in order
+            while pending_files:
+                entry = pending_files[0]
+                if not entry[4] or (entry[3] is None and any(e is None for e in entry[2])):
+                    break
+                pending_files.pop(0)
+                if entry[3] is False:
+                    continue  # extraction failed part-way; already reported
+                if entry[3] is not None:
+                    self._fail(entry[0], "embed", entry[3])
+                else:
+                    self._put(self._write_q, entry)
+
+        while True:
+            item = self._get(self._embed_q)
+            if item is _DONE:
+                break
+            pdf_info, chunks, complete = item
+            entry = open_files.get(pdf_info["doc_id"])
+            if entry is None:
+                entry = [pdf_info, [], [], None, False]
+                open_files[pdf_info["doc_id"]] = entry
+                pending_files.append(entry)
+            if chunks is None:
+                entry[3] = False
+            else:
+                for chunk in chunks:
+                    entry[1].append(chunk)
+                    entry[2].append(None)
+                    pending_texts.append((entry, len(entry[1]) - 1, chunk["text"]))
+                    if len(pending_texts) >= self.embed_batch_size:
+                        flush()
+            if complete:
+                entry[4] = True
+                del open_files[pdf_info["doc_id"]]
+                if not pending_texts:
+                    flush()
+        flush()
+        self._put(self._write_q, _DONE)
+
+    def _write_stage(self):
+        while True:
+            item = self._get(self._write_q)
+            if item is _DONE:
+                break
+            pdf_info, chunks, embeddings, _, _ = item
+            start = time.perf_counter()
+            try:
+                written = self.graph.add_document_chunks(
+                    doc_id=pdf_info["doc_id"],
+                    title=pdf_info.get("module_name") or pdf_info["filename"],
+                    chunks=[c["text"] for c in chunks],
+                    embeddings=embeddings,
+                    metadata={**pdf_info["metadata"], "filename": pdf_info["filename"], "total_chunks": len(chunks),
+                              "content_hash": pdf_info.get("content_hash")},
+                    replace=True,
+                    invalidate=False,
+                    pages=[(c.get("page_start"), c.get("page_end")) for c in chunks],
+                )
+            except Exception as e:
+                self.stats["write"].record(seconds=time.perf_counter() - start, failed=True)
+                self._fail(pdf_info, "write", e)
+                continue
+            self.stats["write"].record(items=written, seconds=time.perf_counter() - start)
+            self._events.put(("written", {"pdf_info": pdf_info, "chunks": written}))
+        self._events.put(("finished", {}))
+
+    # -- driver -------------------------------------------------------------
+
+    def run(self, pdf_files: List[Dict]) -> Dict[str, Any]:
+        """Process every file through all stages; returns counts, errors and per-stage throughput"""
+        stages = [
+            ("sync-download", self._download_stage, (pdf_files,)),
+            ("sync-extract", self._extract_stage, ()),
+            ("sync-chunk", self._chunk_stage, ()),
+            ("sync-embed", self._embed_stage, ()),
+            ("sync-write", self._write_stage, ()),
+        ]
+        # every stage runs in a copy of the caller's context, so metrics and model usage keep
+        # the course (and trace) of the sync job; extraction processes make no model calls
+        threads = [
+            threading.Thread(target=contextvars.copy_context().run, args=(self._guard, target, *args),
+                             name=name, daemon=True)
+            for name, target, args in stages
+        ]
+        for t in threads:
+            t.start()
+
+        successful, total_chunks, errors = 0, 0, []
+        synced_files, unchanged_files = [], []
+        boilerplate = {"chunks_saved": 0, "tokens_saved": 0, "lines_removed": 0}
+        try:
+            while True:
+                stage, data = self._events.get()
+                if stage == "finished":
+                    break
+                if stage == "crashed":
+                    raise RuntimeError(f"Course sync pipeline failed: {data['error']}")
+                if stage == "error":
+                    errors.append(f"{data['filename']} ({data['stage']}): {data['error']}")
+                    self.progress("files", phase="failed", **data)
+                elif stage == "written":
+                    successful += 1
+                    total_chunks += data["chunks"]
+                    synced_files.append({**data["pdf_info"], "chunks": data["chunks"]})
+                    self.progress("batches", step="write", filename=data["pdf_info"]["filename"], size=data["chunks"])
+                elif stage == "chunks":
+                    for key in boilerplate:
+                        boilerplate[key] += (data.get("boilerplate") or {}).get(key, 0)
+                    self.progress(stage, **data)
+                elif stage == "unchanged":
+                    unchanged_files.append(data["pdf_info"])
+                    self.progress("files", phase="unchanged", filename=data["pdf_info"]["filename"])
+                else:
+                    self.progress(stage, **data)
+        finally:
+            self._stop.set()
+            for t in threads:
+                t.join(timeout=5)
+
+        throughput = {name: stats.summary() for name, stats in self.stats.items()}
+        self.progress("throughput", stages=throughput)
+        for name, summary in throughput.items():
+            print(f"  {name:<9} {summary['items']:>6} {summary['unit']:<6} "
+                  f"{summary['items_per_second'] or 0:>8} /s  (busy {summary['busy_seconds']}s)")
+
+        return {
+            "downloaded": self.stats["download"].items,
+            "successful": successful,
+            "failed": len(pdf_files) - successful - len(unchanged_files),
+            "total_chunks": total_chunks,
+            "errors": errors,
+            "throughput": throughput,
+            "boilerplate": boilerplate,
+            "synced_files": synced_files,
+            "unchanged_files": unchanged_files,
+        }
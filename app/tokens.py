@@ -0,0 +1,34 @@
+# app/tokens.py
+import os
+import threading
+
+# Rough OpenAI tokenizer ratio for English text, used when tiktoken is unavailable
+CHARS_PER_TOKEN = 4
+
+_encoder = None
+_encoder_loaded = False
+_encoder_lock = threading.Lock()
+
+
+def _get_encoder():
+    global _encoder, _encoder_loaded
+    with _encoder_lock:
+        if not _encoder_loaded:
+            _encoder_loaded = True
+            try:
+                import tiktoken
+                _encoder = tiktoken.encoding_for_model(os.getenv("TOKENIZER_MODEL", "gpt-4o-mini"))
+            except Exception as e:
+                # tiktoken missing, or its BPE file cannot be downloaded (offline deployments)
+                print(f"⚠ tiktoken unavailable ({str(e)[:80]}), estimating tokens as characters / {CHARS_PER_TOKEN}")
+        return _encoder
+
+
+def count_tokens(text: str) -> int:
+    """Number of model tokens in text (estimated from its length when no tokenizer is available)"""
+    if not text:
+        return 0
+    encoder = _get_encoder()
+    if encoder is None:
+        return max(1, len(text) // CHARS_PER_TOKEN)
+    return len(encoder.encode(text, disallowed_special=()))
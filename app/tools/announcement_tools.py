@@ -1,9 +1,14 @@
-from openai import OpenAI
+from typing import TYPE_CHECKING
+
+from metrics import stage_timer
+
+if TYPE_CHECKING:
+    from openai import OpenAI
 
 class AnnouncementTools:
     """Course announcements and reminders"""
     
-    def __init__(self, client: OpenAI):
+    def __init__(self, client: "OpenAI"):
         self.client = client
 
     def create_announcement(self, context: str, urgency: str = "normal") -> str:
@@ -21,10 +26,11 @@ class AnnouncementTools:
         Don't include greetings or sign-offs.
         """
 
-        response = self.client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}]
-        )
+        with stage_timer("llm"):
+            response = self.client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[{"role": "user", "content": prompt}]
+            )
 
         return response.choices[0].message.content.strip()
 
@@ -38,9 +44,10 @@ class AnnouncementTools:
         Keep it polite and short.
         """
 
-        response = self.client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}]
-        )
+        with stage_timer("llm"):
+            response = self.client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[{"role": "user", "content": prompt}]
+            )
 
         return response.choices[0].message.content.strip()
\ No newline at end of file
@@ -1,11 +1,15 @@
 import json
-from typing import Dict, Any
-from openai import OpenAI
+from typing import TYPE_CHECKING, Dict, Any
+
+from metrics import stage_timer
+
+if TYPE_CHECKING:
+    from openai import OpenAI
 
 class GradingTools:
     """Assignment grading and feedback tools"""
     
-    def __init__(self, client: OpenAI):
+    def __init__(self, client: "OpenAI"):
         self.client = client
 
     def grade_assignment(self, assignment_content: str, rubric: Dict[str, Any], student_answer: str) -> Dict:
@@ -25,10 +29,11 @@ class GradingTools:
         }}
         """
 
-        response = self.client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}]
-        )
+        with stage_timer("llm"):
+            response = self.client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[{"role": "user", "content": prompt}]
+            )
 
         content = response.choices[0].message.content.strip()
         try:
@@ -1,11 +1,15 @@
 import json
-from typing import Dict
-from openai import OpenAI
+from typing import TYPE_CHECKING, Dict
+
+from metrics import stage_timer
+
+if TYPE_CHECKING:
+    from openai import OpenAI
 
 class PerformanceTools:
     """Student performance analysis tools"""
     
-    def __init__(self, client: OpenAI):
+    def __init__(self, client: "OpenAI"):
         self.client = client
 
     def analyze_performance(self, student_data: Dict) -> Dict:
@@ -23,10 +27,11 @@ class PerformanceTools:
         }}
         """
 
-        response = self.client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}]
-        )
+        with stage_timer("llm"):
+            response = self.client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[{"role": "user", "content": prompt}]
+            )
 
         content = response.choices[0].message.content.strip()
         try:
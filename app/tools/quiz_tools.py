@@ -1,11 +1,15 @@
 import json
-from typing import Dict
-from openai import OpenAI
+from typing import TYPE_CHECKING, Dict
+
+from metrics import stage_timer
+
+if TYPE_CHECKING:
+    from openai import OpenAI
 
 class QuizTools:
     """Quiz generation and management tools"""
     
-    def __init__(self, client: OpenAI, graph_memory):
+    def __init__(self, client: "OpenAI", graph_memory):
         self.client = client
         self.graph_memory = graph_memory
 
@@ -39,10 +43,11 @@ class QuizTools:
         Always starts with questions key.
         """
 
-        response = self.client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}]
-        )
+        with stage_timer("llm"):
+            response = self.client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[{"role": "user", "content": prompt}]
+            )
 
         content = response.choices[0].message.content.strip()
 
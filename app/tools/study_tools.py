@@ -1,11 +1,16 @@
 import json
-from typing import Dict
-from openai import OpenAI
+from typing import TYPE_CHECKING, Dict
+
+from metrics import stage_timer
+from usage import free_text_output
+
+if TYPE_CHECKING:
+    from openai import OpenAI
 
 class StudyTools:
     """Study planning and learning tools"""
     
-    def __init__(self, client: OpenAI):
+    def __init__(self, client: "OpenAI"):
         self.client = client
 
     def generate_study_plan(self, student_performance: Dict, course_content: Dict) -> Dict:
@@ -19,10 +24,11 @@ class StudyTools:
         Return JSON format.
         """
 
-        response = self.client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}]
-        )
+        with stage_timer("llm"):
+            response = self.client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[{"role": "user", "content": prompt}]
+            )
 
         content = response.choices[0].message.content.strip()
         try:
@@ -41,9 +47,11 @@ class StudyTools:
         Respond in an educational, supportive tone.
         """
 
-        response = self.client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}]
-        )
+        # plain prose, so the answer may be shortened for a course over budget
+        with stage_timer("llm"), free_text_output():
+            response = self.client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[{"role": "user", "content": prompt}]
+            )
 
         return response.choices[0].message.content.strip()
\ No newline at end of file
@@ -0,0 +1,308 @@
+# app/tracing.py
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+import requests
+
+
+class Span:
+    """One timed operation in a trace; ids and the traceparent header follow W3C Trace Context"""
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], sampled: bool, attributes: Dict[str, Any]):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attributes = {key: value for key, value in attributes.items() if value is not None}
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def to_dict(self, service: str) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_id,
+            "name": self.name,
+            "service": service,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3),
+            "status": "error" if self.error else "ok",
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+def parse_traceparent(header: Optional[str]) -> Optional[Dict[str, Any]]:
+    """trace_id, parent span_id and sampled flag from a traceparent header (None if malformed)"""
+    parts = (header or "").strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16), int(parts[2], 16), int(parts[3], 16)
+    except ValueError:
+        return None
+    return {"trace_id": parts[1], "parent_id": parts[2], "sampled": bool(int(parts[3], 16) & 1)}
+
+
+class SpanExporter:
+    """
+    Buffers finished spans and writes them from a background thread every export_seconds:
+    "file" appends JSON lines to TRACE_FILE, "otlp" posts OTLP/HTTP JSON to TRACE_OTLP_ENDPOINT,
+    "none" drops them (propagation still works).
+    """
+
+    def __init__(self, kind: str = None):
+        self.kind = kind or os.getenv("TRACE_EXPORTER", "file")
+        self.path = os.getenv("TRACE_FILE", "traces.jsonl")
+        self.max_bytes = int(float(os.getenv("TRACE_FILE_MAX_MB", "50")) * 1024 * 1024)
+        self.endpoint = os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+        self.export_seconds = float(os.getenv("TRACE_EXPORT_SECONDS", "1"))
+        self.service = os.getenv("TRACE_SERVICE_NAME", "academic-assistant")
+        self._buffer: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def enabled(self) -> bool:
+        return self.kind in ("file", "otlp")
+
+    def export(self, span: Span):
+        with self._lock:
+            self._buffer.append(span.to_dict(self.service))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="span-exporter", daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        while not self._stop.wait(self.export_seconds):
+            self.flush()
+
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                spans, self._buffer = self._buffer, []
+            if not spans:
+                return
+            try:
+                if self.kind == "file":
+                    self._write_file(spans)
+                elif self.kind == "otlp":
+                    self._post_otlp(spans)
+            except Exception as e:
+                print(f"⚠ Exporting {len(spans)} spans failed: {e}")
+
+    def _write_file(self, spans: List[Dict[str, Any]]):
+        if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+            os.replace(self.path, self.path + ".1")
+        # one write per batch in append mode, so both servers can share the file
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps(span, default=str) + "\n" for span in spans))
+
+    def _post_otlp(self, spans: List[Dict[str, Any]]):
+        def attribute(key, value):
+            if isinstance(value, bool):
+                return {"key": key, "value": {"boolValue": value}}
+            if isinstance(value, int):
+                return {"key": key, "value": {"intValue": str(value)}}
+            if isinstance(value, float):
+                return {"key": key, "value": {"doubleValue": value}}
+            return {"key": key, "value": {"stringValue": str(value)}}
+
+        by_service: Dict[str, List[Dict[str, Any]]] = {}
+        for span in spans:
+            by_service.setdefault(span["service"], []).append({
+                "traceId": span["trace_id"],
+                "spanId": span["span_id"],
+                "parentSpanId": span["parent_span_id"] or "",
+                "name": span["name"],
+                "kind": 1,
+                "startTimeUnixNano": str(span["start_ns"]),
+                "endTimeUnixNano": str(span["end_ns"]),
+                "attributes": [attribute(key, value) for key, value in span["attributes"].items()],
+                "status": {"code": 2, "message": span["error"]} if span["error"] else {"code": 1},
+            })
+        payload = {"resourceSpans": [
+            {
+                "resource": {"attributes": [attribute("service.name", service)]},
+                "scopeSpans": [{"scope": {"name": "academic-assistant"}, "spans": service_spans}],
+            }
+            for service, service_spans in by_service.items()
+        ]}
+        requests.post(self.endpoint, json=payload, timeout=5).raise_for_status()
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
+
+
+_current: contextvars.ContextVar = contextvars.ContextVar("current_span", default=None)
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+def get_exporter() -> SpanExporter:
+    """Process-wide span exporter"""
+    global _exporter
+    with _exporter_lock:
+        if _exporter is None:
+            _exporter = SpanExporter()
+        return _exporter
+
+
+def set_service_name(name: str):
+    """Service recorded on spans finished by this process (unless TRACE_SERVICE_NAME is set)"""
+    if not os.getenv("TRACE_SERVICE_NAME"):
+        get_exporter().service = name
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+def current_traceparent() -> Optional[str]:
+    """traceparent header for an outgoing call made from the current span"""
+    active = _current.get()
+    return active.traceparent if active is not None else None
+
+
+@contextmanager
+def span(name: str, trace_id: str = None, traceparent: str = None, **attributes) -> Iterator[Span]:
+    """
+    Run the block as a span. The parent is the remote caller in traceparent if given, else the
+    current span; without either a new trace starts (with trace_id if given, so a request id can
+    double as the trace id). Exceptions mark the span as failed and are re-raised.
+    """
+    exporter = get_exporter()
+    remote = parse_traceparent(traceparent)
+    parent = _current.get()
+    if remote is not None:
+        trace_id, parent_id, sampled = remote["trace_id"], remote["parent_id"], remote["sampled"]
+    elif parent is not None:
+        trace_id, parent_id, sampled = parent.trace_id, parent.span_id, parent.sampled
+    else:
+        trace_id = trace_id if trace_id and len(trace_id) == 32 else os.urandom(16).hex()
+        parent_id, sampled = None, random.random() < float(os.getenv("TRACE_SAMPLE_RATE", "1"))
+    active = Span(name, trace_id, parent_id, sampled and exporter.enabled, attributes)
+    token = _current.set(active)
+    try:
+        yield active
+    except Exception as e:
+        active.error = f"{type(e).__name__}: {str(e)[:200]}"
+        raise
+    finally:
+        _current.reset(token)
+        active.end_ns = time.time_ns()
+        if active.sampled:
+            exporter.export(active)
+
+
+class TracedSession(requests.Session):
+    """
+    requests.Session that records a span per HTTP request. With propagate=True it also sends
+    the traceparent header, for calls to our own services (never to Moodle or Google).
+    """
+
+    def __init__(self, propagate: bool = False):
+        super().__init__()
+        self.propagate = propagate
+
+    def request(self, method, url, *args, **kwargs):
+        with span(f"http {method.upper()}", url=str(url).split("?")[0]) as active:
+            if self.propagate:
+                kwargs["headers"] = {**(kwargs.get("headers") or {}), "traceparent": active.traceparent}
+            response = super().request(method, url, *args, **kwargs)
+            active.set_attribute("status_code", response.status_code)
+            return response
+
+
+def load_trace(trace_id: str, path: str = None) -> List[Dict[str, Any]]:
+    """Spans of one trace from the file exporter's output (including its rotated file)"""
+    path = path or get_exporter().path
+    get_exporter().flush()
+    spans = []
+    for candidate in (path + ".1", path):
+        if not os.path.exists(candidate):
+            continue
+        with open(candidate, encoding="utf-8") as f:
+            for line in f:
+                if trace_id in line:
+                    record = json.loads(line)
+                    if record["trace_id"] == trace_id:
+                        spans.append(record)
+    return sorted(spans, key=lambda record: record["start_ns"])
+
+
+def analyze_trace(spans: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Critical path and fan-out of a trace. The critical path walks back from the child each span
+    finished with to the child that had finished before it started, and so on, recursively; the
+    spans it lists are the ones the request waited on. Fan-out lists every span with more than one
+    child and how many of those children overlapped in time.
+    """
+    if not spans:
+        return {"spans": 0}
+    by_id = {record["span_id"]: record for record in spans}
+    children: Dict[Optional[str], List[Dict[str, Any]]] = {}
+    for record in spans:
+        parent = record["parent_span_id"] if record["parent_span_id"] in by_id else None
+        children.setdefault(parent, []).append(record)
+
+    def critical(node: Dict[str, Any], depth: int) -> List[Dict[str, Any]]:
+        kids, chain, cutoff = children.get(node["span_id"], []), [], float("inf")
+        while True:
+            candidates = [kid for kid in kids if kid["end_ns"] <= cutoff and kid not in chain]
+            if not candidates:
+                break
+            chain.append(max(candidates, key=lambda kid: kid["end_ns"]))
+            cutoff = chain[-1]["start_ns"]
+        path = [{
+            "name": node["name"], "service": node["service"], "depth": depth,
+            "duration_ms": node["duration_ms"],
+            "self_ms": round(max(node["duration_ms"] - sum(kid["duration_ms"] for kid in chain), 0.0), 3),
+        }]
+        for kid in reversed(chain):
+            path.extend(critical(kid, depth + 1))
+        return path
+
+    roots = children.get(None, [])
+    root = max(roots, key=lambda record: record["end_ns"] - record["start_ns"])
+    critical_path = critical(root, 0)
+
+    fan_out = []
+    for parent_id, kids in children.items():
+        if parent_id is None or len(kids) < 2:
+            continue
+        events = sorted([(kid["start_ns"], 1) for kid in kids] + [(kid["end_ns"], -1) for kid in kids])
+        running = peak = 0
+        for _, change in events:
+            running += change
+            peak = max(peak, running)
+        fan_out.append({"span": by_id[parent_id]["name"], "children": len(kids), "max_concurrent": peak})
+
+    return {
+        "trace_id": root["trace_id"],
+        "spans": len(spans),
+        "services": sorted({record["service"] for record in spans}),
+        "duration_ms": round((max(r["end_ns"] for r in spans) - min(r["start_ns"] for r in spans)) / 1e6, 3),
+        "errors": [{"name": r["name"], "error": r["error"]} for r in spans if r["error"]],
+        "critical_path": critical_path,
+        "fan_out": sorted(fan_out, key=lambda entry: -entry["children"]),
+    }
@@ -0,0 +1,107 @@
+# app/uploads.py
+import base64
+import codecs
+import hashlib
+import os
+import tempfile
+from typing import Iterator, Optional
+
+from fastapi import UploadFile
+
+
+class UploadTooLarge(Exception):
+    """Raised when an upload exceeds UPLOAD_MAX_MB"""
+
+
+class SpooledUpload:
+    """
+    An uploaded document held in a SpooledTemporaryFile: kept in memory while small and moved to
+    a temp file on disk past the spool threshold, so memory per upload stays bounded.
+    The SHA-256 is computed while the bytes are copied in.
+    """
+
+    def __init__(self, filename: str = None, spool_bytes: int = None, max_bytes: int = None):
+        self.filename = filename or "Uploaded Document"
+        self.spool_bytes = spool_bytes or int(os.getenv("UPLOAD_SPOOL_MAX_MB", "8")) * 1024 * 1024
+        self.max_bytes = max_bytes or int(os.getenv("UPLOAD_MAX_MB", "100")) * 1024 * 1024
+        self.file = tempfile.SpooledTemporaryFile(max_size=self.spool_bytes)
+        self.size = 0
+        self._hasher = hashlib.sha256()
+        self._head = b""
+
+    def write(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise UploadTooLarge(f"{self.filename} is larger than {self.max_bytes // (1024 * 1024)} MB")
+        if len(self._head) < 4:
+            self._head += chunk[:4 - len(self._head)]
+        self._hasher.update(chunk)
+        self.file.write(chunk)
+
+    def finish(self) -> "SpooledUpload":
+        self.file.flush()
+        self.file.seek(0)
+        return self
+
+    @property
+    def content_hash(self) -> str:
+        return self._hasher.hexdigest()
+
+    @property
+    def on_disk(self) -> bool:
+        return bool(getattr(self.file, "_rolled", False))
+
+    @property
+    def is_pdf(self) -> bool:
+        # PDF files start with "%PDF"
+        return self._head == b"%PDF"
+
+    def read_text(self) -> str:
+        self.file.seek(0)
+        return self.file.read().decode("utf-8", errors="ignore")
+
+    def iter_text(self, block_size: int = 1024 * 1024) -> Iterator[str]:
+        """The upload decoded as UTF-8, block by block (a block may end mid-word)"""
+        self.file.seek(0)
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        while True:
+            block = self.file.read(block_size)
+            if not block:
+                break
+            yield decoder.decode(block)
+        yield decoder.decode(b"", final=True)
+
+    def close(self):
+        self.file.close()
+
+
+async def spool_upload_file(upload: UploadFile, chunk_size: int = None) -> SpooledUpload:
+    """Copy a multipart UploadFile into a SpooledUpload chunk by chunk, hashing as it goes"""
+    chunk_size = chunk_size or int(os.getenv("UPLOAD_READ_CHUNK_KB", "1024")) * 1024
+    spool = SpooledUpload(upload.filename)
+    try:
+        while True:
+            chunk = await upload.read(chunk_size)
+            if not chunk:
+                break
+            spool.write(chunk)
+    except Exception:
+        spool.close()
+        raise
+    finally:
+        await upload.close()
+    return spool.finish()
+
+
+def spool_base64(data: str, filename: Optional[str] = None, chunk_chars: int = 4 * 1024 * 1024) -> SpooledUpload:
+    """Decode a base64 document (legacy /chat "file" field) into a SpooledUpload in slices"""
+    spool = SpooledUpload(filename)
+    data = "".join(data.split())
+    try:
+        # slices are a multiple of 4 characters, so each decodes on its own
+        for start in range(0, len(data), chunk_chars):
+            spool.write(base64.b64decode(data[start:start + chunk_chars], validate=True))
+    except Exception:
+        spool.close()
+        raise
+    return spool.finish()
@@ -0,0 +1,326 @@
+# app/usage.py
+import contextvars
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+from metrics import current_labels
+from tokens import count_tokens
+
+# USD per million tokens as (input, output); override or extend with USAGE_PRICES='{"model": [in, out]}'
+DEFAULT_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-3.5-turbo": (0.50, 1.50),
+    "text-embedding-3-small": (0.02, 0.0),
+    "text-embedding-3-large": (0.13, 0.0),
+}
+
+# Usage is stored in hourly buckets, so "since" queries and budget windows have hour resolution
+BUCKET_SECONDS = 3600
+
+KEY_FIELDS = ("bucket", "request_id", "session_id", "tool", "course", "model", "kind")
+VALUE_FIELDS = ("calls", "prompt_tokens", "completion_tokens", "cost_usd")
+GROUP_FIELDS = ("request_id", "session_id", "tool", "course", "model", "kind")
+
+# set inside free_text_output(): the answer length of chat completions there may be capped
+_free_text: contextvars.ContextVar = contextvars.ContextVar("free_text_output", default=False)
+
+
+class CourseOverBudget(Exception):
+    """Raised for a model call on behalf of a course past its hard budget limit (COURSE_BUDGET_HARD_FACTOR)"""
+
+
+@contextmanager
+def free_text_output() -> Iterator[None]:
+    """
+    Mark the chat completions in this block as producing free text, so a course over budget also
+    gets its answer length capped. Everything else (JSON for intents, quizzes, grading) only
+    switches to the cheaper model, since cut-off JSON cannot be parsed.
+    """
+    token = _free_text.set(True)
+    try:
+        yield
+    finally:
+        _free_text.reset(token)
+
+
+class UsageTracker:
+    """
+    Model token usage and cost, attributed to request, session, tool and course.
+
+    Calls are summed in memory and flushed to SQLite every flush_seconds by a background thread,
+    so recording a call never waits on disk. The main app and the MCP server share the database;
+    query() flushes this process first, the other process's latest calls appear after its next flush.
+    """
+
+    def __init__(self, db_path: str = None, flush_seconds: float = None):
+        self.db_path = db_path or os.getenv("USAGE_DB_PATH", "usage.db")
+        self.flush_seconds = flush_seconds if flush_seconds is not None else float(os.getenv("USAGE_FLUSH_SECONDS", "10"))
+        self.prices = {**DEFAULT_PRICES, **{model: tuple(price) for model, price in json.loads(os.getenv("USAGE_PRICES", "{}")).items()}}
+        self.budgets = {str(course): float(usd) for course, usd in json.loads(os.getenv("COURSE_BUDGETS_USD", "{}")).items()}
+        self.default_budget = float(os.getenv("COURSE_BUDGET_USD", "0"))  # 0 = no limit
+        self.budget_window = float(os.getenv("COURSE_BUDGET_WINDOW_HOURS", "720")) * 3600
+        self.fallback_model = os.getenv("BUDGET_FALLBACK_MODEL", "gpt-4o-mini")
+        self.fallback_max_tokens = int(os.getenv("BUDGET_FALLBACK_MAX_TOKENS", "400"))
+        # past budget x hard_factor model calls are refused outright (0 = never refuse)
+        self.hard_factor = float(os.getenv("COURSE_BUDGET_HARD_FACTOR", "0"))
+        self._pending: Dict[tuple, List[float]] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._spend_cache: Dict[str, tuple] = {}
+        self._thread = None
+        self._stop = threading.Event()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS usage (
+                    bucket INTEGER NOT NULL,
+                    request_id TEXT NOT NULL,
+                    session_id TEXT NOT NULL,
+                    tool TEXT NOT NULL,
+                    course TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    calls INTEGER NOT NULL,
+                    prompt_tokens INTEGER NOT NULL,
+                    completion_tokens INTEGER NOT NULL,
+                    cost_usd REAL NOT NULL,
+                    PRIMARY KEY (bucket, request_id, session_id, tool, course, model, kind)
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS usage_course ON usage (course, bucket)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def price(self, model: str, prompt_tokens: int, completion_tokens: int) -> float:
+        """Cost in USD; dated model names (gpt-4o-mini-2024-07-18) use their base model's price"""
+        matches = [name for name in self.prices if model == name or model.startswith(name + "-")]
+        if not matches:
+            return 0.0
+        price_in, price_out = self.prices[max(matches, key=len)]
+        return (prompt_tokens * price_in + completion_tokens * price_out) / 1_000_000
+
+    def record(self, kind: str, model: str, prompt_tokens: int, completion_tokens: int = 0,
+               labels: Dict[str, str] = None):
+        """Add one model call to the in-memory totals (kind is "chat" or "embedding")"""
+        labels = labels if labels is not None else current_labels()
+        key = (int(time.time() // BUCKET_SECONDS * BUCKET_SECONDS),) + tuple(
+            labels.get(field, "") for field in ("request_id", "session_id", "tool", "course")
+        ) + (model or "", kind)
+        cost = self.price(model or "", prompt_tokens, completion_tokens)
+        with self._lock:
+            totals = self._pending.setdefault(key, [0, 0, 0, 0.0])
+            totals[0] += 1
+            totals[1] += prompt_tokens
+            totals[2] += completion_tokens
+            totals[3] += cost
+            course = labels.get("course", "")
+            if course in self._spend_cache:
+                spent, checked_at = self._spend_cache[course]
+                self._spend_cache[course] = (spent + cost, checked_at)
+        self._ensure_flusher()
+
+    def _ensure_flusher(self):
+        if self._thread is None and self.flush_seconds > 0:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._loop, name="usage-flush", daemon=True)
+                    self._thread.start()
+
+    def _loop(self):
+        while not self._stop.wait(self.flush_seconds):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"⚠ Usage flush failed: {e}")
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
+
+    def flush(self) -> int:
+        """Write the in-memory totals to SQLite; returns the number of rows written"""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+            try:
+                with self._connect() as conn:
+                    conn.executemany(
+                        f"INSERT INTO usage ({', '.join(KEY_FIELDS + VALUE_FIELDS)}) "
+                        f"VALUES ({', '.join('?' * (len(KEY_FIELDS) + len(VALUE_FIELDS)))}) "
+                        f"ON CONFLICT ({', '.join(KEY_FIELDS)}) DO UPDATE SET "
+                        + ", ".join(f"{field} = {field} + excluded.{field}" for field in VALUE_FIELDS),
+                        [key + tuple(totals) for key, totals in pending.items()]
+                    )
+            except Exception:
+                # keep the totals for the next attempt
+                with self._lock:
+                    for key, totals in pending.items():
+                        merged = self._pending.setdefault(key, [0, 0, 0, 0.0])
+                        for i, value in enumerate(totals):
+                            merged[i] += value
+                raise
+            return len(pending)
+
+    def query(self, group_by: List[str] = None, since: float = None, **filters) -> Dict[str, Any]:
+        """
+        Usage totals grouped by any of request_id, session_id, tool, course, model, kind.
+        filters narrow the rows by those same fields (e.g. course="12").
+        """
+        group_by = [field for field in (group_by or []) if field in GROUP_FIELDS]
+        self.flush()
+        where, params = [], []
+        if since is not None:
+            where.append("bucket >= ?")
+            params.append(int(since // BUCKET_SECONDS * BUCKET_SECONDS))
+        for field, value in filters.items():
+            if field in GROUP_FIELDS and value is not None:
+                where.append(f"{field} = ?")
+                params.append(str(value))
+        sums = ", ".join(f"SUM({field}) AS {field}" for field in VALUE_FIELDS)
+        sql = f"SELECT {', '.join(group_by + [sums])} FROM usage"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        if group_by:
+            sql += f" GROUP BY {', '.join(group_by)} ORDER BY cost_usd DESC"
+        with self._connect() as conn:
+            rows = [dict(row) for row in conn.execute(sql, params).fetchall()]
+        for row in rows:
+            row["cost_usd"] = round(row["cost_usd"] or 0.0, 6)
+        if group_by:
+            return {"group_by": group_by, "rows": rows}
+        return {"totals": rows[0] if rows else {}}
+
+    def budget(self, course) -> float:
+        """Budget in USD for course over the budget window (0 = unlimited)"""
+        return self.budgets.get(str(course), self.default_budget)
+
+    def course_spend(self, course) -> float:
+        """USD spent on course within the budget window, cached for a few seconds between checks"""
+        course = str(course)
+        now = time.time()
+        with self._lock:
+            cached = self._spend_cache.get(course)
+        if cached and now - cached[1] < float(os.getenv("USAGE_BUDGET_CHECK_SECONDS", "30")):
+            return cached[0]
+        self.flush()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT SUM(cost_usd) FROM usage WHERE course = ? AND bucket >= ?",
+                (course, int((now - self.budget_window) // BUCKET_SECONDS * BUCKET_SECONDS))
+            ).fetchone()
+        spent = row[0] or 0.0
+        with self._lock:
+            self._spend_cache[course] = (spent, now)
+        return spent
+
+    def over_budget(self, course) -> bool:
+        if course in (None, ""):
+            return False
+        budget = self.budget(course)
+        return budget > 0 and self.course_spend(course) >= budget
+
+    def budget_status(self, course) -> Dict[str, Any]:
+        budget = self.budget(course)
+        spent = self.course_spend(course)
+        return {
+            "course": str(course),
+            "budget_usd": budget or None,
+            "spent_usd": round(spent, 6),
+            "window_hours": self.budget_window / 3600,
+            "over_budget": budget > 0 and spent >= budget,
+            "fallback_model": self.fallback_model,
+            "fallback_max_tokens": self.fallback_max_tokens,
+            "hard_limit_usd": budget * self.hard_factor if budget > 0 and self.hard_factor > 0 else None,
+        }
+
+    def check_budget(self, course, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Chat completion arguments to use for course: unchanged within budget, the cheaper fallback
+        once over it. Past the hard limit (if one is set) CourseOverBudget is raised instead.
+        """
+        if not self.over_budget(course):
+            return kwargs
+        budget, spent = self.budget(course), self.course_spend(course)
+        if self.hard_factor > 0 and spent >= budget * self.hard_factor:
+            raise CourseOverBudget(
+                f"Course {course} is over its model budget (${spent:.2f} spent of ${budget:.2f} "
+                f"in the last {self.budget_window / 3600:g} hours), so the assistant is paused for it"
+            )
+        print(f"💸 Course {course} is over budget, using {self.fallback_model}")
+        return self.cheaper_request(kwargs, cap_tokens=_free_text.get())
+
+    def cheaper_request(self, kwargs: Dict[str, Any], cap_tokens: bool = False) -> Dict[str, Any]:
+        """Chat completion arguments for a course over its budget: cheaper model, and with cap_tokens a shorter answer"""
+        request = {**kwargs, "model": self.fallback_model}
+        if cap_tokens:
+            max_tokens = kwargs.get("max_tokens")
+            request["max_tokens"] = min(max_tokens, self.fallback_max_tokens) if max_tokens else self.fallback_max_tokens
+        return request
+
+
+def _message_text(messages) -> str:
+    return "\n".join(str(message.get("content") or "") for message in messages or [] if isinstance(message, dict))
+
+
+def track_openai_client(client):
+    """
+    Meter every chat completion and embedding made through client, and switch chat completions
+    for courses over budget to the cheaper fallback (see UsageTracker.check_budget).
+    Returns the same client.
+    Token counts come from response.usage, estimated with count_tokens when it is missing.
+    """
+    completions, embeddings = client.chat.completions, client.embeddings
+    create_chat, create_embedding = completions.create, embeddings.create
+
+    def chat(*args, **kwargs):
+        tracker = get_usage_tracker()
+        labels = current_labels()
+        kwargs = tracker.check_budget(labels.get("course"), kwargs)
+        response = create_chat(*args, **kwargs)
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+        else:
+            prompt_tokens = count_tokens(_message_text(kwargs.get("messages")))
+            completion_tokens = sum(count_tokens(choice.message.content or "") for choice in response.choices)
+        tracker.record("chat", kwargs.get("model"), prompt_tokens, completion_tokens, labels)
+        return response
+
+    def embed(*args, **kwargs):
+        response = create_embedding(*args, **kwargs)
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            prompt_tokens = usage.prompt_tokens
+        else:
+            texts = kwargs.get("input")
+            prompt_tokens = sum(count_tokens(text) for text in ([texts] if isinstance(texts, str) else texts or []))
+        get_usage_tracker().record("embedding", kwargs.get("model"), prompt_tokens)
+        return response
+
+    completions.create = chat
+    embeddings.create = embed
+    return client
+
+
+_tracker = None
+_tracker_lock = threading.Lock()
+
+
+def get_usage_tracker() -> UsageTracker:
+    """Process-wide usage tracker"""
+    global _tracker
+    with _tracker_lock:
+        if _tracker is None:
+            _tracker = UsageTracker()
+        return _tracker
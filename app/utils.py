@@ -1,12 +1,15 @@
-from fpdf import FPDF
 import os
-import numpy as np
 import io
-from PyPDF2 import PdfReader
+from contextlib import nullcontext
+from typing import BinaryIO, Iterator, List, Tuple, Union
+import hashlib
+import unicodedata
+from extraction_cache import get_extraction_cache
 
 def generate_pdf(topic, content):
     filepath = f"/tmp/{topic}.pdf"
 
+    from fpdf import FPDF
     pdf = FPDF()
     pdf.add_page()
     pdf.set_font("Arial", size=12)
@@ -16,13 +19,63 @@ def generate_pdf(topic, content):
     print("PDF saved at:", filepath)
     return filepath
 
+def _open_pdf_source(pdf_source: Union[bytes, str, BinaryIO]):
+    if isinstance(pdf_source, str):
+        return open(pdf_source, "rb")
+    if isinstance(pdf_source, (bytes, bytearray)):
+        return io.BytesIO(pdf_source)
+    # caller-owned file handle (e.g. a spooled upload): rewind it and leave it open
+    pdf_source.seek(0)
+    return nullcontext(pdf_source)
+
+def iter_pdf_pages(pdf_source: Union[bytes, str, BinaryIO], start: int = 0, end: int = None) -> Iterator[Tuple[int, str]]:
+    """
+    Lazily yield (page_no, text) for pages [start, end) of a PDF given as bytes, a file path or an open binary file.
+    Page numbers are 1-based; pages that fail to extract yield an empty string.
+    """
+    from PyPDF2 import PdfReader  # deferred: PyPDF2 is only needed once a PDF is actually read
+    with _open_pdf_source(pdf_source) as f:
+        reader = PdfReader(f)
+        end = len(reader.pages) if end is None else min(end, len(reader.pages))
+        for index in range(start, end):
+            try:
+                text = normalize_page_text(reader.pages[index].extract_text() or "")
+            except Exception:
+                text = ""
+            yield index + 1, text
+
+def normalize_page_text(text: str) -> str:
+    """Unicode-normalize extracted text and drop NULs, CRs and trailing spaces on each line."""
+    text = unicodedata.normalize("NFKC", text).replace("\x00", "").replace("\r\n", "\n").replace("\r", "\n")
+    return "\n".join(line.rstrip() for line in text.split("\n"))
+
+def pdf_page_count(pdf_source: Union[bytes, str, BinaryIO]) -> int:
+    from PyPDF2 import PdfReader
+    with _open_pdf_source(pdf_source) as f:
+        return len(PdfReader(f).pages)
+
+def extract_pdf_page_range(file_path: str, start: int, end: int) -> List[Tuple[int, str]]:
+    """Extract pages [start, end) of a PDF on disk (top-level so it can run in a process pool)."""
+    return list(iter_pdf_pages(file_path, start, end))
+
+def pdf_page_ranges(page_count: int, pages_per_task: int = None) -> List[Tuple[int, int]]:
+    """Split a PDF into page ranges so one large file can be extracted by several workers."""
+    pages_per_task = pages_per_task or int(os.getenv("PDF_PAGES_PER_TASK", "20"))
+    return [(start, min(start + pages_per_task, page_count)) for start in range(0, page_count, pages_per_task)]
+
+def extract_pdf_pages_cached(pdf_bytes: bytes, content_hash: str = None) -> List[Tuple[int, str]]:
+    """(page_no, text) pages of a PDF, served from the content-addressed extraction cache when possible."""
+    cache = get_extraction_cache()
+    content_hash = content_hash or hashlib.sha256(pdf_bytes).hexdigest()
+    pages = cache.get(content_hash)
+    if pages is None:
+        pages = list(iter_pdf_pages(pdf_bytes))
+        cache.put(content_hash, pages)
+    return pages
+
 def extract_pdf_text(pdf_bytes: bytes) -> str:
-    reader = PdfReader(io.BytesIO(pdf_bytes))
-    text = []
-    for page in reader.pages:
-        try:
-            txt = page.extract_text() or ""
-            text.append(txt)
-        except:
-            continue
-    return "\n".join(text)
\ No newline at end of file
+    return "\n".join(text for _, text in extract_pdf_pages_cached(pdf_bytes))
+
+def extract_pdf_file_text(file_path: str) -> str:
+    """Extract text from a PDF on disk (top-level so it can run in a process pool)."""
+    return "\n".join(text for _, text in iter_pdf_pages(file_path))
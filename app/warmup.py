@@ -0,0 +1,168 @@
+# app/warmup.py
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app_container import AppContainer
+
+# Step names run by default, in order; override per process with WARMUP_STEPS / MCP_WARMUP_STEPS
+DEFAULT_STEPS = ("openai_client", "tokenizer", "neo4j", "moodle_courses", "course_contents")
+
+
+def warmup_enabled() -> bool:
+    return os.getenv("WARMUP_ENABLED", "true").lower() in ("1", "true", "yes")
+
+
+class Warmup:
+    """
+    Runs slow first-use work (client construction, connection pools, caches) in a background
+    thread after startup, so the first real request does not pay for it. status() reports
+    progress for the readiness endpoint; a failed step marks the process degraded, not down.
+    """
+
+    def __init__(self, steps: Dict[str, Callable[[], Optional[Dict[str, Any]]]]):
+        self.steps = steps
+        self._lock = threading.Lock()
+        self._thread = None
+        self._state = "pending" if steps else "ready"
+        self._started_at = None
+        self._finished_at = None
+        self._results: Dict[str, Dict[str, Any]] = {
+            name: {"name": name, "status": "pending"} for name in steps
+        }
+
+    def start(self):
+        """Start warming in a daemon thread (no-op if already started or nothing to do)"""
+        with self._lock:
+            if self._thread is not None or not self.steps:
+                return
+            self._state = "warming"
+            self._started_at = time.time()
+            self._thread = threading.Thread(target=self._run, name="warmup", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        failed = False
+        for name, step in self.steps.items():
+            with self._lock:
+                self._results[name]["status"] = "running"
+            start = time.perf_counter()
+            try:
+                detail = step()
+                result = {"status": "done"}
+                if detail:
+                    result["detail"] = detail
+            except Exception as e:
+                failed = True
+                result = {"status": "failed", "error": str(e)[:200]}
+                print(f"⚠ Warm-up step {name} failed: {e}")
+            result["seconds"] = round(time.perf_counter() - start, 3)
+            with self._lock:
+                self._results[name].update(result)
+        with self._lock:
+            self._finished_at = time.time()
+            self._state = "degraded" if failed else "ready"
+        print(f"🔥 Warm-up {self._state} in {self._finished_at - self._started_at:.2f}s")
+
+    def wait(self, timeout: float = None) -> bool:
+        """Block until warm-up has finished; True if it finished within timeout"""
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+            return not thread.is_alive()
+        return self._state != "warming"
+
+    @property
+    def ready(self) -> bool:
+        """Whether requests can be served warm (a degraded warm-up still counts as ready)"""
+        return self._state in ("ready", "degraded", "disabled")
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            status = {
+                "state": self._state,
+                "steps": [dict(result) for result in self._results.values()],
+            }
+            if self._started_at is not None:
+                end = self._finished_at or time.time()
+                status["seconds"] = round(end - self._started_at, 3)
+        return status
+
+
+class DisabledWarmup(Warmup):
+    """Stand-in when WARMUP_ENABLED is off: always ready, never starts anything"""
+
+    def __init__(self):
+        super().__init__({})
+        self._state = "disabled"
+
+
+def recent_course_ids(container: AppContainer, limit: int = None) -> List[int]:
+    """Courses to preload: WARMUP_COURSE_IDS if set, else the most recently synced courses"""
+    limit = limit if limit is not None else int(os.getenv("WARMUP_MAX_COURSES", "5"))
+    configured = os.getenv("WARMUP_COURSE_IDS", "")
+    if configured.strip():
+        return [int(course_id) for course_id in configured.split(",") if course_id.strip()][:limit]
+    synced = container.moodle.sync_manifest.synced_courses()
+    return sorted(synced, key=lambda course_id: -(synced[course_id] or 0))[:limit]
+
+
+def build_steps(container: AppContainer, names: List[str]) -> Dict[str, Callable[[], Optional[Dict[str, Any]]]]:
+    """Warm-up steps for a process, by name, in the given order"""
+
+    def openai_client():
+        container.openai_client
+
+    def tokenizer():
+        from tokens import count_tokens
+        count_tokens("warm-up")
+
+    def neo4j():
+        # building the graph creates its schema; the query opens a pooled bolt connection
+        container.graph_memory.conn.run("RETURN 1 AS ok")
+
+    def embedding_matrix():
+        return container.graph_memory.load_embedding_matrix()
+
+    def moodle_courses():
+        # primes the Moodle read cache and the HTTP session's connection pool
+        return {"courses": len(container.moodle.get_user_courses())}
+
+    def course_contents():
+        course_ids = recent_course_ids(container)
+        for course_id in course_ids:
+            container.moodle.get_course_contents(course_id)
+        return {"courses": course_ids}
+
+    available = {
+        "openai_client": openai_client,
+        "tokenizer": tokenizer,
+        "neo4j": neo4j,
+        "embedding_matrix": embedding_matrix,
+        "moodle_courses": moodle_courses,
+        "course_contents": course_contents,
+    }
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        print(f"⚠ Unknown warm-up steps ignored: {', '.join(unknown)}")
+    return {name: available[name] for name in names if name in available}
+
+
+def readiness_status(warmup: Warmup, container: AppContainer) -> Tuple[int, Dict[str, Any]]:
+    """
+    HTTP status and body for a server's /ready endpoint: warm-up progress plus how long each
+    container service took to build; 503 until the warm-up has finished
+    """
+    status = warmup.status()
+    status["services"] = dict(container.build_seconds)
+    return (200 if warmup.ready else 503), status
+
+
+def create_warmup(container: AppContainer, env_var: str = "WARMUP_STEPS", default_steps=DEFAULT_STEPS) -> Warmup:
+    """Warm-up for this process, with steps taken from env_var (comma-separated) or default_steps"""
+    if not warmup_enabled():
+        return DisabledWarmup()
+    configured = os.getenv(env_var)
+    names = [name.strip() for name in configured.split(",") if name.strip()] if configured is not None else list(default_steps)
+    return Warmup(build_steps(container, names))
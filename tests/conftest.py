@@ -0,0 +1,11 @@
+# tests/conftest.py
+import os
+import sys
+
+# No span export: the default file exporter would write traces.jsonl into the working directory
+os.environ.setdefault("TRACE_EXPORTER", "none")
+
+# The app is a set of flat modules run from app/ (as in the Dockerfiles)
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app")
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
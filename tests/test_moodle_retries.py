@@ -0,0 +1,123 @@
+# tests/test_moodle_retries.py
+"""
+MoodleIntegration web-service calls against a stub Moodle (http.server on localhost):
+reads are retried on 5xx and dropped connections, writes are not, and the keep-alive pool is reused.
+"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import pytest
+import requests
+
+from moodle_integration import MoodleIntegration
+
+
+class StubMoodle(ThreadingHTTPServer):
+    """Answers each POST with the next scripted reply: an HTTP status, or 'reset' to drop the connection"""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.script = []
+        self.calls = []
+        self.connections = set()
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/webservice/rest/server.php"
+
+    def next_reply(self, handler):
+        with self._lock:
+            self.connections.add(handler.client_address)
+            self.calls.append(handler.wsfunction)
+            return self.script.pop(0) if self.script else 200
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+        self.wsfunction = parse_qs(body).get("wsfunction", [""])[0]
+        reply = self.server.next_reply(self)
+        if reply == "reset":
+            self.close_connection = True
+            self.connection.close()
+            return
+        payload = json.dumps({"ok": True} if reply == 200 else {"error": reply}).encode()
+        self.send_response(reply)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub():
+    server = StubMoodle()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def moodle(stub, monkeypatch):
+    monkeypatch.setenv("MOODLE_BASE_URL", stub.url)
+    monkeypatch.setenv("MOODLE_MAX_RETRIES", "3")
+    monkeypatch.setenv("MOODLE_RETRY_BACKOFF", "0")
+    client = MoodleIntegration()
+    client.cache_enabled = False
+    yield client
+    client.session.close()
+
+
+def test_read_is_retried_on_5xx(stub, moodle):
+    stub.script = [503, 502]
+    assert moodle.make_api_call("core_course_get_courses") == {"ok": True}
+    assert stub.calls == ["core_course_get_courses"] * 3
+    assert moodle.get_api_metrics()["core_course_get_courses"]["retries"] == 2
+
+
+def test_read_is_retried_on_connection_reset(stub, moodle):
+    stub.script = ["reset"]
+    assert moodle.make_api_call("core_course_get_contents", {"courseid": 2}) == {"ok": True}
+    assert len(stub.calls) == 2
+
+
+def test_read_gives_up_after_max_retries(stub, moodle):
+    stub.script = [500] * 10
+    with pytest.raises(requests.exceptions.HTTPError):
+        moodle.make_api_call("core_course_get_courses")
+    assert len(stub.calls) == 1 + moodle.max_retries
+    assert moodle.get_api_metrics()["core_course_get_courses"]["errors"] == 1
+
+
+def test_client_errors_are_not_retried(stub, moodle):
+    stub.script = [404]
+    with pytest.raises(requests.exceptions.HTTPError):
+        moodle.make_api_call("core_course_get_courses")
+    assert len(stub.calls) == 1
+
+
+@pytest.mark.parametrize("reply", [503, "reset"])
+def test_write_is_not_retried(stub, moodle, reply):
+    stub.script = [reply]
+    with pytest.raises((requests.exceptions.HTTPError, requests.exceptions.ConnectionError)):
+        moodle.make_api_call("mod_forum_add_discussion", {"forumid": 1, "subject": "s", "message": "m"})
+    assert stub.calls == ["mod_forum_add_discussion"]
+
+
+def test_session_pool_is_reused(stub, moodle):
+    for _ in range(5):
+        moodle.make_api_call("core_course_get_courses")
+    assert len(stub.calls) == 5
+    assert len(stub.connections) == 1